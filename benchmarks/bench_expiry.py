@@ -0,0 +1,83 @@
+"""Measure memory cleanup cost with many idle channels.
+
+Compares the old full scan (every message checked on every cleanup) with the
+heap-based cleanup in JsonMemoryBackend, which only visits channels whose
+oldest message has expired.
+
+Usage: python benchmarks/bench_expiry.py [--channels 10000] [--messages 50] [--expired 100]
+"""
+import argparse
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from memory_store import JsonMemoryBackend, MessageMemory
+from persistence import BackgroundWriter
+
+EXPIRY_HOURS = 24
+
+
+def legacy_cleanup(channels, max_messages):
+    """The original cleanup_expired_memories: rebuild every channel's deque"""
+    for channel_id in list(channels.keys()):
+        valid_messages = [msg for msg in channels[channel_id] if not msg.is_expired(EXPIRY_HOURS)]
+        if valid_messages:
+            channels[channel_id] = deque(valid_messages, maxlen=max_messages)
+        else:
+            del channels[channel_id]
+
+
+def populate(backend, channels, messages, expired):
+    """Fill a backend with idle channels, `expired` of which have one expired message"""
+    now = time.time()
+    for channel_id in range(channels):
+        history = deque(maxlen=messages)
+        # Idle channels: recent enough not to expire, except the first `expired` ones
+        oldest = now - (EXPIRY_HOURS * 3600 + 60 if channel_id < expired else 3600)
+        for i in range(messages):
+            history.append(MessageMemory('user', 1, f"message {i}", oldest + i))
+        backend.channels[channel_id] = history
+    backend.expiry_scheduled = {}
+    backend.expiry_heap = []
+    for channel_id, history in backend.channels.items():
+        backend.schedule_expiry(channel_id, history[0].timestamp)
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--expired', type=int, default=100, help='channels with an expired message')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    backend = JsonMemoryBackend(BackgroundWriter(), args.messages, EXPIRY_HOURS, os.devnull, os.devnull)
+    print(f"{args.channels} channels x {args.messages} messages, {args.expired} with expired messages")
+
+    populate(backend, args.channels, args.messages, args.expired)
+    first = timed(backend.cleanup_expired, 1)
+    idle = timed(backend.cleanup_expired, args.repeat)
+
+    populate(backend, args.channels, args.messages, args.expired)
+    legacy_first = timed(lambda: legacy_cleanup(backend.channels, args.messages), 1)
+    legacy_idle = timed(lambda: legacy_cleanup(backend.channels, args.messages), args.repeat)
+
+    print(f"{'':28} {'with expired':>14} {'all idle':>12}")
+    print(f"{'full scan (legacy)':28} {legacy_first * 1000:12.2f}ms {legacy_idle * 1000:10.2f}ms")
+    print(f"{'heap-based':28} {first * 1000:12.2f}ms {idle * 1000:10.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
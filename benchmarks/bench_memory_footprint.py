@@ -0,0 +1,81 @@
+"""Compare the memory footprint of the legacy and compact MessageMemory layouts.
+
+Usage: python benchmarks/bench_memory_footprint.py [--channels 10000] [--messages 50]
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from memory_store import MessageMemory
+
+
+class LegacyMessageMemory:
+    """The original layout: a __dict__ per instance and a datetime timestamp"""
+    def __init__(self, author_name, author_id, content, timestamp, is_bot=False):
+        self.author_name = author_name
+        self.author_id = author_id
+        self.content = content
+        self.timestamp = timestamp
+        self.is_bot = is_bot
+
+
+def build(channels, messages, make_record):
+    """Build {channel_id: deque} the way the bot does, returning the structure"""
+    memories = {}
+    now = time.time()
+    for channel_id in range(channels):
+        history = deque(maxlen=messages)
+        for i in range(messages):
+            # Discord hands us a fresh display-name string for every message
+            author_name = ''.join(['user', str(i % 8)])
+            history.append(make_record(author_name, 1000 + i % 8, f"message {i} in channel {channel_id}", now - i))
+        memories[channel_id] = history
+    return memories
+
+
+def measure(channels, messages, make_record):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    memories = build(channels, messages, make_record)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del memories
+    return current, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=50)
+    args = parser.parse_args()
+
+    layouts = {
+        'legacy (__dict__ + datetime)': lambda name, author_id, content, ts: LegacyMessageMemory(
+            name, author_id, content, datetime.fromtimestamp(ts)),
+        'compact (__slots__ + epoch + interned)': lambda name, author_id, content, ts: MessageMemory(
+            name, author_id, content, ts),
+    }
+
+    total = args.channels * args.messages
+    print(f"{args.channels} channels x {args.messages} messages = {total} records")
+    results = {}
+    for label, make_record in layouts.items():
+        size, elapsed = measure(args.channels, args.messages, make_record)
+        results[label] = size
+        print(f"{label:42} {size / 2**20:8.1f} MiB  {size / total:6.0f} B/record  built in {elapsed:.2f}s")
+
+    legacy, compact = results.values()
+    print(f"Compact layout saves {(legacy - compact) / 2**20:.1f} MiB ({100 * (1 - compact / legacy):.0f}%)")
+
+
+if __name__ == '__main__':
+    main()
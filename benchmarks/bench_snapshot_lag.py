@@ -0,0 +1,118 @@
+"""Measure event loop lag while a large memory snapshot is written.
+
+Writes a full JsonMemoryBackend snapshot from the background writer thread,
+once encoding on that thread and once in a CpuPool of worker processes, while
+a probe task on the event loop records how late its timers fire. Encoding in
+the writer thread competes with the loop for the GIL; the worker pool keeps
+the loop's lag close to idle.
+
+Usage: python benchmarks/bench_snapshot_lag.py [--channels 20000] [--messages 50] [--workers 2]
+"""
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cpu_pool import CpuPool
+from memory_store import JsonMemoryBackend, MessageMemory
+from persistence import BackgroundWriter
+
+PROBE_INTERVAL = 0.005  # Seconds between event loop probes
+
+
+def populate(backend, channels, messages):
+    now = time.time()
+    for channel_id in range(channels):
+        history = deque(maxlen=messages)
+        for i in range(messages):
+            history.append(MessageMemory(f'user{i % 7}', i % 7, f'message {i} in channel {channel_id} ' * 3, now - messages + i))
+        backend.channels[channel_id] = history
+
+
+async def probe(lags, stop):
+    """Record how much later than scheduled each short sleep wakes up"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+def summarize(lags):
+    lags = sorted(lags)
+    pick = lambda q: lags[min(len(lags) - 1, int(q * len(lags)))] * 1000
+    return f"p50 {pick(0.5):6.2f} ms  p99 {pick(0.99):6.2f} ms  max {lags[-1] * 1000:6.2f} ms"
+
+
+async def measure(backend):
+    """Write one snapshot in a worker thread, returning (snapshot copy s, write s, lag during write)"""
+    lags, stop = [], asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    await asyncio.sleep(0.1)
+    lags.clear()
+
+    backend.save()
+    start = time.perf_counter()
+    payload = backend.snapshot()  # Runs on the event loop, like BackgroundWriter._take_snapshots
+    copy_seconds = time.perf_counter() - start
+
+    # Only count lag caused by the write itself, not the copy above
+    await asyncio.sleep(PROBE_INTERVAL * 2)
+    lags.clear()
+    start = time.perf_counter()
+    await asyncio.to_thread(backend.write, payload)
+    write_seconds = time.perf_counter() - start
+
+    stop.set()
+    await probe_task
+    return copy_seconds, write_seconds, lags
+
+
+async def idle_lag(seconds=1.0):
+    lags, stop = [], asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    await asyncio.sleep(seconds)
+    stop.set()
+    await probe_task
+    return lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=20000)
+    parser.add_argument('--messages', type=int, default=50, help='messages per channel')
+    parser.add_argument('--workers', type=int, default=2, help='worker processes for the pooled run')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='snapshot-lag-')
+    os.chdir(workdir)
+
+    async def run():
+        print(f"{args.channels} channels x {args.messages} messages")
+        print(f"  {'idle':<28} lag {summarize(await idle_lag())}")
+        for label, pool in (('writer thread', CpuPool()), (f'{args.workers} worker processes', CpuPool(args.workers))):
+            backend = JsonMemoryBackend(BackgroundWriter(), args.messages, 24, f'{label}.snapshot.jsonl', f'{label}.journal.jsonl', cpu_pool=pool)
+            populate(backend, args.channels, args.messages)
+            # Like the bot after loading: keep the long-lived messages out of full GC passes
+            gc.collect()
+            gc.freeze()
+            # Start the workers before measuring so process startup is not counted
+            pool.run(sum, [1])
+            copy_seconds, write_seconds, lags = await measure(backend)
+            size = os.path.getsize(backend.snapshot_file) / 2**20
+            print(f"  {label:<28} lag {summarize(lags)}  (copy on loop {copy_seconds * 1000:.1f} ms, write {write_seconds:.2f} s, {size:.0f} MiB)")
+            pool.shutdown()
+            del backend
+            gc.unfreeze()
+            gc.collect()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Measure how long loading memories takes and how much resident memory it leaves.
+
+Writes a JsonMemoryBackend snapshot, then loads it in a fresh process per
+run: once indexing it (what the bot does at startup, reading each channel on
+first use) and once also reading every channel up front (the old behaviour).
+A few channels are then touched, as the first replies after startup would.
+
+Usage: python benchmarks/bench_startup.py [--channels 20000] [--messages 50] [--touch 100]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from memory_store import JsonMemoryBackend, MessageMemory
+from metrics import resident_memory_bytes
+from persistence import BackgroundWriter
+
+
+def make_backend(messages):
+    return JsonMemoryBackend(BackgroundWriter(), messages, 24, 'memories.snapshot.jsonl', 'memories.journal.jsonl')
+
+
+def write_snapshot(channels, messages):
+    backend = make_backend(messages)
+    now = time.time()
+    for channel_id in range(channels):
+        history = deque(maxlen=messages)
+        for i in range(messages):
+            history.append(MessageMemory(f'user{i % 7}', i % 7, f'message {i} in channel {channel_id} ' * 3, now - messages + i))
+        backend.channels[channel_id] = history
+    backend.save()
+    backend.writer.flush()
+
+
+def load(messages, eager, touch):
+    """Run in a child process: load the snapshot and report timings as JSON"""
+    rss_before = resident_memory_bytes()
+    backend = make_backend(messages)
+    start = time.perf_counter()
+    backend.load()
+    if eager:
+        backend.load_all()
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for channel_id in range(touch):
+        backend.recent(channel_id, 30)
+    touch_seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        'load_s': load_seconds,
+        'touch_ms': touch_seconds * 1000,
+        'rss_mib': (resident_memory_bytes() - rss_before) / 2**20,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, default=20000)
+    parser.add_argument('--messages', type=int, default=50, help='messages per channel')
+    parser.add_argument('--touch', type=int, default=100, help='channels used right after loading')
+    parser.add_argument('--child', choices=('lazy', 'eager'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        load(args.messages, args.child == 'eager', args.touch)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='startup-')
+    os.chdir(workdir)
+    write_snapshot(args.channels, args.messages)
+    size = os.path.getsize('memories.snapshot.jsonl') / 2**20
+    print(f"{args.channels} channels x {args.messages} messages ({size:.0f} MiB snapshot), {args.touch} channels touched after loading")
+
+    for label in ('eager', 'lazy'):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', label,
+             '--messages', str(args.messages), '--touch', str(args.touch)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"  {label:<6} load {result['load_s']:6.2f} s  first touches {result['touch_ms']:7.1f} ms  resident +{result['rss_mib']:6.0f} MiB")
+
+
+if __name__ == '__main__':
+    main()
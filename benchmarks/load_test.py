@@ -0,0 +1,333 @@
+"""Offline load test for the bot's message pipeline.
+
+Drives on_message (including the buffered ingestion of passive messages),
+add_message_to_memory, get_conversation_context and
+generate_ai_response with synthetic Discord messages across N guilds x M
+channels, against a local stub completion server with configurable latency.
+No Discord connection or OpenRouter key is needed.
+
+Usage: python benchmarks/load_test.py [--guilds 10] [--channels 10] [--messages 50]
+                                      [--mention-ratio 0.1] [--latency 0.2] [--json]
+                                      [--error-rate 0.1] [--rate-limit-rate 0.1] [--outage 2:5]
+
+The stub can inject faults (random 500s, 429s with Retry-After, and a full
+outage window) to exercise retries, the circuit breaker and load shedding.
+
+Any bot settings (MEMORY_BACKEND, STREAM_RESPONSES, COALESCE_MENTIONS, ...)
+can be passed as environment variables as usual.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO_ROOT)
+
+
+class FakeUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id = user_id
+        self.display_name = name
+        self.name = name
+        self.bot = bot
+        self.mention = f'<@{user_id}>'
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f'guild-{guild_id}'
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.sent = 0
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeSentMessage(self, content)
+
+
+class FakeSentMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+        self.created_at = datetime.now(timezone.utc)
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+        return self
+
+
+class FakeMessage:
+    """Just enough of discord.Message for the bot's on_message path"""
+    def __init__(self, author, channel, content, mentions=()):
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.mentions = list(mentions)
+        self.id = random.getrandbits(62)
+        self.created_at = datetime.now(timezone.utc)
+        self.first_reply_at = None
+        self.first_reply = None
+        self.reactions = []
+
+    async def reply(self, content=None, **kwargs):
+        if self.first_reply_at is None:
+            self.first_reply_at = time.perf_counter()
+            self.first_reply = content
+        return await self.channel.send(content)
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+
+async def start_stub_server(latency, reply_chars, error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0, outage=None):
+    """Start a local OpenAI-compatible completion server, returning (runner, base_url, fault counts).
+
+    `outage` is an optional (start, duration) window, in seconds after the
+    server starts, during which every request fails with a 503.
+    """
+    from aiohttp import web
+
+    reply = ('lorem ipsum dolor sit amet ' * (reply_chars // 27 + 1))[:reply_chars]
+    started = time.monotonic()
+    faults = {'requests': 0, '500': 0, '429': 0, '503': 0}
+
+    async def handle(request):
+        body = await request.json()
+        faults['requests'] += 1
+        await asyncio.sleep(latency)
+        if outage and outage[0] <= time.monotonic() - started < outage[0] + outage[1]:
+            faults['503'] += 1
+            return web.json_response({'error': {'message': 'upstream outage'}}, status=503)
+        roll = random.random()
+        if roll < rate_limit_rate:
+            faults['429'] += 1
+            return web.json_response({'error': {'message': 'rate limited'}}, status=429, headers={'Retry-After': str(retry_after)})
+        if roll < rate_limit_rate + error_rate:
+            faults['500'] += 1
+            return web.json_response({'error': {'message': 'injected failure'}}, status=500)
+        if body.get('stream'):
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            for i in range(0, len(reply), 40):
+                chunk = {
+                    'id': 'stub', 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'],
+                    'choices': [{'index': 0, 'delta': {'content': reply[i:i + 40]}, 'finish_reason': None}]
+                }
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            return response
+        return web.json_response({
+            'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': reply}}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+        })
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/v1', faults
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def rss_mib():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+
+async def run(args):
+    outage = tuple(float(part) for part in args.outage.split(':')) if args.outage else None
+    stub, base_url, faults = await start_stub_server(
+        args.latency, args.reply_chars, args.error_rate, args.rate_limit_rate, args.retry_after, outage
+    )
+    os.environ.setdefault('OPENROUTER_API_KEY', 'load-test')
+    os.environ['OPENROUTER_BASE_URL'] = base_url
+
+    # Import the bot only after pointing it at the stub server
+    import bot as bot_module
+    bot_module.bot._connection.user = bot_user = FakeUser(1, 'Dingus', bot=True)
+
+    async def skip_commands(message):
+        return None
+    bot_module.bot.process_commands = skip_commands
+
+    bot_module.load_system_prompts()
+    bot_module.load_memories()
+    bot_module.persistence_writer.start()
+    bot_module.message_ingestor.start()
+
+    random.seed(args.seed)
+    guilds = [FakeGuild(1000 + g) for g in range(args.guilds)]
+    channels = [FakeChannel(10_000 + g * args.channels + c, guild) for g, guild in enumerate(guilds) for c in range(args.channels)]
+    users = [FakeUser(100 + u, f'user{u}') for u in range(args.users)]
+
+    # Build the whole workload up front so generation cost is not measured
+    workload = []
+    for _ in range(args.messages):
+        for channel in channels:
+            mentioned = random.random() < args.mention_ratio
+            text = ' '.join(random.choice(('hey', 'what', 'is', 'the', 'plan', 'tonight', 'lol', 'ok')) for _ in range(random.randint(3, 30)))
+            content = f'<@{bot_user.id}> {text}' if mentioned else text
+            workload.append(FakeMessage(random.choice(users), channel, content, [bot_user] if mentioned else []))
+
+    # The client imports and sets up most of its machinery on the first request; keep that out of the numbers
+    await bot_module.generate_ai_response('warm up', 'bench', 0)
+    for key in faults:
+        faults[key] = 0
+
+    tracemalloc.start()
+    memory_before, _ = tracemalloc.get_traced_memory()
+    rss_before = rss_mib()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def deliver(message):
+        async with semaphore:
+            start = time.perf_counter()
+            await bot_module.on_message(message)
+            if message.mentions and message.first_reply_at is not None:
+                latencies.append(message.first_reply_at - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(deliver(message) for message in workload))
+    elapsed = time.perf_counter() - started
+
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Micro-benchmarks of the memory functions on the populated store
+    sample = channels[:min(len(channels), 100)]
+    start = time.perf_counter()
+    for i in range(args.micro_iterations):
+        bot_module.add_message_to_memory(sample[i % len(sample)].id, 'bench', 1, 'micro benchmark message')
+    add_us = (time.perf_counter() - start) / args.micro_iterations * 1e6
+    # Passive messages go through the ingestion buffer; include the bulk commit in the cost
+    start = time.perf_counter()
+    for i in range(args.micro_iterations):
+        bot_module.message_ingestor.submit(sample[i % len(sample)].id, 1000, 'bench', 1, 'micro benchmark message', time.time())
+    bot_module.message_ingestor.flush_all()
+    ingest_us = (time.perf_counter() - start) / args.micro_iterations * 1e6
+    start = time.perf_counter()
+    for i in range(args.micro_iterations):
+        bot_module.get_conversation_context(sample[i % len(sample)].id)
+    context_us = (time.perf_counter() - start) / args.micro_iterations * 1e6
+
+    # Persistence cost: flush everything and force a full checkpoint
+    start = time.perf_counter()
+    bot_module.message_ingestor.flush_all()
+    bot_module.save_memories()
+    await bot_module.persistence_writer.stop()
+    flush_seconds = time.perf_counter() - start
+    write_seconds = bot_module.REGISTRY.metrics['bot_persist_write_seconds']
+
+    await stub.cleanup()
+
+    mentions = [message for message in workload if message.mentions]
+    replies = [message.first_reply or '' for message in mentions if message.first_reply_at is not None]
+    results = {
+        'guilds': args.guilds,
+        'channels': len(channels),
+        'messages': len(workload),
+        'mentions': len(mentions),
+        'replies': len(latencies),
+        'replies_ok': sum(1 for reply in replies if not reply.startswith(('❌', '⏳'))),
+        'replies_error': sum(1 for reply in replies if reply.startswith('❌')),
+        'replies_shed': sum(1 for reply in replies if reply.startswith('⏳')),
+        'stub_requests': faults['requests'],
+        'stub_faults': faults['500'] + faults['429'] + faults['503'],
+        'retries': bot_module.AI_RETRIES.total(),
+        'stub_latency_ms': args.latency * 1000,
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_s': round(len(workload) / elapsed, 1),
+        'reply_p50_ms': round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+        'reply_p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        'add_message_us': round(add_us, 2),
+        'ingest_message_us': round(ingest_us, 2),
+        'get_context_us': round(context_us, 2),
+        'memory_growth_mib': round((memory_after - memory_before) / 2**20, 2),
+        'memory_peak_mib': round(memory_peak / 2**20, 2),
+        'rss_growth_mib': round(rss_mib() - rss_before, 2),
+        'final_flush_s': round(flush_seconds, 4),
+        'persist_writes': sum(write_seconds.count(job) for (job,) in write_seconds.series),
+        'persist_write_total_s': round(sum(series[-1] for series in write_seconds.series.values()), 4),
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--channels', type=int, default=10, help='channels per guild')
+    parser.add_argument('--messages', type=int, default=50, help='messages per channel')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--mention-ratio', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.2, help='stub completion latency in seconds')
+    parser.add_argument('--reply-chars', type=int, default=400)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of stub requests failing with a 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of stub requests failing with a 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After seconds sent with injected 429s')
+    parser.add_argument('--outage', help='START:DURATION seconds during which the stub fails every request with a 503')
+    parser.add_argument('--concurrency', type=int, default=500, help='messages in flight at once')
+    parser.add_argument('--micro-iterations', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print one JSON line for run-to-run comparison')
+    args = parser.parse_args()
+
+    # Keep state files from the run out of the working tree
+    workdir = tempfile.mkdtemp(prefix='dingus-load-test-')
+    os.chdir(workdir)
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results))
+    else:
+        width = max(len(key) for key in results)
+        for key, value in results.items():
+            print(f"{key:{width}}  {value}")
+        print(f"(state files written to {workdir})")
+
+
+if __name__ == '__main__':
+    main()
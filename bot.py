@@ -2,12 +2,30 @@ import discord
 from discord.ext import commands
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError
+import httpx
 import asyncio
-import json
-import re
-from datetime import datetime, timedelta
-from collections import deque
+import gc
+import time
+import signal
+from typing import Literal
+from persistence import BackgroundWriter
+from cpu_pool import CpuPool
+from memory_store import MessageMemory, JsonMemoryBackend, SqliteMemoryBackend
+from state_store import FileStateStore, SqliteStateStore
+from summarizer import RollingSummarizer
+from coalescer import MentionCoalescer
+from ingest import MessageIngestor, clean_content
+from dump_format import MessageRecorder
+from outbound import ReplySender, split_message
+from response_cache import ResponseCache
+from prompts import CompiledPrompt, PromptUsage
+from resilience import CircuitBreaker, Overloaded, RequestGuard, parse_retry_after
+from routing import ChatProvider, ModelRouter, estimate_prompt_tokens, parse_model_prices
+from metrics import REGISTRY, resident_memory_bytes, start_metrics_server
+
+# When the process started, for reporting how long it takes to become ready
+STARTED_AT = time.monotonic()
 
 # Load environment variables
 load_dotenv()
@@ -17,11 +35,113 @@ TOKEN = os.getenv('DISCORD_TOKEN')
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
 SITE_URL = os.getenv('SITE_URL', 'https://discord.com')
 SITE_NAME = os.getenv('SITE_NAME', 'Discord AI Bot')
+OPENROUTER_BASE_URL = os.getenv('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1')
+
+# AI client configuration
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', '64'))  # Maximum completions in flight at once
+AI_MAX_CONNECTIONS = int(os.getenv('AI_MAX_CONNECTIONS', '100'))  # Size of the shared HTTP connection pool
+AI_KEEPALIVE_SECONDS = float(os.getenv('AI_KEEPALIVE_SECONDS', '60'))  # How long idle connections stay open
+AI_CONNECT_TIMEOUT = float(os.getenv('AI_CONNECT_TIMEOUT', '5'))  # Seconds to establish a connection
+AI_REQUEST_TIMEOUT = float(os.getenv('AI_REQUEST_TIMEOUT', '30'))  # Seconds allowed per completion request
+
+# Upstream protection configuration
+AI_RATE_LIMIT = float(os.getenv('AI_RATE_LIMIT', '20'))  # Requests per second sent with the API key (0 disables the limit)
+AI_RATE_BURST = int(os.getenv('AI_RATE_BURST', '40'))  # Requests the API key may send at once after being idle
+GUILD_RATE_LIMIT = float(os.getenv('GUILD_RATE_LIMIT', '1'))  # Requests per second per guild (0 disables the limit)
+GUILD_RATE_BURST = int(os.getenv('GUILD_RATE_BURST', '10'))  # Requests a guild may send at once after being idle
+GUILD_MAX_WAIT_SECONDS = 5  # Longest a request waits for its guild's limit before being turned away
+AI_MAX_PENDING = int(os.getenv('AI_MAX_PENDING', '256'))  # Requests waiting or running before new ones are turned away
+AI_MAX_RETRIES = int(os.getenv('AI_MAX_RETRIES', '2'))  # Retries for timeouts, connection errors, 429s and 5xx responses
+AI_RETRY_BASE_DELAY = 0.5  # Seconds; backoff doubles per retry, with full jitter
+AI_RETRY_MAX_DELAY = float(os.getenv('AI_RETRY_MAX_DELAY', '8'))  # Longest backoff; a longer Retry-After gives up instead
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))  # Consecutive upstream failures that stop all requests
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', '30'))  # How long requests stay stopped before a trial request
+
+# AI model configuration
+AI_MODEL = os.getenv('AI_MODEL', 'openai/gpt-4o-mini')  # Fast, cheap model used for most replies
+AI_LARGE_MODEL = os.getenv('AI_LARGE_MODEL', AI_MODEL)  # Bigger model for long contexts (defaults to AI_MODEL, which disables routing)
+AI_ROUTE_LARGE_TOKENS = int(os.getenv('AI_ROUTE_LARGE_TOKENS', '1200'))  # Estimated prompt tokens above which replies use AI_LARGE_MODEL
+AI_ROUTE_SLOW_SECONDS = float(os.getenv('AI_ROUTE_SLOW_SECONDS', '10'))  # Recent model latency above which replies switch to the fastest model
+AI_ROUTE_BUSY_PENDING = int(os.getenv('AI_ROUTE_BUSY_PENDING', '64'))  # Pending requests above which replies switch to the fastest model
+AI_MODEL_PRICES = parse_model_prices(os.getenv('AI_MODEL_PRICES', 'openai/gpt-4o-mini=0.15:0.60,openai/gpt-4o=2.50:10.00'))  # USD per million input:output tokens, for cost stats
+AI_MAX_TOKENS = 300
+AI_TEMPERATURE = 0.8
+PROMPT_CACHE_CONTROL = os.getenv('PROMPT_CACHE_CONTROL', 'false').lower() == 'true'  # Mark system prompts cacheable for providers that need explicit breakpoints
+
+# Response cache configuration
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1000'))  # Cached completions kept (0 disables the cache)
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '600'))  # How long a cached completion is reused
+
+# Metrics configuration
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # Port for the Prometheus /metrics endpoint (0 disables it)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')  # Interface the metrics endpoint listens on
+
+# Reply configuration
+DISCORD_MESSAGE_LIMIT = 2000  # Discord's maximum message length
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'false').lower() == 'true'  # Edit replies as tokens arrive
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))  # Minimum seconds between message edits
+REPLY_MAX_AGE_SECONDS = float(os.getenv('REPLY_MAX_AGE_SECONDS', '300'))  # Replies to messages older than this are dropped instead of sent
+REPLY_MAX_QUEUED = int(os.getenv('REPLY_MAX_QUEUED', '20'))  # Replies waiting per channel before the stalest is dropped
+REPLY_CHANNEL_RATE = 1.0  # Messages per second per channel (Discord allows 5 every 5 seconds)
+REPLY_CHANNEL_BURST = 5  # Messages a quiet channel may send at once
+
+# Mention coalescing configuration
+COALESCE_MENTIONS = os.getenv('COALESCE_MENTIONS', 'false').lower() == 'true'  # Answer rapid-fire mentions with one reply
+COALESCE_WINDOW_SECONDS = float(os.getenv('COALESCE_WINDOW_SECONDS', '2'))  # How long to collect mentions in a channel
+COALESCE_MAX_BATCH = 10  # Mentions answered by one reply
+COALESCE_MAX_PENDING = int(os.getenv('COALESCE_MAX_PENDING', '20'))  # Queued mentions per channel before new ones are shed
+COALESCE_MAX_CONCURRENT = int(os.getenv('COALESCE_MAX_CONCURRENT', '32'))  # Batches answered at once across all guilds
+COALESCE_MAX_PER_GUILD = int(os.getenv('COALESCE_MAX_PER_GUILD', '4'))  # Batches answered at once per guild
 
 # Memory configuration
-MAX_MEMORY_MESSAGES = 50  # Maximum messages to remember per channel
+MAX_MEMORY_MESSAGES = int(os.getenv('MAX_MEMORY_MESSAGES', '50'))  # Maximum messages to remember per channel
 MEMORY_EXPIRY_HOURS = 24  # How long to keep messages in memory
-MAX_CONTEXT_MESSAGES = 10  # Maximum messages to include in AI context
+MAX_CONTEXT_MESSAGES = int(os.getenv('MAX_CONTEXT_MESSAGES', '30'))  # Maximum messages to include in AI context
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '1500'))  # Maximum tokens of history to include in AI context
+
+# Message ingestion configuration
+INGEST_FLUSH_SECONDS = float(os.getenv('INGEST_FLUSH_SECONDS', '1'))  # Longest an observed message is buffered before being committed to memory (0 commits each one right away)
+INGEST_MAX_BUFFERED = int(os.getenv('INGEST_MAX_BUFFERED', '2000'))  # Buffered messages across all channels that trigger an early commit
+INGEST_MAX_CHARS = int(os.getenv('INGEST_MAX_CHARS', '1000'))  # Longer messages are cut before being remembered
+
+# Memory persistence configuration
+MEMORY_BACKEND = os.getenv('MEMORY_BACKEND', 'json')  # 'json' (all channels in RAM) or 'sqlite'
+MEMORY_DB_FILE = 'memories.db'  # SQLite database used by the sqlite backend
+MEMORY_CACHE_CHANNELS = int(os.getenv('MEMORY_CACHE_CHANNELS', '1000'))  # Hot channels kept in RAM by the sqlite backend
+MEMORY_SNAPSHOT_FILE = 'memories.snapshot.jsonl'  # Compacted memories, one channel per line
+MEMORY_JOURNAL_FILE = 'memories.journal.jsonl'  # Append-only log of changes since the last snapshot
+LEGACY_MEMORY_FILE = 'memories.json'  # Old whole-file format, migrated on startup
+MEMORY_COMPACT_EVERY = int(os.getenv('MEMORY_COMPACT_EVERY', '1000'))  # Journal records between compactions
+# Rolling summary configuration
+ROLLING_SUMMARY_ENABLED = os.getenv('ROLLING_SUMMARY_ENABLED', 'false').lower() == 'true'  # Summarize history that drops out of memory
+SUMMARY_BATCH_SIZE = int(os.getenv('SUMMARY_BATCH_SIZE', '20'))  # Evicted messages folded into the summary at once
+SUMMARY_DELAY_SECONDS = float(os.getenv('SUMMARY_DELAY_SECONDS', '60'))  # How long to wait for a fuller batch
+SUMMARY_MAX_TOKENS = 250  # Maximum length of a channel summary
+
+# Long-term memory configuration (needs numpy)
+LONG_TERM_MEMORY_ENABLED = os.getenv('LONG_TERM_MEMORY_ENABLED', 'false').lower() == 'true'  # Recall relevant older messages from a per-server vector index
+LONG_TERM_MEMORY_MODEL = os.getenv('LONG_TERM_MEMORY_MODEL', '')  # Local fastembed model, e.g. 'BAAI/bge-small-en-v1.5' (unset uses hashed bag-of-words)
+LONG_TERM_MEMORY_DIM = 256  # Vector size of the hashed bag-of-words embeddings
+LONG_TERM_MEMORY_SIZE = int(os.getenv('LONG_TERM_MEMORY_SIZE', '2000'))  # Messages indexed per server; the oldest are replaced past this
+LONG_TERM_MEMORY_GUILDS = int(os.getenv('LONG_TERM_MEMORY_GUILDS', '1000'))  # Server indexes kept in RAM (others are loaded on use)
+LONG_TERM_MEMORY_TOP_K = int(os.getenv('LONG_TERM_MEMORY_TOP_K', '3'))  # Past messages added to each reply's context
+LONG_TERM_MEMORY_MIN_SCORE = float(os.getenv('LONG_TERM_MEMORY_MIN_SCORE', '0.2'))  # Similarity a past message needs to be recalled (models usually need a higher value, e.g. 0.5)
+LONG_TERM_MEMORY_BUDGET_MS = float(os.getenv('LONG_TERM_MEMORY_BUDGET_MS', '50'))  # Longest a search may take before the reply goes ahead without it
+LONG_TERM_MEMORY_MIN_CHARS = 20  # Shorter messages ("lol", "ok") are not indexed
+LONG_TERM_MEMORY_MAX_CHARS = 300  # Recalled messages are cut to this length
+LONG_TERM_MEMORY_DIR = 'long_term_memory'  # One file per server
+
+PERSIST_DELAY_SECONDS = float(os.getenv('PERSIST_DELAY_SECONDS', '2'))  # How long to batch changes before writing
+CPU_WORKERS = int(os.getenv('CPU_WORKERS', '0'))  # Worker processes for snapshot and journal encoding (0 encodes on the writer thread)
+RECORD_MESSAGES_FILE = os.getenv('RECORD_MESSAGES_FILE', '')  # Dump every remembered message is appended to, for `manage.py replay` (unset disables recording)
+
+# Shared state configuration
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'file')  # 'file' (JSON files) or 'sqlite' (one database for every process)
+STATE_DB_FILE = 'state.db'  # SQLite database used by the sqlite state backend
+
+# Sharding configuration
+SHARD_COUNT = os.getenv('SHARD_COUNT', '')  # Total gateway shards across all processes ('auto' lets Discord choose; unset disables sharding)
+SHARD_IDS = os.getenv('SHARD_IDS', '')  # Shards run by this process, e.g. '0-3' or '4,5' (unset runs them all)
 
 # Default system prompt (can be customized per server)
 DEFAULT_SYSTEM_PROMPT = """You are the character Kasane Teto. Kasane Teto is officially stated to be 31 years old.[1] However, a popular fan interpretation that she is a teenager stems from one of her earliest and most popular songs, "Kasane Territory ~ Always Teto's Turn" (in Japanese). The song comedically suggests that because she is a chimera (two halves, one human, forming one being), her age of 31 can be divided in two, making her 15.5 years old. This is a fan-created joke and not her official age, but despite this, the idea entered popular knowledge, leading many to incorrectly assume Teto's "real" age is 15. Teto's developers have acknowledged that fans have differing interpretations of her age and are free to interpret it differently. In her earliest design, she was 159.5 centimetres tall and weighed 47 kilograms. She is listed as liking baguettes (which she is frequently depicted with in fanart) and being a tsundere.[7]
@@ -35,271 +155,892 @@ Remember previous messages in the conversation and respond naturally, acknowledg
 # Store system prompts per guild
 guild_system_prompts = {}
 
-# Memory storage: {channel_id: deque of message objects}
-channel_memories = {}
-
-class MessageMemory:
-    """Class to store message information"""
-    def __init__(self, author_name, author_id, content, timestamp, is_bot=False):
-        self.author_name = author_name
-        self.author_id = author_id
-        self.content = content
-        self.timestamp = timestamp
-        self.is_bot = is_bot
-    
-    def to_dict(self):
-        return {
-            'author_name': self.author_name,
-            'author_id': self.author_id,
-            'content': self.content,
-            'timestamp': self.timestamp.isoformat(),
-            'is_bot': self.is_bot
-        }
-    
-    @classmethod
-    def from_dict(cls, data):
-        return cls(
-            author_name=data['author_name'],
-            author_id=data['author_id'],
-            content=data['content'],
-            timestamp=datetime.fromisoformat(data['timestamp']),
-            is_bot=data['is_bot']
-        )
-    
-    def is_expired(self):
-        """Check if this message is older than the expiry time"""
-        return datetime.now() - self.timestamp > timedelta(hours=MEMORY_EXPIRY_HOURS)
+# Prompts prepared for sending, built once when set or loaded: {guild_id: CompiledPrompt}
+compiled_prompts = {}
+default_compiled_prompt = CompiledPrompt(DEFAULT_SYSTEM_PROMPT, PROMPT_CACHE_CONTROL)
+
+# Provider-reported token usage per guild since startup: {guild_id: PromptUsage}
+prompt_usage = {}
+
+# Other per-guild settings: {guild_id: {setting: value}}
+guild_settings = {}
+
+# Guilds whose prompt or settings changed since the last write
+changed_system_prompts = set()
+changed_guild_settings = set()
 
-# Set up OpenAI client for OpenRouter
+# Personalities, settings and summaries, shared by every process serving the bot
+if STATE_BACKEND == 'sqlite':
+    state_store = SqliteStateStore(STATE_DB_FILE)
+    state_store.import_files(FileStateStore(), ('system_prompts', 'guild_settings', 'summaries'))
+else:
+    state_store = FileStateStore()
+
+# Writes state to disk in the background, merging bursts of changes
+persistence_writer = BackgroundWriter(delay=PERSIST_DELAY_SECONDS)
+
+# Worker processes for CPU-heavy encoding, so the writer never competes with the event loop for the GIL
+cpu_pool = CpuPool(CPU_WORKERS)
+
+# Conversation memory storage, keyed by channel
+if MEMORY_BACKEND == 'sqlite':
+    memory_backend = SqliteMemoryBackend(
+        persistence_writer,
+        MAX_MEMORY_MESSAGES,
+        MEMORY_EXPIRY_HOURS,
+        MEMORY_DB_FILE,
+        cache_channels=MEMORY_CACHE_CHANNELS
+    )
+else:
+    memory_backend = JsonMemoryBackend(
+        persistence_writer,
+        MAX_MEMORY_MESSAGES,
+        MEMORY_EXPIRY_HOURS,
+        MEMORY_SNAPSHOT_FILE,
+        MEMORY_JOURNAL_FILE,
+        legacy_file=LEGACY_MEMORY_FILE,
+        compact_every=MEMORY_COMPACT_EVERY,
+        cpu_pool=cpu_pool
+    )
+
+# Set up async OpenAI client for OpenRouter.
+# All requests share one keep-alive connection pool, so concurrent mentions
+# reuse connections instead of each holding an executor thread.
 if OPENROUTER_API_KEY:
-    client = OpenAI(
-        base_url="https://openrouter.ai/api/v1",
+    client = AsyncOpenAI(
+        base_url=OPENROUTER_BASE_URL,
         api_key=OPENROUTER_API_KEY,
+        timeout=AI_REQUEST_TIMEOUT,
+        max_retries=0,  # Retries are handled by ai_guard
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=AI_MAX_CONNECTIONS,
+                max_keepalive_connections=AI_MAX_CONNECTIONS,
+                keepalive_expiry=AI_KEEPALIVE_SECONDS,
+            ),
+            timeout=httpx.Timeout(AI_REQUEST_TIMEOUT, connect=AI_CONNECT_TIMEOUT),
+        ),
     )
 else:
     client = None
 
+# Limits how many completions run at once; extra requests wait their turn
+ai_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+
+def classify_ai_error(error):
+    """Sort a client error into (retryable, counts as an outage, Retry-After seconds or None)"""
+    if isinstance(error, APIConnectionError):
+        # Includes timeouts
+        return True, True, None
+    if isinstance(error, APIStatusError):
+        retry_after = parse_retry_after(error.response.headers.get('retry-after'))
+        if error.status_code == 429:
+            return True, False, retry_after
+        if error.status_code >= 500:
+            return True, True, retry_after
+    return False, False, None
+
+# Rate limits, retries, circuit breaking and load shedding for upstream requests
+ai_guard = RequestGuard(
+    classify_ai_error,
+    key_rate=AI_RATE_LIMIT,
+    key_burst=AI_RATE_BURST,
+    guild_rate=GUILD_RATE_LIMIT,
+    guild_burst=GUILD_RATE_BURST,
+    guild_max_wait=GUILD_MAX_WAIT_SECONDS,
+    max_pending=AI_MAX_PENDING,
+    max_retries=AI_MAX_RETRIES,
+    retry_base_delay=AI_RETRY_BASE_DELAY,
+    retry_max_delay=AI_RETRY_MAX_DELAY,
+    breaker=CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET_SECONDS),
+    on_retry=lambda error: AI_RETRIES.inc()
+)
+# Every completion goes through the provider (swap in a fake one to test without a network)
+ai_provider = ChatProvider(
+    client,
+    extra_headers={
+        "HTTP-Referer": SITE_URL,
+        "X-Title": SITE_NAME,
+    },
+    timeout=AI_REQUEST_TIMEOUT
+) if client else None
+
+# Picks the model for each request from prompt size, upstream load and recent latency
+model_router = ModelRouter(
+    AI_MODEL,
+    AI_LARGE_MODEL,
+    large_tokens=AI_ROUTE_LARGE_TOKENS,
+    slow_seconds=AI_ROUTE_SLOW_SECONDS,
+    busy_fn=lambda: ai_guard.pending >= AI_ROUTE_BUSY_PENDING,
+    prices=AI_MODEL_PRICES
+)
+
+OVERLOADED_REPLY = "⏳ I'm getting more requests than I can handle right now. Please try again in a moment!"
+
+# Hot-path metrics
+REPLY_SECONDS = REGISTRY.histogram('bot_reply_seconds', 'Time spent producing replies, by stage (queue, api, outbound, send)', labels=('stage',))
+REPLIES_DROPPED = REGISTRY.counter('bot_replies_dropped_total', 'Replies not sent (stale, queue_full or error)', labels=('reason',))
+AI_REQUESTS = REGISTRY.counter('bot_ai_requests_total', 'Completion requests sent to OpenRouter', labels=('kind',))
+AI_ERRORS = REGISTRY.counter('bot_ai_errors_total', 'Completion requests that failed', labels=('error',))
+AI_SHED = REGISTRY.counter('bot_ai_shed_total', 'Requests turned away before reaching OpenRouter', labels=('reason',))
+AI_RETRIES = REGISTRY.counter('bot_ai_retries_total', 'Completion requests retried after a transient failure')
+REGISTRY.gauge('bot_ai_pending_requests', 'Completion requests waiting or running', fn=lambda: ai_guard.pending)
+REGISTRY.gauge('bot_ai_circuit_open', 'Whether requests are stopped by the circuit breaker', fn=lambda: int(ai_guard.breaker.state != 'closed'))
+AI_MODEL_REQUESTS = REGISTRY.counter('bot_ai_model_requests_total', 'Completion requests by model and kind', labels=('model', 'kind'))
+REGISTRY.gauge('bot_ai_model_latency_seconds', 'Recent request latency per model', labels=('model',), fn=lambda: {
+    (model,): stats.latency for model, stats in model_router.stats.items() if stats.latency is not None
+})
+REGISTRY.gauge('bot_ai_model_cost_dollars', 'Estimated spend per model since startup', labels=('model',), fn=lambda: {
+    (model,): stats.cost for model, stats in model_router.stats.items()
+})
+AI_TOKENS = REGISTRY.counter('bot_ai_tokens_total', 'Tokens used by replies as reported by the provider (prompt, cached prompt, completion)', labels=('kind',))
+STARTUP_SECONDS = REGISTRY.gauge('bot_startup_seconds', 'Seconds from process start to the first ready event')
+REGISTRY.gauge('bot_resident_memory_bytes', 'Resident memory of the bot process', fn=resident_memory_bytes)
+LONG_TERM_RECALLS = REGISTRY.counter('bot_long_term_recalls_total', 'Long-term memory searches by outcome (hit, miss, timeout, error)', labels=('outcome',))
+LONG_TERM_RECALL_SECONDS = REGISTRY.histogram('bot_long_term_recall_seconds', 'Time spent searching long-term memory', buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+REGISTRY.gauge('bot_long_term_memories', 'Messages in long-term memory indexes held in RAM', fn=lambda: long_term_memory.memory_count() if long_term_memory else 0)
+INGEST_SKIPPED = REGISTRY.counter('bot_ingest_skipped_total', 'Observed messages not remembered (empty, attachment-only or commands)')
+REGISTRY.gauge('bot_ingest_buffered_messages', 'Observed messages waiting to be committed to memory', fn=lambda: message_ingestor.buffered)
+MEMORY_LOAD_SECONDS = REGISTRY.histogram('bot_memory_load_seconds', 'Time spent loading memories', buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0))
+
 # Bot setup with intents
 intents = discord.Intents.default()
 intents.message_content = True
 intents.guilds = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+def parse_shard_ids(value):
+    """Parse '0-3' or '0,2,5' (or a mix) into a sorted list of shard ids"""
+    shard_ids = set()
+    for part in value.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-', 1)
+            shard_ids.update(range(int(first), int(last) + 1))
+        elif part:
+            shard_ids.add(int(part))
+    return sorted(shard_ids)
+
+if SHARD_COUNT or SHARD_IDS:
+    # Split the gateway connection into shards; with SHARD_IDS several processes
+    # each run a slice of them and share state through the stores above
+    bot = commands.AutoShardedBot(
+        command_prefix='!',
+        intents=intents,
+        shard_count=int(SHARD_COUNT) if SHARD_COUNT and SHARD_COUNT != 'auto' else None,
+        shard_ids=parse_shard_ids(SHARD_IDS) if SHARD_IDS else None
+    )
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
 
 @bot.event
-async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
-    print(f'Bot ID: {bot.user.id}')
-    print(f'Connected to {len(bot.guilds)} guild(s)')
-    
-    # List all guilds the bot is in
-    for guild in bot.guilds:
-        print(f'- {guild.name} (ID: {guild.id})')
-    
-    # Load saved system prompts and memories
+async def setup_hook():
+    # Load saved state once per process, before connecting; reconnects fire
+    # on_ready again but must not reload (and overwrite) what is in memory
     load_system_prompts()
+    load_guild_settings()
     load_memories()
     
-    # Sync slash commands
+    # Start writing state to disk in the background
+    persistence_writer.start()
+    if rolling_summarizer:
+        rolling_summarizer.start()
+    if long_term_memory:
+        long_term_memory.start()
+    message_ingestor.start()
+    
+    # Serve metrics locally if enabled
+    if METRICS_PORT:
+        try:
+            await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        except Exception as e:
+            print(f"Error starting metrics server: {e}")
+    
+    # Shut down cleanly (and flush state) when the container is stopped
+    loop = asyncio.get_running_loop()
     try:
-        print("Syncing slash commands...")
-        synced = await bot.tree.sync()
-        print(f'✅ Successfully synced {len(synced)} command(s)')
-        for cmd in synced:
-            print(f'  - /{cmd.name}: {cmd.description}')
-    except Exception as e:
-        print(f'❌ Failed to sync commands: {e}')
+        loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(bot.close()))
+    except NotImplementedError:
+        pass
 
 def load_system_prompts():
-    """Load system prompts from file"""
+    """Load system prompts from the state store"""
     try:
-        if os.path.exists('system_prompts.json'):
-            with open('system_prompts.json', 'r') as f:
-                global guild_system_prompts
-                guild_system_prompts = json.load(f)
-                print(f"Loaded system prompts for {len(guild_system_prompts)} guilds")
+        global guild_system_prompts, compiled_prompts
+        guild_system_prompts = state_store.load('system_prompts')
+        compiled_prompts = {guild_id: CompiledPrompt(prompt, PROMPT_CACHE_CONTROL) for guild_id, prompt in guild_system_prompts.items()}
+        print(f"Loaded system prompts for {len(guild_system_prompts)} guilds")
     except Exception as e:
         print(f"Error loading system prompts: {e}")
 
-def save_system_prompts():
-    """Save system prompts to file"""
+def save_system_prompts(guild_id):
+    """Schedule a guild's system prompt to be saved"""
+    changed_system_prompts.add(str(guild_id))
+    persistence_writer.mark_dirty('system_prompts')
+
+def set_system_prompt(guild_id, prompt):
+    """Set a guild's system prompt (None restores the default), compiling it once for reuse"""
+    guild_id = str(guild_id)
+    if prompt is None:
+        guild_system_prompts.pop(guild_id, None)
+        compiled_prompts.pop(guild_id, None)
+    else:
+        guild_system_prompts[guild_id] = prompt
+        compiled_prompts[guild_id] = CompiledPrompt(prompt, PROMPT_CACHE_CONTROL)
+    save_system_prompts(guild_id)
+
+def load_guild_settings():
+    """Load per-guild settings from the state store"""
     try:
-        with open('system_prompts.json', 'w') as f:
-            json.dump(guild_system_prompts, f, indent=2)
+        global guild_settings
+        guild_settings = state_store.load('guild_settings')
+        print(f"Loaded settings for {len(guild_settings)} guilds")
     except Exception as e:
-        print(f"Error saving system prompts: {e}")
+        print(f"Error loading guild settings: {e}")
+
+def save_guild_settings(guild_id):
+    """Schedule a guild's settings to be saved"""
+    changed_guild_settings.add(str(guild_id))
+    persistence_writer.mark_dirty('guild_settings')
+
+def get_guild_setting(guild_id, name, default=None):
+    """Get one setting for a guild"""
+    return guild_settings.get(str(guild_id), {}).get(name, default)
+
+def set_guild_setting(guild_id, name, value):
+    """Change one setting for a guild and schedule it to be saved"""
+    guild_settings.setdefault(str(guild_id), {})[name] = value
+    save_guild_settings(guild_id)
+
+def snapshot_changes(state, changed):
+    """Copy the changed guilds' entries (None for removed ones) and reset the change set"""
+    changes = {guild_id: state.get(guild_id) for guild_id in changed}
+    changed.clear()
+    return {guild_id: dict(value) if isinstance(value, dict) else value for guild_id, value in changes.items()}
+
+persistence_writer.register(
+    'system_prompts',
+    lambda: snapshot_changes(guild_system_prompts, changed_system_prompts),
+    lambda changes: state_store.update('system_prompts', changes)
+)
+persistence_writer.register(
+    'guild_settings',
+    lambda: snapshot_changes(guild_settings, changed_guild_settings),
+    lambda changes: state_store.update('guild_settings', changes)
+)
+
+def migrate_json_memories_to_sqlite():
+    """Import memories saved by the JSON backend into an empty SQLite database"""
+    if not any(os.path.exists(path) for path in (MEMORY_SNAPSHOT_FILE, MEMORY_JOURNAL_FILE, LEGACY_MEMORY_FILE)):
+        return
+    
+    # Read through a JSON backend with its own writer so nothing is written back
+    json_backend = JsonMemoryBackend(
+        BackgroundWriter(),
+        MAX_MEMORY_MESSAGES,
+        MEMORY_EXPIRY_HOURS,
+        MEMORY_SNAPSHOT_FILE,
+        MEMORY_JOURNAL_FILE,
+        legacy_file=LEGACY_MEMORY_FILE
+    )
+    json_backend.load()
+    json_backend.load_all()
+    memory_backend.import_channels(json_backend.channels)
+    print(f"Imported {len(json_backend.channels)} channels into {MEMORY_DB_FILE}")
 
 def load_memories():
-    """Load conversation memories from file"""
+    """Load conversation memories from the configured backend"""
     try:
-        if os.path.exists('memories.json'):
-            with open('memories.json', 'r') as f:
-                data = json.load(f)
-                global channel_memories
-                for channel_id, messages in data.items():
-                    channel_memories[int(channel_id)] = deque([
-                        MessageMemory.from_dict(msg) for msg in messages
-                        if not MessageMemory.from_dict(msg).is_expired()
-                    ], maxlen=MAX_MEMORY_MESSAGES)
-                print(f"Loaded memories for {len(channel_memories)} channels")
-                
-                # Clean up expired memories
-                cleanup_expired_memories()
+        with MEMORY_LOAD_SECONDS.time():
+            if rolling_summarizer:
+                rolling_summarizer.load()
+            memory_backend.load()
+            if isinstance(memory_backend, SqliteMemoryBackend) and memory_backend.is_empty():
+                migrate_json_memories_to_sqlite()
+        # Loaded memories stay around for hours; keep them out of full GC passes,
+        # which would otherwise stall the event loop while a snapshot is written
+        gc.collect()
+        gc.freeze()
     except Exception as e:
         print(f"Error loading memories: {e}")
 
 def save_memories():
-    """Save conversation memories to file"""
-    try:
-        data = {}
-        for channel_id, messages in channel_memories.items():
-            # Only save non-expired messages
-            valid_messages = [msg for msg in messages if not msg.is_expired()]
-            if valid_messages:
-                data[str(channel_id)] = [msg.to_dict() for msg in valid_messages]
-        
-        with open('memories.json', 'w') as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        print(f"Error saving memories: {e}")
+    """Schedule conversation memories to be checkpointed to disk"""
+    memory_backend.save()
 
 def cleanup_expired_memories():
     """Remove expired messages from memory"""
-    for channel_id in list(channel_memories.keys()):
-        if channel_id in channel_memories:
-            # Filter out expired messages
-            valid_messages = [msg for msg in channel_memories[channel_id] if not msg.is_expired()]
-            if valid_messages:
-                channel_memories[channel_id] = deque(valid_messages, maxlen=MAX_MEMORY_MESSAGES)
-            else:
-                # Remove empty channels
-                del channel_memories[channel_id]
+    memory_backend.cleanup_expired()
 
 def add_message_to_memory(channel_id, author_name, author_id, content, is_bot=False):
     """Add a message to the channel's memory"""
-    if channel_id not in channel_memories:
-        channel_memories[channel_id] = deque(maxlen=MAX_MEMORY_MESSAGES)
-    
-    memory = MessageMemory(author_name, author_id, content, datetime.now(), is_bot)
-    channel_memories[channel_id].append(memory)
-    
-    # Save memories periodically (every few messages)
-    if len(channel_memories[channel_id]) % 5 == 0:
-        save_memories()
+    # Commit buffered messages first so the channel stays in time order
+    message_ingestor.flush(channel_id)
+    memory = MessageMemory(author_name, author_id, content, time.time(), is_bot)
+    memory_backend.add(channel_id, memory)
+    if message_recorder:
+        message_recorder.record(channel_id, None, [memory])
 
-def get_conversation_context(channel_id, max_messages=MAX_CONTEXT_MESSAGES):
-    """Get recent conversation context for AI"""
-    if channel_id not in channel_memories:
-        return []
-    
-    # Get the most recent messages (excluding expired ones)
+def get_conversation_context(channel_id, max_messages=MAX_CONTEXT_MESSAGES, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Get recent conversation context for AI, newest messages first until the token budget is used"""
+    message_ingestor.flush(channel_id)
     recent_messages = []
-    for memory in list(channel_memories[channel_id])[-max_messages:]:
-        if not memory.is_expired():
-            role = "assistant" if memory.is_bot else "user"
-            content = f"{memory.author_name}: {memory.content}" if not memory.is_bot else memory.content
-            recent_messages.append({"role": role, "content": content})
+    tokens_used = 0
+    for memory in memory_backend.iter_recent(channel_id, max_messages):
+        tokens_used += memory.tokens()
+        if tokens_used > token_budget:
+            break
+        role = "assistant" if memory.is_bot else "user"
+        recent_messages.append({"role": role, "content": memory.context_content()})
     
+    # Return in chronological order
+    recent_messages.reverse()
     return recent_messages
 
 def get_system_prompt(guild_id):
     """Get system prompt for a guild"""
     return guild_system_prompts.get(str(guild_id), DEFAULT_SYSTEM_PROMPT)
 
-async def generate_ai_response(message_content, user_name, guild_id, channel_id=None):
+def get_compiled_prompt(guild_id):
+    """Get the precompiled system prompt for a guild"""
+    return compiled_prompts.get(str(guild_id), default_compiled_prompt)
+
+def record_usage(guild_id, usage, model):
+    """Track provider-reported token usage for a guild's completion"""
+    if usage is None:
+        return
+    model_router.record_usage(model, usage)
+    guild_usage = prompt_usage.get(guild_id)
+    if guild_usage is None:
+        guild_usage = prompt_usage[guild_id] = PromptUsage()
+    cached = guild_usage.record(usage)
+    AI_TOKENS.inc('prompt', amount=usage.prompt_tokens or 0)
+    AI_TOKENS.inc('cached', amount=cached)
+    AI_TOKENS.inc('completion', amount=usage.completion_tokens or 0)
+
+def choose_model(messages, guild_id):
+    """Pick the model for a reply from the guild's routing mode and the request's size"""
+    prompt_tokens = estimate_prompt_tokens(messages, get_compiled_prompt(guild_id).tokens)
+    return model_router.choose(prompt_tokens, get_guild_setting(guild_id, 'model_routing', 'auto'))
+
+async def create_completion(model, kind, **kwargs):
+    """Send one completion request through the provider, recording the model's latency"""
+    AI_MODEL_REQUESTS.inc(model, kind)
+    started = time.perf_counter()
+    try:
+        result = await ai_provider.create(model=model, **kwargs)
+    except Exception:
+        model_router.record(model, time.perf_counter() - started, failed=True)
+        raise
+    model_router.record(model, time.perf_counter() - started)
+    return result
+
+def format_age(seconds):
+    """Format how long ago something happened, e.g. '3d ago'"""
+    if seconds >= 86400:
+        return f"{seconds // 86400:.0f}d ago"
+    if seconds >= 3600:
+        return f"{seconds // 3600:.0f}h ago"
+    return f"{seconds // 60:.0f}m ago"
+
+def build_ai_messages(message_content, user_name, guild_id, channel_id=None, earlier_mentions=None, recalled=None):
+    """Build the chat messages list sent to the AI for a user message.
+    
+    earlier_mentions is an optional list of (user_name, content) for other
+    mentions being answered by the same reply. recalled is an optional list
+    of (channel_id, author_name, content, timestamp) from long-term memory.
+    """
+    # The precompiled system prompt always comes first, so every request for
+    # this guild starts with an identical, cacheable prefix
+    messages = [get_compiled_prompt(guild_id).message]
+    
+    # Add the rolling summary of older history, if any
+    if channel_id and rolling_summarizer:
+        summary = rolling_summarizer.get(channel_id)
+        if summary:
+            messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation in this channel:\n{summary}"
+            })
+    
+    # Add relevant older messages recalled from long-term memory
+    if recalled:
+        now = time.time()
+        lines = [
+            f"[{format_age(now - timestamp)}] {author_name}: {content[:LONG_TERM_MEMORY_MAX_CHARS]}"
+            for _, author_name, content, timestamp in recalled
+        ]
+        messages.append({
+            "role": "system",
+            "content": "Older messages from this server that may be relevant:\n" + "\n".join(lines)
+        })
+    
+    # Add conversation context from memory
+    if channel_id:
+        context = get_conversation_context(channel_id)
+        messages.extend(context)
+    
+    # Add other mentions answered by this reply
+    if earlier_mentions:
+        messages.append({
+            "role": "system",
+            "content": "Several people mentioned you at nearly the same time. Reply once, addressing each of them by name."
+        })
+        for earlier_name, earlier_content in earlier_mentions:
+            messages.append({"role": "user", "content": f"{earlier_name}: {earlier_content}"})
+    
+    # Add the current user message
+    messages.append({
+        "role": "user", 
+        "content": f"{user_name}: {message_content}"
+    })
+    
+    return messages
+
+# Recently generated completions, reused for identical requests
+response_cache = ResponseCache(max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL_SECONDS) if RESPONSE_CACHE_SIZE > 0 else None
+
+def response_cache_key(messages, guild_id, model):
+    """Return the cache key for a request, or None if caching is off for this guild"""
+    if not response_cache or not get_guild_setting(guild_id, 'response_cache', True):
+        return None
+    # Hash the prompt's digest rather than re-hashing its full text every time
+    return ResponseCache.make_key(
+        messages[1:],
+        prompt=get_compiled_prompt(guild_id).digest,
+        model=model,
+        max_tokens=AI_MAX_TOKENS,
+        temperature=AI_TEMPERATURE
+    )
+
+async def generate_ai_response(message_content, user_name, guild_id, channel_id=None, earlier_mentions=None):
     """Generate AI response using OpenRouter with conversation context"""
-    if not client:
+    if not ai_provider:
         return "❌ AI service is not configured. Please set up the OPENROUTER_API_KEY."
     
     try:
-        # Prepare messages for the conversation
-        messages = [
-            {"role": "system", "content": get_system_prompt(guild_id)}
-        ]
-        
-        # Add conversation context from memory
-        if channel_id:
-            context = get_conversation_context(channel_id)
-            messages.extend(context)
+        recalled = await recall_long_term_memories(guild_id, channel_id, message_content)
+        messages = build_ai_messages(message_content, user_name, guild_id, channel_id, earlier_mentions, recalled)
         
-        # Add the current user message
-        messages.append({
-            "role": "user", 
-            "content": f"{user_name}: {message_content}"
-        })
+        # Reuse a recent completion for an identical request
+        model = choose_model(messages, guild_id)
+        cache_key = response_cache_key(messages, guild_id, model)
+        if cache_key:
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return cached
         
         # Generate response
-        completion = await asyncio.to_thread(
-            client.chat.completions.create,
-            extra_headers={
-                "HTTP-Referer": SITE_URL,
-                "X-Title": SITE_NAME,
-            },
-            model="openai/gpt-4o-mini",  # Using mini for cost efficiency
-            messages=messages,
-            max_tokens=300,
-            temperature=0.8
-        )
+        queued_at = time.perf_counter()
+        async with ai_guard.admit(guild_id), ai_semaphore:
+            REPLY_SECONDS.observe(time.perf_counter() - queued_at, 'queue')
+            AI_REQUESTS.inc('reply')
+            with REPLY_SECONDS.time('api'):
+                completion = await ai_guard.call(lambda: create_completion(
+                    model,
+                    'reply',
+                    messages=messages,
+                    max_tokens=AI_MAX_TOKENS,
+                    temperature=AI_TEMPERATURE
+                ))
         
-        return completion.choices[0].message.content.strip()
+        record_usage(guild_id, completion.usage, model)
+        response = completion.choices[0].message.content.strip()
+        if cache_key:
+            response_cache.put(cache_key, response)
+        return response
     
+    except Overloaded as e:
+        AI_SHED.inc(e.reason)
+        return OVERLOADED_REPLY
+    except APITimeoutError:
+        AI_ERRORS.inc('timeout')
+        print(f"AI response timed out after {AI_REQUEST_TIMEOUT}s")
+        return "❌ Sorry, I took too long to think of a reply. Please try again!"
     except Exception as e:
+        AI_ERRORS.inc(type(e).__name__)
         print(f"AI response error: {e}")
         return f"❌ Sorry, I'm having trouble thinking right now. Error: {str(e)[:100]}"
 
-@bot.event
-async def on_message(message):
-    # Don't respond to own messages, but still store them in memory
-    if message.author == bot.user:
+async def summarize_evicted_history(previous_summary, memories):
+    """Fold messages that dropped out of channel memory into the channel's summary"""
+    if not ai_provider:
+        return previous_summary
+    
+    transcript = "\n".join(
+        f"Assistant: {memory.content}" if memory.is_bot else memory.context_content()
+        for memory in memories
+    )
+    # Summaries are short and not user-facing, so they always use the small tier
+    model = model_router.choose(0, 'small')
+    # No guild limit: summaries are background work, and a shed batch is retried later
+    async with ai_guard.admit(), ai_semaphore:
+        AI_REQUESTS.inc('summary')
+        completion = await ai_guard.call(lambda: create_completion(
+            model,
+            'summary',
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You maintain a short running summary of a Discord conversation. "
+                               "Keep names, topics, decisions and anything people asked to be remembered. "
+                               "Reply with only the updated summary."
+                },
+                {
+                    "role": "user",
+                    "content": f"Current summary:\n{previous_summary or '(none yet)'}\n\nNew messages:\n{transcript}"
+                }
+            ],
+            max_tokens=SUMMARY_MAX_TOKENS,
+            temperature=0.3
+        ))
+    if completion.usage is not None:
+        model_router.record_usage(model, completion.usage)
+    return completion.choices[0].message.content.strip()
+
+# Summarizes evicted history in the background when enabled
+if ROLLING_SUMMARY_ENABLED:
+    rolling_summarizer = RollingSummarizer(
+        persistence_writer,
+        summarize_evicted_history,
+        state_store,
+        batch_size=SUMMARY_BATCH_SIZE,
+        delay=SUMMARY_DELAY_SECONDS
+    )
+    memory_backend.on_evict = rolling_summarizer.add_evicted
+else:
+    rolling_summarizer = None
+
+# Indexes older messages per guild and recalls the ones relevant to a mention when enabled
+if LONG_TERM_MEMORY_ENABLED:
+    from long_term_memory import LongTermMemory, make_embedder
+    long_term_memory = LongTermMemory(
+        persistence_writer,
+        make_embedder(LONG_TERM_MEMORY_MODEL, LONG_TERM_MEMORY_DIM),
+        LONG_TERM_MEMORY_DIR,
+        capacity=LONG_TERM_MEMORY_SIZE,
+        max_guilds=LONG_TERM_MEMORY_GUILDS,
+        top_k=LONG_TERM_MEMORY_TOP_K,
+        min_score=LONG_TERM_MEMORY_MIN_SCORE,
+        budget=LONG_TERM_MEMORY_BUDGET_MS / 1000
+    )
+else:
+    long_term_memory = None
+
+def index_long_term_memories(guild_id, channel_id, memories):
+    """Queue newly committed messages for the guild's long-term memory"""
+    if not long_term_memory:
+        return
+    for memory in memories:
+        if len(memory.content) >= LONG_TERM_MEMORY_MIN_CHARS:
+            long_term_memory.add(guild_id, channel_id, memory.author_name, memory.content, memory.timestamp)
+
+# Appends every remembered message to a dump for `manage.py replay` when enabled
+message_recorder = MessageRecorder(persistence_writer, RECORD_MESSAGES_FILE) if RECORD_MESSAGES_FILE else None
+
+def observed_messages_committed(guild_id, channel_id, memories):
+    """Pass messages the ingestor committed on to long-term memory and the recording"""
+    index_long_term_memories(guild_id, channel_id, memories)
+    if message_recorder:
+        message_recorder.record(channel_id, guild_id, memories)
+
+# Buffers messages the bot only observes and commits them to memory per channel in bulk
+message_ingestor = MessageIngestor(
+    memory_backend,
+    flush_interval=INGEST_FLUSH_SECONDS,
+    max_buffered=INGEST_MAX_BUFFERED,
+    on_commit=observed_messages_committed
+)
+
+async def recall_long_term_memories(guild_id, channel_id, query):
+    """Find older messages in the guild relevant to a mention, within the latency budget"""
+    if not long_term_memory or not channel_id:
+        return None
+    # Skip what the channel's recent context already includes
+    message_ingestor.flush(channel_id)
+    recent = memory_backend.recent(channel_id, MAX_CONTEXT_MESSAGES)
+    since = recent[0].timestamp if recent else None
+    try:
+        with LONG_TERM_RECALL_SECONDS.time():
+            results = await long_term_memory.search(guild_id, channel_id, query, since)
+    except asyncio.TimeoutError:
+        LONG_TERM_RECALLS.inc('timeout')
+        return None
+    except Exception as e:
+        LONG_TERM_RECALLS.inc('error')
+        print(f"Long-term memory search error: {e}")
+        return None
+    LONG_TERM_RECALLS.inc('hit' if results else 'miss')
+    return [entry for _, entry in results]
+
+async def stream_ai_response(message_content, user_name, guild_id, channel_id=None, earlier_mentions=None):
+    """Stream an AI response from OpenRouter, yielding text as tokens arrive"""
+    if not ai_provider:
+        yield "❌ AI service is not configured. Please set up the OPENROUTER_API_KEY."
         return
     
-    # Store user message in memory (for all messages, not just mentions)
-    if message.guild and not message.author.bot:
-        add_message_to_memory(
-            message.channel.id,
-            message.author.display_name,
-            message.author.id,
-            message.content,
-            is_bot=False
-        )
+    received_text = False
+    try:
+        recalled = await recall_long_term_memories(guild_id, channel_id, message_content)
+        messages = build_ai_messages(message_content, user_name, guild_id, channel_id, earlier_mentions, recalled)
+        
+        # Reuse a recent completion for an identical request
+        model = choose_model(messages, guild_id)
+        cache_key = response_cache_key(messages, guild_id, model)
+        if cache_key:
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+        
+        streamed = []
+        queued_at = time.perf_counter()
+        async with ai_guard.admit(guild_id), ai_semaphore:
+            REPLY_SECONDS.observe(time.perf_counter() - queued_at, 'queue')
+            AI_REQUESTS.inc('stream')
+            api_started = time.perf_counter()
+            # Only opening the stream is retried; text already sent to Discord cannot be taken back
+            stream = await ai_guard.call(lambda: create_completion(
+                model,
+                'stream',
+                messages=messages,
+                max_tokens=AI_MAX_TOKENS,
+                temperature=AI_TEMPERATURE,
+                stream=True,
+                stream_options={"include_usage": True}
+            ))
+            async for chunk in stream:
+                if chunk.usage:
+                    # Sent in the final chunk
+                    record_usage(guild_id, chunk.usage, model)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    received_text = True
+                    streamed.append(delta)
+                    yield delta
+            REPLY_SECONDS.observe(time.perf_counter() - api_started, 'api')
+        
+        if cache_key and streamed:
+            response_cache.put(cache_key, ''.join(streamed).strip())
     
-    # Check if bot is mentioned/pinged
-    if bot.user in message.mentions:
-        # Show typing indicator
-        async with message.channel.typing():
-            # Remove the bot mention from the message content
-            content = message.content
-            for mention in message.mentions:
-                if mention == bot.user:
-                    content = content.replace(f'<@{mention.id}>', '').replace(f'<@!{mention.id}>', '').strip()
-            
-            if not content:
-                content = "Hi there!"
+    except Overloaded as e:
+        AI_SHED.inc(e.reason)
+        if not received_text:
+            yield OVERLOADED_REPLY
+    except APITimeoutError:
+        AI_ERRORS.inc('timeout')
+        print(f"AI response stream timed out after {AI_REQUEST_TIMEOUT}s")
+        if not received_text:
+            yield "❌ Sorry, I took too long to think of a reply. Please try again!"
+    except Exception as e:
+        AI_ERRORS.inc(type(e).__name__)
+        print(f"AI response stream error: {e}")
+        # Keep whatever was already streamed rather than appending an error to it
+        if not received_text:
+            yield f"❌ Sorry, I'm having trouble thinking right now. Error: {str(e)[:100]}"
+
+async def reply_with_stream(message, deltas):
+    """Reply to a message with streamed text, editing in place as it arrives.
+    
+    The first reply is posted once the first tokens arrive, then edited at most
+    once per STREAM_EDIT_INTERVAL seconds. Text past 2000 characters rolls over
+    into additional replies, split like queued replies. Returns the final full
+    response text.
+    """
+    text = ""
+    replies = []  # (discord.Message, content currently shown)
+    last_edit = 0.0
+    send_seconds = 0.0
+    
+    async def sync_replies():
+        nonlocal send_seconds
+        started = time.perf_counter()
+        chunks = split_message(text, DISCORD_MESSAGE_LIMIT)
+        for index, chunk in enumerate(chunks):
+            if not chunk.strip():
+                continue
+            if index < len(replies):
+                sent, shown = replies[index]
+                if shown != chunk:
+                    await sent.edit(content=chunk)
+                    replies[index] = (sent, chunk)
+            else:
+                sent = await message.reply(chunk)
+                replies.append((sent, chunk))
+        send_seconds += time.perf_counter() - started
+    
+    loop = asyncio.get_running_loop()
+    async for delta in deltas:
+        text += delta
+        if not text.strip():
+            continue
+        # Post the first message right away, then batch edits to respect rate limits
+        if not replies or loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+            await sync_replies()
+            last_edit = loop.time()
+    
+    text = text.strip()
+    if text:
+        await sync_replies()
+    REPLY_SECONDS.observe(send_seconds, 'send')
+    return text
+
+def strip_bot_mention(message):
+    """Remove the bot mention from a message's content"""
+    content = message.content
+    for mention in message.mentions:
+        if mention == bot.user:
+            content = content.replace(f'<@{mention.id}>', '').replace(f'<@!{mention.id}>', '').strip()
+    
+    if not content:
+        content = "Hi there!"
+    return content
+
+async def respond_to_mentions(channel_id, mentions):
+    """Answer one or more (message, content) mentions in a channel with a single reply"""
+    message, content = mentions[-1]
+    earlier_mentions = [(earlier.author.display_name, earlier_content) for earlier, earlier_content in mentions[:-1]]
+    
+    # Show typing indicator
+    async with message.channel.typing():
+        if STREAM_RESPONSES:
+            # Stream the reply, editing it as tokens arrive
+            response = await reply_with_stream(
+                message,
+                stream_ai_response(
+                    content,
+                    message.author.display_name,
+                    message.guild.id if message.guild else 0,
+                    channel_id,
+                    earlier_mentions
+                )
+            )
             
+            # Store only the final bot response in memory
+            if response:
+                add_message_to_memory(
+                    channel_id,
+                    bot.user.display_name,
+                    bot.user.id,
+                    response,
+                    is_bot=True
+                )
+        else:
             # Generate AI response with conversation context
             response = await generate_ai_response(
                 content, 
                 message.author.display_name, 
                 message.guild.id if message.guild else 0,
-                message.channel.id
+                channel_id,
+                earlier_mentions
             )
             
-            # Store bot response in memory
-            add_message_to_memory(
+            # Send through the channel's reply queue, which splits long responses
+            delivered = await reply_sender.send(channel_id, message, response, message.created_at.timestamp())
+            
+            # Store bot response in memory, unless it was dropped
+            if delivered:
+                add_message_to_memory(
+                    channel_id,
+                    bot.user.display_name,
+                    bot.user.id,
+                    response,
+                    is_bot=True
+                )
+
+def record_reply_delivery(wait_seconds, send_seconds):
+    """Record how long a reply waited in its channel's queue and took to send"""
+    REPLY_SECONDS.observe(wait_seconds, 'outbound')
+    REPLY_SECONDS.observe(send_seconds, 'send')
+
+# Sends replies through a paced queue per channel, freshest first
+reply_sender = ReplySender(
+    limit=DISCORD_MESSAGE_LIMIT,
+    max_age=REPLY_MAX_AGE_SECONDS,
+    max_queued=REPLY_MAX_QUEUED,
+    channel_rate=REPLY_CHANNEL_RATE,
+    channel_burst=REPLY_CHANNEL_BURST,
+    on_delivered=record_reply_delivery,
+    on_dropped=REPLIES_DROPPED.inc
+)
+
+# Merges mentions that arrive close together in a channel when enabled
+if COALESCE_MENTIONS:
+    mention_coalescer = MentionCoalescer(
+        respond_to_mentions,
+        window=COALESCE_WINDOW_SECONDS,
+        max_batch=COALESCE_MAX_BATCH,
+        max_pending=COALESCE_MAX_PENDING,
+        max_concurrent=COALESCE_MAX_CONCURRENT,
+        max_per_guild=COALESCE_MAX_PER_GUILD
+    )
+else:
+    mention_coalescer = None
+
+def memory_store_stats():
+    """Summarize remembered channels and messages for the metrics endpoint"""
+    sizes = memory_backend.channel_sizes()
+    return {
+        ('channels',): len(sizes),
+        ('messages',): sum(sizes),
+        ('max_per_channel',): max(sizes, default=0),
+        ('mean_per_channel',): sum(sizes) / len(sizes) if sizes else 0,
+    }
+
+def response_cache_stats():
+    """Summarize response cache activity for the metrics endpoint"""
+    if not response_cache:
+        return {}
+    return {
+        ('entries',): len(response_cache.entries),
+        ('hits',): response_cache.hits,
+        ('misses',): response_cache.misses,
+    }
+
+# Values computed only when metrics are scraped
+REGISTRY.gauge('bot_memory_store', 'Remembered channels and messages', labels=('stat',), fn=memory_store_stats)
+REGISTRY.gauge('bot_response_cache', 'Response cache entries, hits and misses', labels=('stat',), fn=response_cache_stats)
+REGISTRY.gauge('bot_gateway_latency_seconds', 'Discord gateway heartbeat latency', fn=lambda: bot.latency)
+REGISTRY.gauge('bot_mention_queue_depth', 'Mentions waiting to be answered', fn=lambda: mention_coalescer.queue_depth() if mention_coalescer else 0)
+REGISTRY.gauge('bot_reply_queue_depth', 'Reply messages waiting to be sent to Discord', fn=lambda: reply_sender.queue_depth())
+
+@bot.event
+async def on_message(message):
+    # Don't respond to own messages, but still store them in memory
+    if message.author == bot.user:
+        return
+    
+    # Buffer user messages for memory (for all messages, not just mentions)
+    if message.guild and not message.author.bot:
+        content = clean_content(message.content, bot.command_prefix, INGEST_MAX_CHARS)
+        if content is None:
+            # Empty, attachment-only or a command (which stores its own messages)
+            INGEST_SKIPPED.inc()
+        else:
+            message_ingestor.submit(
                 message.channel.id,
-                bot.user.display_name,
-                bot.user.id,
-                response,
-                is_bot=True
+                message.guild.id,
+                message.author.display_name,
+                message.author.id,
+                content,
+                time.time()
             )
-            
-            # Split long responses if needed
-            if len(response) > 2000:
-                chunks = [response[i:i+2000] for i in range(0, len(response), 2000)]
-                for chunk in chunks:
-                    await message.reply(chunk)
-            else:
-                await message.reply(response)
+    
+    # Check if bot is mentioned/pinged
+    if bot.user in message.mentions:
+        content = strip_bot_mention(message)
+        if mention_coalescer:
+            accepted = await mention_coalescer.submit(
+                message.channel.id,
+                message.guild.id if message.guild else 0,
+                (message, content)
+            )
+            if not accepted:
+                # Too many mentions already queued in this channel
+                await message.add_reaction('⏳')
+        else:
+            await respond_to_mentions(message.channel.id, [(message, content)])
     
     # Process commands
     await bot.process_commands(message)
@@ -325,8 +1066,7 @@ async def set_personality(interaction: discord.Interaction, personality: str):
         return
     
     # Save the personality
-    guild_system_prompts[str(interaction.guild.id)] = personality
-    save_system_prompts()
+    set_system_prompt(interaction.guild.id, personality)
     
     await interaction.response.send_message(
         f"✅ AI personality updated!\n\n**New Personality:**\n{personality[:500]}{'...' if len(personality) > 500 else ''}",
@@ -372,8 +1112,7 @@ async def reset_personality(interaction: discord.Interaction):
     
     # Reset to default
     if str(interaction.guild.id) in guild_system_prompts:
-        del guild_system_prompts[str(interaction.guild.id)]
-        save_system_prompts()
+        set_system_prompt(interaction.guild.id, None)
     
     await interaction.response.send_message(
         "✅ AI personality reset to default!",
@@ -393,9 +1132,12 @@ async def clear_memory(interaction: discord.Interaction):
         return
     
     channel_id = interaction.channel.id
-    if channel_id in channel_memories:
-        del channel_memories[channel_id]
-        save_memories()
+    if rolling_summarizer:
+        rolling_summarizer.clear(channel_id)
+    if long_term_memory:
+        await long_term_memory.forget(interaction.guild.id, channel_id)
+    message_ingestor.discard(channel_id)
+    if memory_backend.clear(channel_id):
         await interaction.response.send_message(
             "✅ Conversation memory cleared for this channel!",
             ephemeral=True
@@ -417,8 +1159,9 @@ async def memory_stats(interaction: discord.Interaction):
         color=0x00aaff
     )
     
-    if channel_id in channel_memories:
-        memories = channel_memories[channel_id]
+    message_ingestor.flush(channel_id)
+    memories = memory_backend.messages(channel_id)
+    if memories:
         total_messages = len(memories)
         
         # Count messages by user
@@ -465,7 +1208,7 @@ async def memory_stats(interaction: discord.Interaction):
             
             embed.add_field(
                 name="Memory Range",
-                value=f"**Oldest:** <t:{int(oldest.timestamp.timestamp())}:R>\n**Newest:** <t:{int(newest.timestamp.timestamp())}:R>",
+                value=f"**Oldest:** <t:{int(oldest.timestamp)}:R>\n**Newest:** <t:{int(newest.timestamp)}:R>",
                 inline=False
             )
     
@@ -480,6 +1223,177 @@ async def memory_stats(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+@bot.tree.command(name='response_cache', description='Turn reuse of cached AI replies on or off for this server (Admin only)')
+async def response_cache_command(interaction: discord.Interaction, enabled: bool):
+    """Opt this server in or out of the response cache"""
+    
+    # Check if user has manage server permissions
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message(
+            "❌ You need 'Manage Server' permission to use this command!",
+            ephemeral=True
+        )
+        return
+    
+    set_guild_setting(interaction.guild.id, 'response_cache', enabled)
+    
+    stats = ""
+    if response_cache:
+        stats = f"\n\nCache: {response_cache.hits} hits, {response_cache.misses} misses ({response_cache.hit_rate():.0%} hit rate)"
+    await interaction.response.send_message(
+        f"✅ Cached AI replies {'enabled' if enabled else 'disabled'} for this server!{stats}",
+        ephemeral=True
+    )
+
+@bot.tree.command(name='model_routing', description='Choose which AI model answers in this server (Admin only)')
+async def model_routing_command(interaction: discord.Interaction, mode: Literal['auto', 'small', 'large']):
+    """Pick the model tier for this server, or let the bot choose per reply"""
+    
+    # Check if user has manage server permissions
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message(
+            "❌ You need 'Manage Server' permission to use this command!",
+            ephemeral=True
+        )
+        return
+    
+    set_guild_setting(interaction.guild.id, 'model_routing', mode)
+    
+    descriptions = {
+        'auto': f"short prompts use `{model_router.small_model}`, long conversations use `{model_router.large_model}`",
+        'small': f"replies use `{model_router.small_model}`",
+        'large': f"replies use `{model_router.large_model}`",
+    }
+    await interaction.response.send_message(
+        f"✅ Model routing set to **{mode}**: {descriptions[mode]}.\n\nWhen the AI service is busy or slow, replies may switch to the fastest model.",
+        ephemeral=True
+    )
+
+def format_model_stats():
+    """Format per-model requests, latency and cost for /bot_stats"""
+    lines = []
+    for model, stats in model_router.stats.items():
+        latency = f"{stats.latency * 1000:.0f}ms" if stats.latency is not None else "no data"
+        lines.append(f"**{model}:** {stats.requests} requests, {latency} recent latency, ${stats.cost:.4f}")
+    if model_router.fallbacks:
+        lines.append(f"{model_router.fallbacks} replies switched to the fastest model")
+    return "\n".join(lines)
+
+def format_latency(stage):
+    """Format p50/p95 of a reply stage for /bot_stats"""
+    if not REPLY_SECONDS.count(stage):
+        return "no data"
+    p50 = REPLY_SECONDS.quantile(0.5, stage)
+    p95 = REPLY_SECONDS.quantile(0.95, stage)
+    return f"p50 ≤ {p50 * 1000:.0f}ms, p95 ≤ {p95 * 1000:.0f}ms"
+
+@bot.tree.command(name='bot_stats', description='View bot performance statistics')
+async def bot_stats(interaction: discord.Interaction):
+    """Summarize latency, error, cache and memory metrics"""
+    
+    embed = discord.Embed(
+        title="📊 Bot Statistics",
+        color=0x00aaff
+    )
+    
+    embed.add_field(
+        name="Reply Latency",
+        value=(
+            f"**Queue:** {format_latency('queue')}\n**API:** {format_latency('api')}\n"
+            f"**Send queue:** {format_latency('outbound')}, {reply_sender.queue_depth()} waiting, {reply_sender.dropped} dropped\n"
+            f"**Discord send:** {format_latency('send')}"
+        ),
+        inline=False
+    )
+    
+    requests = AI_REQUESTS.total()
+    errors = AI_ERRORS.total()
+    embed.add_field(
+        name="AI Requests",
+        value=f"{requests} sent, {errors} failed ({errors / requests if requests else 0:.1%} error rate)",
+        inline=True
+    )
+    
+    if response_cache:
+        embed.add_field(
+            name="Response Cache",
+            value=f"{response_cache.hits} hits, {response_cache.misses} misses ({response_cache.hit_rate():.0%} hit rate)",
+            inline=True
+        )
+    
+    embed.add_field(
+        name="Upstream Protection",
+        value=f"{AI_RETRIES.total()} retries, {AI_SHED.total()} turned away, circuit {ai_guard.breaker.state.replace('_', '-')}",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="Models",
+        value=format_model_stats(),
+        inline=False
+    )
+    
+    stats = memory_store_stats()
+    embed.add_field(
+        name="Memory",
+        value=f"{stats[('channels',)]} channels, {stats[('messages',)]} messages, {resident_memory_bytes() / 2**20:.0f} MiB resident",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="Gateway Latency",
+        value=f"{round(bot.latency * 1000)}ms",
+        inline=True
+    )
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name='prompt_usage', description='View prompt token usage for this server (Admin only)')
+async def prompt_usage_command(interaction: discord.Interaction):
+    """Show the personality's token cost and token usage reported by the provider"""
+    
+    # Check if user has manage server permissions
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message(
+            "❌ You need 'Manage Server' permission to use this command!",
+            ephemeral=True
+        )
+        return
+    
+    compiled = get_compiled_prompt(interaction.guild.id)
+    usage = prompt_usage.get(interaction.guild.id) or PromptUsage()
+    
+    embed = discord.Embed(
+        title="🧮 Prompt Token Usage",
+        color=0x00aaff
+    )
+    
+    embed.add_field(
+        name="Personality",
+        value=f"{compiled.tokens} tokens sent with every reply ({'custom' if compiled is not default_compiled_prompt else 'default'})",
+        inline=False
+    )
+    
+    if usage.requests:
+        embed.add_field(
+            name="Replies Since Startup",
+            value=f"{usage.requests} replies, {usage.prompt_tokens // usage.requests} prompt tokens and {usage.completion_tokens // usage.requests} completion tokens on average",
+            inline=False
+        )
+        embed.add_field(
+            name="Provider Prompt Cache",
+            value=f"{usage.cached_tokens} of {usage.prompt_tokens} prompt tokens cached ({usage.cached_rate():.0%})",
+            inline=False
+        )
+    else:
+        embed.add_field(
+            name="Replies Since Startup",
+            value="No replies yet",
+            inline=False
+        )
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @bot.tree.command(name='ping_ai', description='Test the AI response')
 async def ping_ai(interaction: discord.Interaction, message: str = "Hello!"):
     """Test command to ping the AI"""
@@ -512,7 +1426,7 @@ async def chat_command(ctx, *, message):
             ctx.channel.id
         )
         
-        # Store both user message and bot response in memory
+        # Store the user message, then the bot response once it has been sent
         add_message_to_memory(
             ctx.channel.id,
             ctx.author.display_name,
@@ -521,20 +1435,29 @@ async def chat_command(ctx, *, message):
             is_bot=False
         )
         
-        add_message_to_memory(
-            ctx.channel.id,
-            bot.user.display_name,
-            bot.user.id,
-            response,
-            is_bot=True
-        )
-        
-        await ctx.reply(response)
+        delivered = await reply_sender.send(ctx.channel.id, ctx.message, response, ctx.message.created_at.timestamp())
+        if delivered:
+            add_message_to_memory(
+                ctx.channel.id,
+                bot.user.display_name,
+                bot.user.id,
+                response,
+                is_bot=True
+            )
+
+# Time of the first ready event (None until the bot has connected)
+ready_at = None
 
-# Periodic cleanup task
 @bot.event
 async def on_ready():
-    # Previous on_ready code...
+    global ready_at
+    if ready_at is not None:
+        # Discord fires on_ready again after a reconnect that starts a new session
+        print(f'{bot.user} reconnected to Discord ({len(bot.guilds)} guild(s))')
+        return
+    ready_at = time.monotonic()
+    STARTUP_SECONDS.set(ready_at - STARTED_AT)
+    
     print(f'{bot.user} has connected to Discord!')
     print(f'Bot ID: {bot.user.id}')
     print(f'Connected to {len(bot.guilds)} guild(s)')
@@ -542,8 +1465,16 @@ async def on_ready():
     for guild in bot.guilds:
         print(f'- {guild.name} (ID: {guild.id})')
     
-    load_system_prompts()
-    load_memories()
+    shard_ids = getattr(bot, 'shard_ids', None)
+    if shard_ids is not None:
+        print(f'Running shards {list(shard_ids)} of {bot.shard_count}')
+    
+    print(f'Ready {ready_at - STARTED_AT:.1f}s after startup, {resident_memory_bytes() / 2**20:.0f} MiB resident')
+    
+    # Commands are global, so only the process running shard 0 syncs them
+    if shard_ids is not None and 0 not in shard_ids:
+        bot.loop.create_task(periodic_cleanup())
+        return
     
     try:
         print("Syncing slash commands...")
@@ -561,9 +1492,12 @@ async def periodic_cleanup():
     """Periodically clean up expired memories and save to disk"""
     while not bot.is_closed():
         try:
+            message_ingestor.flush_all()
             cleanup_expired_memories()
             save_memories()
-            print(f"Memory cleanup completed. Active channels: {len(channel_memories)}")
+            if long_term_memory:
+                long_term_memory.save()
+            print(f"Memory cleanup completed. Active channels: {memory_backend.channel_count()}")
         except Exception as e:
             print(f"Error during periodic cleanup: {e}")
         
@@ -585,4 +1519,22 @@ if __name__ == '__main__':
     if not OPENROUTER_API_KEY:
         print("Warning: OPENROUTER_API_KEY not set. AI features will be limited.")
     
-    bot.run(TOKEN)
\ No newline at end of file
+    if SHARD_IDS and (not SHARD_COUNT or SHARD_COUNT == 'auto'):
+        print("Error: SHARD_IDS needs SHARD_COUNT set to the total number of shards!")
+        exit(1)
+    
+    if SHARD_IDS and MEMORY_BACKEND != 'sqlite':
+        # Each process would overwrite the others' snapshot and journal files
+        print("Error: running a shard range needs MEMORY_BACKEND=sqlite so processes share memories!")
+        exit(1)
+    
+    bot.run(TOKEN)
+    
+    # Write anything the background writer had not flushed yet
+    message_ingestor.flush_all()
+    if long_term_memory:
+        long_term_memory.save()
+    persistence_writer.flush()
+    if message_recorder:
+        message_recorder.close()
+    cpu_pool.shutdown()
\ No newline at end of file
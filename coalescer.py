@@ -0,0 +1,121 @@
+import asyncio
+from collections import OrderedDict, deque
+
+
+class MentionBatch:
+    """Mentions in one channel that will be answered by a single reply"""
+    def __init__(self, channel_id, guild_id, done):
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.items = []
+        self.done = done  # Future resolved once the batch has been handled
+
+
+class MentionCoalescer:
+    """Merges rapid-fire mentions per channel into one AI request.
+
+    Mentions arriving within `window` seconds of the first one in a channel are
+    batched and passed together to `handler(channel_id, items)`. Each channel
+    handles one batch at a time and may queue at most `max_pending` mentions.
+    Batches are dispatched round-robin across guilds, with at most
+    `max_concurrent` running overall and `max_per_guild` per guild, so one busy
+    guild cannot starve the others.
+    """
+
+    def __init__(self, handler, window=2.0, max_batch=10, max_pending=20, max_concurrent=16, max_per_guild=4):
+        self.handler = handler
+        self.window = window  # Seconds to collect mentions after the first one
+        self.max_batch = max_batch  # Mentions answered by one reply
+        self.max_pending = max_pending  # Queued mentions per channel before new ones are shed
+        self.max_concurrent = max_concurrent  # Batches handled at once across all guilds
+        self.max_per_guild = max_per_guild  # Batches handled at once per guild
+
+        self.collecting = {}  # {channel_id: MentionBatch still accepting mentions}
+        self.ready = OrderedDict()  # {guild_id: deque of closed batches}, in round-robin order
+        self.queued = {}  # {channel_id: mentions accepted but not yet handled}
+        self.running_channels = set()
+        self.running_per_guild = {}
+        self.running = 0
+
+    def queue_depth(self):
+        """Return how many mentions are waiting or being handled"""
+        return sum(self.queued.values())
+
+    async def submit(self, channel_id, guild_id, item):
+        """Queue a mention and wait until it has been answered.
+
+        Returns False without queueing if the channel already has too much
+        pending work.
+        """
+        if self.queued.get(channel_id, 0) >= self.max_pending:
+            return False
+
+        batch = self.collecting.get(channel_id)
+        if batch is None:
+            loop = asyncio.get_running_loop()
+            batch = MentionBatch(channel_id, guild_id, loop.create_future())
+            self.collecting[channel_id] = batch
+            loop.call_later(self.window, self.close_batch, batch)
+
+        batch.items.append(item)
+        self.queued[channel_id] = self.queued.get(channel_id, 0) + 1
+        if len(batch.items) >= self.max_batch:
+            self.close_batch(batch)
+
+        await asyncio.shield(batch.done)
+        return True
+
+    def close_batch(self, batch):
+        """Stop collecting a batch and queue it for dispatch"""
+        if self.collecting.get(batch.channel_id) is not batch:
+            return
+        del self.collecting[batch.channel_id]
+        self.ready.setdefault(batch.guild_id, deque()).append(batch)
+        self.dispatch()
+
+    def next_batch(self):
+        """Pick the next runnable batch, rotating through guilds"""
+        for guild_id in list(self.ready.keys()):
+            if self.running_per_guild.get(guild_id, 0) >= self.max_per_guild:
+                continue
+            batches = self.ready[guild_id]
+            for batch in batches:
+                if batch.channel_id not in self.running_channels:
+                    batches.remove(batch)
+                    if batches:
+                        self.ready.move_to_end(guild_id)
+                    else:
+                        del self.ready[guild_id]
+                    return batch
+        return None
+
+    def dispatch(self):
+        """Start batches while there is capacity"""
+        while self.running < self.max_concurrent:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            self.running += 1
+            self.running_per_guild[batch.guild_id] = self.running_per_guild.get(batch.guild_id, 0) + 1
+            self.running_channels.add(batch.channel_id)
+            asyncio.get_running_loop().create_task(self.run_batch(batch))
+
+    async def run_batch(self, batch):
+        try:
+            await self.handler(batch.channel_id, batch.items)
+        except Exception as e:
+            print(f"Error handling mentions in channel {batch.channel_id}: {e}")
+        finally:
+            self.running -= 1
+            self.running_per_guild[batch.guild_id] -= 1
+            if not self.running_per_guild[batch.guild_id]:
+                del self.running_per_guild[batch.guild_id]
+            self.running_channels.discard(batch.channel_id)
+
+            self.queued[batch.channel_id] -= len(batch.items)
+            if not self.queued[batch.channel_id]:
+                del self.queued[batch.channel_id]
+
+            if not batch.done.done():
+                batch.done.set_result(None)
+            self.dispatch()
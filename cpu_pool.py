@@ -0,0 +1,90 @@
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class CpuPool:
+    """Runs CPU-bound work (bulk serialization, snapshot compaction) in worker processes.
+
+    Work done in a thread still holds the GIL and stalls the event loop, so
+    heavy encoding is handed to separate processes instead. Only plain data
+    crosses the boundary: submitted functions must be module-level and take
+    and return picklable builtins (tuples, lists, strings), never bot objects.
+    As with any multiprocessing pool, the main script is imported (not run)
+    by the workers, so it must keep its startup under `if __name__ == '__main__'`.
+    Calls block until the result is ready, so they belong on the background
+    writer thread, never on the event loop. With workers=0 (the default)
+    everything runs inline in the caller.
+    """
+
+    def __init__(self, workers=0):
+        self.workers = workers  # Worker processes (0 runs work inline)
+        self.executor = None
+
+    def get_executor(self):
+        if not self.workers:
+            return None
+        if self.executor is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                # Fork workers from a single-threaded server process rather than
+                # from the bot itself, with its threads and open sockets
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context('spawn')
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=context)
+        return self.executor
+
+    def run(self, fn, *args):
+        """Call fn(*args) in a worker process and return its result"""
+        executor = self.get_executor()
+        if executor is None:
+            return fn(*args)
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool as e:
+            self.restart(e)
+            return fn(*args)
+
+    def imap(self, fn, items):
+        """Yield fn(item) for each item in order, keeping a few items in flight per worker"""
+        executor = self.get_executor()
+        if executor is None:
+            for item in items:
+                yield fn(item)
+            return
+        items = iter(items)
+        pending = deque()  # Items submitted but not yet yielded
+        futures = deque()
+        try:
+            # Bounded window so large inputs are not all copied to the workers at once
+            for item in items:
+                pending.append(item)
+                futures.append(executor.submit(fn, item))
+                if len(futures) >= self.workers * 2:
+                    result = futures[0].result()
+                    futures.popleft()
+                    pending.popleft()
+                    yield result
+            while futures:
+                result = futures[0].result()
+                futures.popleft()
+                pending.popleft()
+                yield result
+        except BrokenProcessPool as e:
+            self.restart(e)
+            for item in pending:
+                yield fn(item)
+            for item in items:
+                yield fn(item)
+
+    def restart(self, error):
+        """Drop a broken pool so the next call starts fresh workers"""
+        print(f"CPU worker pool failed, running inline until restarted: {error}")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,247 @@
+"""Compact streaming dump format for memories, personalities and message streams.
+
+A dump is a short header followed by length-prefixed records, so it can be
+written and read one record at a time however large it gets:
+
+    b'DGDUMP' version:u8 codec:u8   then per record:   length:u32 (big-endian) payload
+
+Payloads are msgpack when the `msgpack` package is installed, otherwise
+compact JSON; the codec byte says which, so either kind of dump can be read
+anywhere the codec is available. The whole stream may be gzip or xz
+compressed, which readers detect from the first bytes.
+
+Records are dicts with a 'type':
+- 'personality': {'guild_id', 'prompt'}
+- 'settings': {'guild_id', 'settings'}
+- 'channel': {'channel_id', 'author_names', 'author_ids', 'contents', 'timestamps', 'is_bot'}
+  - one channel's memory, oldest first, stored column by column
+- 'message': {'channel_id', 'guild_id', 'author_name', 'author_id', 'content', 'timestamp', 'is_bot'}
+  - one message of a recorded stream (see MessageRecorder)
+"""
+import gzip
+import json
+import lzma
+import os
+import struct
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from memory_store import MessageMemory
+
+MAGIC = b'DGDUMP'
+FORMAT_VERSION = 1
+LENGTH = struct.Struct('>I')
+CODECS = {'m': 'msgpack', 'j': 'json'}  # Codec byte -> codec name
+COMPRESSIONS = ('none', 'gzip', 'xz')
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+
+class DumpError(Exception):
+    """Raised for files that are not dumps or are cut short"""
+
+
+def default_codec():
+    return 'msgpack' if msgpack is not None else 'json'
+
+
+def encoder(codec):
+    if codec == 'msgpack':
+        if msgpack is None:
+            raise DumpError("Writing msgpack dumps needs the msgpack package")
+        return lambda record: msgpack.packb(record, use_bin_type=True)
+    return lambda record: json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def decoder(codec):
+    if codec == 'msgpack':
+        if msgpack is None:
+            raise DumpError("This dump is msgpack encoded; install msgpack to read it")
+        return lambda payload: msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    return json.loads
+
+
+class DumpWriter:
+    """Writes records to a dump file ('-' for stdout).
+
+    With `append`, records are added to the end of an existing dump with the
+    codec and compression it already uses (gzip and xz streams may be
+    concatenated).
+    """
+
+    def __init__(self, path, compression='none', codec=None, append=False):
+        existing = append and path != '-' and os.path.exists(path) and os.path.getsize(path) > 0
+        if existing:
+            raw, _, compression, codec = open_dump(path)
+            raw.close()
+        self.codec = codec or default_codec()
+        self.encode = encoder(self.codec)
+        self.raw = sys.stdout.buffer if path == '-' else open(path, 'ab' if append else 'wb')
+        if compression == 'gzip':
+            self.file = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=6)
+        elif compression == 'xz':
+            self.file = lzma.LZMAFile(self.raw, mode='wb', preset=6)
+        else:
+            self.file = self.raw
+        if not existing:
+            codec_byte = next(key for key, name in CODECS.items() if name == self.codec)
+            self.file.write(MAGIC + bytes([FORMAT_VERSION]) + codec_byte.encode('ascii'))
+        self.records = 0
+
+    def write(self, record):
+        payload = self.encode(record)
+        self.file.write(LENGTH.pack(len(payload)))
+        self.file.write(payload)
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+        self.raw.flush()
+
+    def close(self):
+        if self.file is not self.raw:
+            self.file.close()
+        if self.raw is sys.stdout.buffer:
+            self.raw.flush()
+        else:
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def open_dump(path):
+    """Open a dump file ('-' for stdin) and read its header, returning (raw file, decompressed stream, compression, codec)"""
+    name = 'stdin' if path == '-' else path
+    raw = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    try:
+        start = raw.peek(len(XZ_MAGIC))[:len(XZ_MAGIC)]
+        if start.startswith(GZIP_MAGIC):
+            compression, f = 'gzip', gzip.GzipFile(fileobj=raw, mode='rb')
+        elif start.startswith(XZ_MAGIC):
+            compression, f = 'xz', lzma.LZMAFile(raw, mode='rb')
+        else:
+            compression, f = 'none', raw
+
+        header = f.read(len(MAGIC) + 2)
+        if len(header) < len(MAGIC) + 2 or not header.startswith(MAGIC):
+            raise DumpError(f"{name} is not a dump file")
+        version, codec_byte = header[len(MAGIC)], chr(header[len(MAGIC) + 1])
+        if version > FORMAT_VERSION or codec_byte not in CODECS:
+            raise DumpError(f"{name} was written by a newer version (format {version}, codec {codec_byte!r})")
+    except Exception:
+        if raw is not sys.stdin.buffer:
+            raw.close()
+        raise
+    return raw, f, compression, CODECS[codec_byte]
+
+
+def read_dump(path):
+    """Yield the records of a dump file ('-' for stdin), decompressing as needed"""
+    name = 'stdin' if path == '-' else path
+    raw, f, _, codec = open_dump(path)
+    try:
+        decode = decoder(codec)
+        while True:
+            prefix = f.read(LENGTH.size)
+            if not prefix:
+                return
+            if len(prefix) < LENGTH.size:
+                raise DumpError(f"{name} is truncated")
+            length, = LENGTH.unpack(prefix)
+            payload = f.read(length)
+            if len(payload) < length:
+                raise DumpError(f"{name} is truncated")
+            yield decode(payload)
+    finally:
+        if raw is not sys.stdin.buffer:
+            raw.close()
+
+
+def channel_record(channel_id, memories):
+    """Build a 'channel' record from a channel's MessageMemory list"""
+    return {
+        'type': 'channel',
+        'channel_id': channel_id,
+        'author_names': [memory.author_name for memory in memories],
+        'author_ids': [memory.author_id for memory in memories],
+        'contents': [memory.content for memory in memories],
+        'timestamps': [memory.timestamp for memory in memories],
+        'is_bot': [memory.is_bot for memory in memories],
+    }
+
+
+def channel_memories(record):
+    """Turn a 'channel' record back into a list of MessageMemory"""
+    return [
+        MessageMemory(*row)
+        for row in zip(record['author_names'], record['author_ids'], record['contents'], record['timestamps'], record['is_bot'])
+    ]
+
+
+def message_record(channel_id, guild_id, author_name, author_id, content, timestamp, is_bot=False):
+    """Build a 'message' record for a recorded message stream"""
+    return {
+        'type': 'message',
+        'channel_id': channel_id,
+        'guild_id': guild_id,
+        'author_name': author_name,
+        'author_id': author_id,
+        'content': content,
+        'timestamp': timestamp,
+        'is_bot': is_bot,
+    }
+
+
+class MessageRecorder:
+    """Appends every message the bot remembers to a dump as 'message' records.
+
+    The recording is a live message stream for `manage.py replay`. `record`
+    only queues a record; the background writer appends queued records to
+    the dump, which stays open until `close`.
+    """
+
+    def __init__(self, writer, path, codec=None):
+        self.writer = writer  # persistence.BackgroundWriter that appends the records
+        self.path = path
+        self.codec = codec  # Codec for a new dump; an existing one keeps its own
+        self.pending = []  # 'message' records waiting for the writer
+        self.dump = None
+        self.recorded = 0  # Records written since startup
+
+        writer.register('message_recording', self.snapshot, self.write)
+
+    def record(self, channel_id, guild_id, memories):
+        """Queue committed MessageMemory records for the recording"""
+        self.pending.extend(
+            message_record(channel_id, guild_id, memory.author_name, memory.author_id,
+                           memory.content, memory.timestamp, memory.is_bot)
+            for memory in memories
+        )
+        self.writer.mark_dirty('message_recording')
+
+    def snapshot(self):
+        records, self.pending = self.pending, []
+        return records
+
+    def write(self, records):
+        """Append records to the dump (runs on the writer thread)"""
+        if self.dump is None:
+            self.dump = DumpWriter(self.path, codec=self.codec, append=True)
+        for record in records:
+            self.dump.write(record)
+        self.dump.flush()
+        self.recorded += len(records)
+
+    def close(self):
+        if self.dump is not None:
+            self.dump.close()
+            self.dump = None
@@ -0,0 +1,98 @@
+import asyncio
+
+from memory_store import MessageMemory
+
+
+def clean_content(content, command_prefix='!', max_chars=1000):
+    """Return message text worth remembering, or None to skip the message.
+
+    Empty messages (including attachment- and sticker-only ones) and bot
+    commands are skipped; very long messages are cut to `max_chars`.
+    """
+    content = content.strip()
+    if not content or content.startswith(command_prefix):
+        return None
+    if len(content) > max_chars:
+        content = content[:max_chars] + '…'
+    return content
+
+
+class MessageIngestor:
+    """Buffers passively observed messages per channel and commits them to memory in bulk.
+
+    `submit` only appends a tuple to the channel's buffer; buffers are turned
+    into MessageMemory records and committed with one `add_many` call per
+    channel every `flush_interval` seconds, or sooner once `max_buffered`
+    messages are waiting. Anything that reads a channel's memory must call
+    `flush(channel_id)` first. `on_commit(guild_id, channel_id, memories)` is
+    called after each channel is committed.
+    """
+
+    def __init__(self, backend, flush_interval=1.0, max_buffered=2000, on_commit=None):
+        self.backend = backend  # memory_store.MemoryBackend the messages are committed to
+        self.flush_interval = flush_interval  # Longest a message waits in a buffer (0 commits right away)
+        self.max_buffered = max_buffered  # Buffered messages across all channels that trigger a flush
+        self.on_commit = on_commit
+        self.buffers = {}  # {channel_id: (guild_id, [(author_name, author_id, content, timestamp, is_bot)])}
+        self.buffered = 0
+        self.committed = 0  # Messages committed since startup
+        self.batches = 0  # add_many calls since startup
+        self._full = None
+        self._task = None
+
+    def start(self):
+        """Start the background flush task on the running event loop"""
+        if self._task is not None or not self.flush_interval:
+            return
+        self._full = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, channel_id, guild_id, author_name, author_id, content, timestamp, is_bot=False):
+        """Queue a message for the channel's memory"""
+        entry = self.buffers.get(channel_id)
+        if entry is None:
+            entry = self.buffers[channel_id] = (guild_id, [])
+        entry[1].append((author_name, author_id, content, timestamp, is_bot))
+        self.buffered += 1
+        if self._task is None:
+            # Not running on an event loop (or buffering is off): commit right away
+            self.flush(channel_id)
+        elif self.buffered >= self.max_buffered:
+            self._full.set()
+
+    def flush(self, channel_id):
+        """Commit a channel's buffered messages"""
+        entry = self.buffers.pop(channel_id, None)
+        if entry is None:
+            return
+        guild_id, rows = entry
+        self.buffered -= len(rows)
+        memories = [MessageMemory(*row) for row in rows]
+        self.backend.add_many(channel_id, memories)
+        self.committed += len(memories)
+        self.batches += 1
+        if self.on_commit is not None:
+            self.on_commit(guild_id, channel_id, memories)
+
+    def flush_all(self):
+        """Commit every buffered message"""
+        for channel_id in list(self.buffers):
+            self.flush(channel_id)
+
+    def discard(self, channel_id):
+        """Drop a channel's buffered messages without committing them"""
+        entry = self.buffers.pop(channel_id, None)
+        if entry is not None:
+            self.buffered -= len(entry[1])
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                self.flush_all()
+            except Exception as e:
+                print(f"Error committing buffered messages: {e}")
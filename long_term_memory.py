@@ -0,0 +1,356 @@
+import asyncio
+import json
+import os
+import re
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from persistence import atomic_write
+
+WORD_PATTERN = re.compile(r"\w{3,}")  # Words of three or more letters; shorter ones carry little meaning
+STOP_WORDS = frozenset(
+    'the and for are but not you your yours all any can had has have her his him how its our out she they them '
+    'their this that these those was were what when where which who whom why will with would could should about '
+    'from into just like than then there here been being also very some such only own same too does did doing '
+    'because while again further once more most other each few both nor off over under until above below'.split()
+)
+PAIR_WEIGHT = 0.5  # Weight of adjacent word pairs relative to single words
+
+
+class HashingEmbedder:
+    """Hashed bag-of-words embeddings: no model, microseconds per message.
+
+    Words (minus common stop words) and adjacent word pairs are hashed into
+    `dim` buckets with a pseudo-random sign and the vector is normalized, so
+    the dot product of two vectors measures how many words (and phrases) two
+    messages share.
+    """
+    slow = False  # Cheap enough to run on the event loop
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f'hashing-{dim}'
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = [word for word in WORD_PATTERN.findall(text.lower()) if word not in STOP_WORDS]
+            tokens = [(word, 1.0) for word in words]
+            tokens += [(f'{first} {second}', PAIR_WEIGHT) for first, second in zip(words, words[1:])]
+            for token, weight in tokens:
+                # crc32 rather than hash(), which changes between runs and would invalidate saved vectors
+                bucket = zlib.crc32(token.encode('utf-8'))
+                vectors[row, bucket % self.dim] += weight if bucket & 0x80000000 else -weight
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class ModelEmbedder:
+    """Embeddings from a small local model run on the CPU with fastembed (ONNX Runtime)"""
+    slow = True  # Runs in a thread so the event loop keeps serving
+
+    def __init__(self, model_name):
+        from fastembed import TextEmbedding
+        self.model = TextEmbedding(model_name)
+        self.name = model_name
+        self.dim = self.embed(['probe']).shape[1]
+
+    def embed(self, texts):
+        vectors = np.asarray(list(self.model.embed(texts)), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+def make_embedder(model_name='', dim=256):
+    """Load the named local embedding model, falling back to hashed bag-of-words"""
+    if model_name:
+        try:
+            return ModelEmbedder(model_name)
+        except Exception as e:
+            print(f"Could not load embedding model {model_name}, using hashed bag-of-words instead: {e}")
+    return HashingEmbedder(dim)
+
+
+class VectorIndex:
+    """Message embeddings for one guild in preallocated NumPy arrays.
+
+    Rows grow by doubling up to `capacity`; after that each insert overwrites
+    the oldest row, so the index always holds the newest `capacity` messages.
+    A search is one matrix-vector product over every row.
+    """
+
+    def __init__(self, dim, capacity):
+        self.dim = dim
+        self.capacity = capacity  # Messages kept; the oldest are overwritten past this
+        rows = min(capacity, 256)
+        self.vectors = np.zeros((rows, dim), dtype=np.float32)
+        self.timestamps = np.zeros(rows, dtype=np.float64)
+        self.channel_ids = np.zeros(rows, dtype=np.int64)
+        self.valid = np.zeros(rows, dtype=bool)  # False for rows forgotten by a channel clear
+        self.entries = []  # (channel_id, author_name, content, timestamp) per row
+        self.next = 0  # Row the next insert overwrites once the index is full
+
+    def __len__(self):
+        return len(self.entries)
+
+    def grow(self):
+        rows = min(self.capacity, len(self.vectors) * 2)
+        self.vectors = np.resize(self.vectors, (rows, self.dim))
+        self.timestamps = np.resize(self.timestamps, rows)
+        self.channel_ids = np.resize(self.channel_ids, rows)
+        self.valid = np.resize(self.valid, rows)
+
+    def add(self, vector, entry):
+        """Insert one message's vector and its (channel_id, author_name, content, timestamp)"""
+        if len(self.entries) < self.capacity:
+            row = len(self.entries)
+            if row == len(self.vectors):
+                self.grow()
+            self.entries.append(entry)
+        else:
+            row = self.next
+            self.next = (row + 1) % self.capacity
+            self.entries[row] = entry
+        self.vectors[row] = vector
+        self.channel_ids[row] = entry[0]
+        self.timestamps[row] = entry[3]
+        self.valid[row] = True
+
+    def forget(self, channel_id):
+        """Stop returning a channel's messages"""
+        size = len(self.entries)
+        self.valid[:size] &= self.channel_ids[:size] != channel_id
+
+    def search(self, query, k, min_score, channel_id=None, since=None):
+        """Return up to k (score, entry) pairs most similar to `query`, best first.
+
+        Messages from `channel_id` at or after `since` are skipped: they are
+        already in the channel's recent context.
+        """
+        size = len(self.entries)
+        if not size or k <= 0:
+            return []
+        scores = self.vectors[:size] @ query
+        hidden = ~self.valid[:size]
+        if channel_id is not None and since is not None:
+            hidden |= (self.channel_ids[:size] == channel_id) & (self.timestamps[:size] >= since)
+        scores[hidden] = -np.inf
+        k = min(k, size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[row]), self.entries[row]) for row in top if scores[row] >= min_score]
+
+    def export(self):
+        """Copy the index into plain arrays for saving"""
+        size = len(self.entries)
+        return {
+            'vectors': self.vectors[:size].copy(),
+            'valid': self.valid[:size].copy(),
+            'next': np.array(self.next),
+            'entries': np.frombuffer(json.dumps(self.entries).encode('utf-8'), dtype=np.uint8),
+        }
+
+    @classmethod
+    def from_saved(cls, data, capacity):
+        entries = [tuple(entry) for entry in json.loads(bytes(data['entries']).decode('utf-8'))]
+        vectors = data['vectors']
+        valid = data['valid']
+        order = range(len(entries))
+        if len(entries) > capacity:
+            # The capacity was lowered: keep the newest messages
+            order = sorted(order, key=lambda row: entries[row][3])[-capacity:]
+        elif len(entries) == capacity:
+            # Full ring: replay from the oldest row so the next insert overwrites it
+            order = [(int(data['next']) + offset) % capacity for offset in order]
+        index = cls(vectors.shape[1], capacity)
+        for row in order:
+            if valid[row]:
+                index.add(vectors[row], entries[row])
+        return index
+
+
+class LongTermMemory:
+    """Per-guild vector indexes of past messages, searched for ones relevant to a new mention.
+
+    Messages are queued by `add` and embedded in batches by a background task
+    (in a thread when the embedder is a model). Indexes are saved under
+    `directory` by the background writer when `save` is called, and loaded
+    the first time a guild is used; at most `max_guilds` stay in RAM.
+    """
+
+    def __init__(self, writer, embedder, directory, capacity=2000, max_guilds=1000,
+                 top_k=3, min_score=0.2, budget=0.05, batch_size=64):
+        self.writer = writer  # persistence.BackgroundWriter used to save indexes
+        self.embedder = embedder
+        self.directory = directory
+        self.capacity = capacity  # Messages kept per guild
+        self.max_guilds = max_guilds  # Guild indexes kept in RAM
+        self.top_k = top_k  # Past messages returned per search
+        self.min_score = min_score  # Similarity below which a message is not considered relevant
+        self.budget = budget  # Seconds a search may take before it is abandoned
+        self.batch_size = batch_size  # Messages embedded at once
+        self.max_pending = batch_size * 50  # Oldest queued messages are dropped past this (a model that cannot keep up)
+
+        self.indexes = OrderedDict()  # {guild_id: VectorIndex}, least recently used first
+        self.changed = set()  # Guilds whose index changed since the last save
+        self.evicted = {}  # Changed indexes dropped from RAM, kept until they are written
+        self.pending = []  # (guild_id, channel_id, author_name, content, timestamp) waiting to be embedded
+        self._wakeup = None
+        self._task = None
+
+        writer.register('long_term_memory', self.snapshot, self.write)
+
+    def path(self, guild_id):
+        return os.path.join(self.directory, f'{guild_id}.npz')
+
+    def load_index(self, guild_id):
+        """Read a guild's saved index, or None if there is none (or it used another embedder)"""
+        path = self.path(guild_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if bytes(data['embedder']).decode('utf-8') != self.embedder.name:
+                    return None
+                return VectorIndex.from_saved(data, self.capacity)
+        except Exception as e:
+            print(f"Error loading long-term memory for guild {guild_id}: {e}")
+            return None
+
+    def index(self, guild_id):
+        """Return a guild's index if it is in RAM (or waiting to be written), or None"""
+        index = self.indexes.get(guild_id)
+        if index is not None:
+            self.indexes.move_to_end(guild_id)
+            return index
+        index = self.evicted.pop(guild_id, None)
+        if index is not None:
+            self.keep(guild_id, index)
+        return index
+
+    def keep(self, guild_id, index):
+        """Hold a guild's index in RAM as the most recently used"""
+        self.indexes[guild_id] = index
+        if len(self.indexes) > self.max_guilds:
+            # Least recently used guilds are dropped when the writer next runs
+            self.writer.mark_dirty('long_term_memory')
+
+    async def load(self, guild_id):
+        """Return a guild's index, reading it from disk in a thread if it is not in RAM"""
+        index = self.index(guild_id)
+        if index is not None:
+            return index
+        index = await asyncio.to_thread(self.load_index, guild_id)
+        cached = self.index(guild_id)
+        if cached is not None:
+            # Another task created or loaded it while the file was read
+            return cached
+        if index is not None:
+            self.keep(guild_id, index)
+        return index
+
+    def memory_count(self):
+        return sum(len(index) for index in self.indexes.values())
+
+    def start(self):
+        """Start the background embedding task on the running event loop"""
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        if self.pending:
+            self._wakeup.set()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def add(self, guild_id, channel_id, author_name, content, timestamp):
+        """Queue a message to be embedded and indexed"""
+        self.pending.append((guild_id, channel_id, author_name, content, timestamp))
+        if len(self.pending) > self.max_pending:
+            del self.pending[:len(self.pending) - self.max_pending]
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def forget(self, guild_id, channel_id):
+        """Forget a channel's messages"""
+        self.pending = [item for item in self.pending if item[1] != channel_id]
+        index = await self.load(guild_id)
+        if index is not None:
+            index.forget(channel_id)
+            self.changed.add(guild_id)
+
+    async def embed(self, texts):
+        if self.embedder.slow:
+            return await asyncio.to_thread(self.embedder.embed, texts)
+        return self.embedder.embed(texts)
+
+    async def search(self, guild_id, channel_id, query, since=None):
+        """Return up to top_k (score, (channel_id, author_name, content, timestamp)) relevant to `query`.
+
+        Raises asyncio.TimeoutError if embedding the query and reading the
+        guild's index take longer than the budget.
+        """
+        if guild_id not in self.indexes and guild_id not in self.evicted and not os.path.exists(self.path(guild_id)):
+            return []
+        # The index read is shielded so a search that times out still leaves it in RAM for the next one
+        vectors, index = await asyncio.wait_for(
+            asyncio.gather(self.embed([query]), asyncio.shield(self.load(guild_id))),
+            self.budget
+        )
+        if index is None:
+            return []
+        return index.search(vectors[0], self.top_k, self.min_score, channel_id, since)
+
+    async def index_pending(self):
+        """Embed and index one batch of queued messages"""
+        batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+        vectors = await self.embed([item[3] for item in batch])
+        for (guild_id, channel_id, author_name, content, timestamp), vector in zip(batch, vectors):
+            index = await self.load(guild_id)
+            if index is None:
+                index = VectorIndex(self.embedder.dim, self.capacity)
+                self.keep(guild_id, index)
+            index.add(vector, (channel_id, author_name, content, timestamp))
+            self.changed.add(guild_id)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.pending:
+                try:
+                    await self.index_pending()
+                except Exception as e:
+                    print(f"Error indexing long-term memory: {e}")
+
+    def save(self):
+        """Schedule changed indexes to be written"""
+        if self.changed:
+            self.writer.mark_dirty('long_term_memory')
+
+    def snapshot(self):
+        """Drop least recently used guilds past max_guilds and copy changed indexes"""
+        # The previous write has finished, so evicted indexes are on disk
+        self.evicted = {}
+        while len(self.indexes) > self.max_guilds:
+            guild_id, index = self.indexes.popitem(last=False)
+            if guild_id in self.changed:
+                self.evicted[guild_id] = index
+        changes = {}
+        for guild_id in self.changed:
+            index = self.indexes.get(guild_id) or self.evicted.get(guild_id)
+            if index is not None:
+                changes[guild_id] = index.export()
+        self.changed = set()
+        return changes
+
+    def write(self, changes):
+        """Save changed indexes (runs on the writer thread)"""
+        if not changes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        embedder = np.frombuffer(self.embedder.name.encode('utf-8'), dtype=np.uint8)
+        for guild_id, arrays in changes.items():
+            atomic_write(self.path(guild_id), lambda f: np.savez(f, embedder=embedder, **arrays), mode='wb')
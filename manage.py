@@ -0,0 +1,233 @@
+"""Back up, restore and replay the bot's state offline.
+
+    python manage.py export backup.dump [--compress gzip|xz] [--only memories|personalities]
+    python manage.py import backup.dump
+    python manage.py replay backup.dump [--speed 0] [--workdir DIR] [--json]
+
+export writes channel memories, personalities and guild settings from the
+configured backends (MEMORY_BACKEND, STATE_BACKEND) in the current directory
+to a dump (see dump_format.py; '-' writes to stdout). import loads one back,
+replacing the channels and guilds it contains and leaving everything else
+alone. Stop the bot first: both read and write its state files.
+
+replay feeds every message in a dump, oldest first, through the bot's memory
+functions as if it were arriving live: user messages through the ingestion
+buffer, bot messages as replies (reading the channel's context, then storing
+the reply). Exports replay as the traffic that produced them, and dumps of
+'message' records (recorded with RECORD_MESSAGES_FILE) replay recorded
+streams. State is written to a fresh temporary directory unless --workdir
+is given, and the run reports the same timings as the load test. No Discord
+connection or OpenRouter key is needed.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from dump_format import COMPRESSIONS, DumpError, DumpWriter, channel_memories, channel_record, read_dump
+from metrics import resident_memory_bytes
+
+REPLAY_YIELD_EVERY = 256  # Events replayed between event loop turns when not pacing, so background tasks keep up
+
+
+def export_state(args):
+    with DumpWriter(args.file, args.compress) as dump, contextlib.redirect_stdout(sys.stderr):
+        # Status goes to stderr so the dump can be written to stdout
+        import bot
+        bot.load_system_prompts()
+        bot.load_guild_settings()
+        bot.load_memories()
+
+        personalities = 0
+        if args.only != 'memories':
+            personalities = len(bot.guild_system_prompts)
+            for guild_id, prompt in bot.guild_system_prompts.items():
+                dump.write({'type': 'personality', 'guild_id': guild_id, 'prompt': prompt})
+            for guild_id, settings in bot.guild_settings.items():
+                dump.write({'type': 'settings', 'guild_id': guild_id, 'settings': settings})
+
+        channels = messages = 0
+        if args.only != 'personalities':
+            for channel_id in bot.memory_backend.channel_ids():
+                memories = bot.memory_backend.messages(channel_id)
+                if memories:
+                    dump.write(channel_record(channel_id, memories))
+                    channels += 1
+                    messages += len(memories)
+
+        print(f"Exported {personalities} personalities, "
+              f"{channels} channels and {messages} messages ({dump.records} records, {dump.codec})")
+
+
+def import_state(args):
+    import bot
+    bot.load_system_prompts()
+    bot.load_guild_settings()
+    bot.load_memories()
+
+    counts = {'personality': 0, 'settings': 0, 'channel': 0, 'message': 0}
+    for record in read_dump(args.file):
+        kind = record.get('type')
+        if kind == 'personality':
+            bot.set_system_prompt(record['guild_id'], record['prompt'])
+        elif kind == 'settings':
+            bot.guild_settings[str(record['guild_id'])] = record['settings']
+            bot.save_guild_settings(record['guild_id'])
+        elif kind == 'channel':
+            # Replace the channel; messages beyond the memory limit would only be evicted again
+            memories = channel_memories(record)[-bot.MAX_MEMORY_MESSAGES:]
+            bot.memory_backend.clear(record['channel_id'])
+            if memories:
+                bot.memory_backend.add_many(record['channel_id'], memories)
+        elif kind != 'message':
+            # Message streams are for replay; anything else is from a newer version
+            print(f"Skipping unknown record type {kind!r}")
+            continue
+        counts[kind] += 1
+
+    bot.save_memories()
+    bot.persistence_writer.flush()
+    print(f"Imported {counts['personality']} personalities, settings for {counts['settings']} guilds "
+          f"and {counts['channel']} channels" + (f" (ignored {counts['message']} stream messages)" if counts['message'] else ''))
+
+
+def load_events(path):
+    """Read every message in a dump as (timestamp, channel_id, guild_id, author_name, author_id, content, is_bot), oldest first"""
+    events = []
+    for record in read_dump(path):
+        kind = record.get('type')
+        if kind == 'message':
+            events.append((record['timestamp'], record['channel_id'], record.get('guild_id') or 0,
+                           record['author_name'], record['author_id'], record['content'], record['is_bot']))
+        elif kind == 'channel':
+            # Exports don't say which guild a channel belongs to
+            events.extend((memory.timestamp, record['channel_id'], 0, memory.author_name,
+                           memory.author_id, memory.content, memory.is_bot) for memory in channel_memories(record))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def replay(args, events):
+    import bot
+    from ingest import clean_content
+    bot.load_memories()
+    bot.persistence_writer.start()
+    bot.message_ingestor.start()
+
+    rss_before = resident_memory_bytes()
+    ingest_seconds = []
+    reply_seconds = []
+    skipped = 0
+    first_timestamp = events[0][0] if events else 0.0
+    start = time.perf_counter()
+    for i, (timestamp, channel_id, guild_id, author_name, author_id, content, is_bot) in enumerate(events):
+        if args.speed:
+            delay = start + (timestamp - first_timestamp) / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif i % REPLAY_YIELD_EVERY == 0:
+            await asyncio.sleep(0)
+
+        began = time.perf_counter()
+        if is_bot:
+            # A reply: the context it was generated from is read, then the reply is stored
+            bot.get_conversation_context(channel_id)
+            bot.add_message_to_memory(channel_id, author_name, author_id, content, is_bot=True)
+            reply_seconds.append(time.perf_counter() - began)
+        else:
+            content = clean_content(content, '!', bot.INGEST_MAX_CHARS)
+            if content is None:
+                skipped += 1
+                continue
+            bot.message_ingestor.submit(channel_id, guild_id, author_name, author_id, content, time.time())
+            ingest_seconds.append(time.perf_counter() - began)
+    elapsed = time.perf_counter() - start
+
+    # Persistence cost: commit what is buffered and force a full checkpoint
+    flush_start = time.perf_counter()
+    bot.message_ingestor.flush_all()
+    bot.save_memories()
+    await bot.persistence_writer.stop()
+    flush_seconds = time.perf_counter() - flush_start
+
+    return {
+        'events': len(events),
+        'channels': bot.memory_backend.channel_count(),
+        'user_messages': len(ingest_seconds),
+        'replies': len(reply_seconds),
+        'skipped': skipped,
+        'speed': args.speed or 'max',
+        'elapsed_s': round(elapsed, 3),
+        'events_per_s': round(len(events) / elapsed, 1) if elapsed else None,
+        'ingest_p50_us': round(percentile(ingest_seconds, 0.5) * 1e6, 2) if ingest_seconds else None,
+        'ingest_p99_us': round(percentile(ingest_seconds, 0.99) * 1e6, 2) if ingest_seconds else None,
+        'reply_p50_us': round(percentile(reply_seconds, 0.5) * 1e6, 2) if reply_seconds else None,
+        'reply_p99_us': round(percentile(reply_seconds, 0.99) * 1e6, 2) if reply_seconds else None,
+        'ingest_batches': bot.message_ingestor.batches,
+        'rss_growth_mib': round((resident_memory_bytes() - rss_before) / 2**20, 2),
+        'final_flush_s': round(flush_seconds, 4),
+    }
+
+
+def replay_stream(args):
+    path = args.file if args.file == '-' else os.path.abspath(args.file)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='dingus-replay-')
+    events = load_events(path)
+
+    # The bot keeps its state files in the working directory
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+        results = asyncio.run(replay(args, events))
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        width = max(len(key) for key in results)
+        for key, value in results.items():
+            print(f"{key:{width}}  {value}")
+        print(f"(state files written to {workdir})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='write memories, personalities and settings to a dump')
+    export_parser.add_argument('file', help="dump to write ('-' for stdout)")
+    export_parser.add_argument('--compress', choices=COMPRESSIONS, default='none')
+    export_parser.add_argument('--only', choices=('memories', 'personalities'), help='export just memories, or just personalities and settings')
+    export_parser.set_defaults(handler=export_state)
+
+    import_parser = commands.add_parser('import', help='load a dump, replacing the channels and guilds it contains')
+    import_parser.add_argument('file', help="dump to read ('-' for stdin)")
+    import_parser.set_defaults(handler=import_state)
+
+    replay_parser = commands.add_parser('replay', help="replay a dump's messages through the memory functions")
+    replay_parser.add_argument('file', help="dump to read ('-' for stdin)")
+    replay_parser.add_argument('--speed', type=float, default=0.0, help='replay at N times the recorded pace (0 replays as fast as possible)')
+    replay_parser.add_argument('--workdir', help='directory for state files (default: a new temporary directory)')
+    replay_parser.add_argument('--json', action='store_true', help='print one JSON line for run-to-run comparison')
+    replay_parser.set_defaults(handler=replay_stream)
+
+    args = parser.parse_args()
+    try:
+        args.handler(args)
+    except DumpError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
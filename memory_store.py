@@ -0,0 +1,802 @@
+import heapq
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from itertools import chain, islice
+
+from cpu_pool import CpuPool
+from persistence import atomic_write
+from tokenizer import count_message_tokens
+
+SNAPSHOT_CHUNK_CHANNELS = 25  # Channels encoded per unit of work when writing a snapshot
+
+# Start of a snapshot line, readable without parsing the messages that follow
+SNAPSHOT_LINE_PREFIX = re.compile(rb'\{"channel_id": (-?\d+), "oldest": ([-+.\deE]+), "count": (\d+), ')
+
+
+class MessageMemory:
+    """Compact record of a remembered message.
+
+    Uses __slots__ instead of a per-instance __dict__, stores the timestamp as
+    seconds since the epoch, and interns author names so every message from
+    the same author shares one string. The token count is computed the first
+    time it is needed and cached on the record.
+    """
+    __slots__ = ('author_name', 'author_id', 'content', 'timestamp', 'is_bot', 'token_count')
+
+    def __init__(self, author_name, author_id, content, timestamp, is_bot=False):
+        self.author_name = sys.intern(author_name)
+        self.author_id = author_id
+        self.content = content
+        self.timestamp = timestamp  # Seconds since the epoch
+        self.is_bot = is_bot
+        self.token_count = None
+
+    def context_content(self):
+        """Text of this message as it appears in AI context"""
+        return self.content if self.is_bot else f"{self.author_name}: {self.content}"
+
+    def tokens(self):
+        """Tokens this message uses in AI context, counted once and cached"""
+        if self.token_count is None:
+            self.token_count = count_message_tokens(self.context_content())
+        return self.token_count
+
+    def to_tuple(self):
+        """Plain (author_name, author_id, content, timestamp, is_bot) tuple, cheap to send to a worker process"""
+        return (self.author_name, self.author_id, self.content, self.timestamp, self.is_bot)
+
+    def to_dict(self):
+        return {
+            'author_name': self.author_name,
+            'author_id': self.author_id,
+            'content': self.content,
+            'timestamp': self.timestamp,
+            'is_bot': self.is_bot
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        timestamp = data['timestamp']
+        if isinstance(timestamp, str):
+            # Files written before epoch timestamps stored ISO strings
+            timestamp = datetime.fromisoformat(timestamp).timestamp()
+        return cls(
+            author_name=data['author_name'],
+            author_id=data['author_id'],
+            content=data['content'],
+            timestamp=timestamp,
+            is_bot=data['is_bot']
+        )
+
+    def is_expired(self, expiry_hours, now=None):
+        """Check if this message is older than the expiry time"""
+        return (now or time.time()) - self.timestamp > expiry_hours * 3600
+
+
+def tuple_to_dict(row):
+    author_name, author_id, content, timestamp, is_bot = row
+    return {'author_name': author_name, 'author_id': author_id, 'content': content, 'timestamp': timestamp, 'is_bot': is_bot}
+
+
+def encode_snapshot_line(channel_id, messages):
+    """Render one channel's snapshot line from message dicts, oldest first.
+
+    The channel id, oldest timestamp and message count come first so loading
+    can index the snapshot without parsing every message.
+    """
+    entry = {'channel_id': channel_id, 'oldest': messages[0]['timestamp'], 'count': len(messages), 'messages': messages}
+    return (json.dumps(entry) + '\n').encode('utf-8')
+
+
+def encode_snapshot_chunk(chunk):
+    """Render snapshot lines for (cutoff, [(channel_id, [message tuples])]), dropping expired messages.
+
+    Takes and returns plain data so it can run in a CpuPool worker process.
+    """
+    cutoff, channels = chunk
+    lines = []
+    for channel_id, rows in channels:
+        valid_messages = [tuple_to_dict(row) for row in rows if row[3] >= cutoff]
+        if valid_messages:
+            lines.append(encode_snapshot_line(channel_id, valid_messages))
+    return b''.join(lines)
+
+
+def encode_journal_records(records):
+    """Render journal lines for [(seq, channel_id, message tuple or None for a clear)]"""
+    lines = []
+    for seq, channel_id, row in records:
+        record = {'seq': seq, 'channel_id': channel_id}
+        if row is None:
+            record['clear'] = True
+        else:
+            record['message'] = tuple_to_dict(row)
+        lines.append(json.dumps(record) + '\n')
+    return ''.join(lines)
+
+
+def chunked(items, size):
+    """Split an iterable into lists of at most `size` items"""
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class SnapshotReader:
+    """Reads single channel lines from a snapshot file by offset.
+
+    The file stays open while any channel still points into it, so lines can
+    be read even after a compaction has replaced the file on disk. Reads use
+    pread, so the writer thread and the event loop can share one reader.
+    """
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self, offset, length):
+        return os.pread(self.fd, length, offset)
+
+    def __del__(self):
+        os.close(self.fd)
+
+
+class MemoryBackend:
+    """Interface for per-channel conversation memory storage.
+
+    Messages are returned oldest first. Writes may be buffered and handed to
+    the background writer, but reads always reflect every write made so far.
+    """
+
+    def __init__(self, writer, max_messages, expiry_hours):
+        self.writer = writer  # persistence.BackgroundWriter used for disk writes
+        self.max_messages = max_messages  # Messages remembered per channel
+        self.expiry_hours = expiry_hours  # How long messages are kept
+        self.on_evict = None  # Optional callable(channel_id, memory) for messages dropped by the size limit or expiry
+
+    def load(self):
+        """Load stored memories at startup"""
+        raise NotImplementedError
+
+    def add(self, channel_id, memory):
+        """Remember a message in a channel"""
+        self.add_many(channel_id, (memory,))
+
+    def add_many(self, channel_id, memories):
+        """Remember several messages in a channel, oldest first, as one change"""
+        raise NotImplementedError
+
+    def recent(self, channel_id, limit):
+        """Return up to `limit` of the newest non-expired messages in a channel"""
+        raise NotImplementedError
+
+    def iter_recent(self, channel_id, limit):
+        """Yield up to `limit` of the newest non-expired messages, newest first"""
+        return reversed(self.recent(channel_id, limit))
+
+    def messages(self, channel_id):
+        """Return every remembered message in a channel"""
+        raise NotImplementedError
+
+    def clear(self, channel_id):
+        """Forget a channel's messages, returning whether there were any"""
+        raise NotImplementedError
+
+    def channel_ids(self):
+        """Return the ids of every channel with stored messages"""
+        raise NotImplementedError
+
+    def channel_count(self):
+        """Return how many channels have remembered messages"""
+        raise NotImplementedError
+
+    def channel_sizes(self):
+        """Return the number of stored messages in each channel"""
+        raise NotImplementedError
+
+    def cleanup_expired(self):
+        """Remove expired messages"""
+        raise NotImplementedError
+
+    def save(self):
+        """Schedule a full checkpoint of the stored memories"""
+        raise NotImplementedError
+
+
+class JsonMemoryBackend(MemoryBackend):
+    """Keeps channels in memory, persisted as a JSON snapshot plus an append-only journal.
+
+    Loading only indexes the snapshot: each channel's line is parsed the first
+    time the channel is used, so startup time and resident memory grow with
+    the number of channels rather than messages. Unread channels are copied
+    into new snapshots line for line.
+    """
+
+    def __init__(self, writer, max_messages, expiry_hours, snapshot_file, journal_file,
+                 legacy_file=None, compact_every=1000, cpu_pool=None):
+        super().__init__(writer, max_messages, expiry_hours)
+        self.snapshot_file = snapshot_file  # Compacted memories, one channel per line
+        self.journal_file = journal_file  # Append-only log of changes since the last snapshot
+        self.legacy_file = legacy_file  # Old whole-file format, migrated on load
+        self.compact_every = compact_every  # Journal records between compactions
+        self.cpu_pool = cpu_pool or CpuPool()  # Where snapshot and journal encoding runs
+
+        # Memory storage: {channel_id: deque of message objects, oldest first}
+        self.channels = {}
+
+        # Channels not read from the snapshot yet: {channel_id: (SnapshotReader, offset, length, message count)}
+        self.cold = {}
+        # (SnapshotReader, {channel_id: (offset, length, count)}, channel_ids dropped as expired) queued by compactions on the writer thread
+        self.reindexes = deque()
+
+        # Min-heap of (oldest timestamp, channel_id) so cleanup only visits channels with
+        # expired messages. Entries are validated lazily against expiry_scheduled.
+        self.expiry_heap = []
+        self.expiry_scheduled = {}  # {channel_id: timestamp of its live heap entry}
+
+        # Journal state
+        self.journal = None  # Open append handle for the journal file
+        self.journal_seq = 0  # Sequence number of the last journal record
+        self.journal_records = 0  # Records written since the last compaction
+        self.pending_records = []  # (seq, channel_id, message or None for a clear) waiting to be written
+        self.compaction_due = False  # Whether the next write should also compact into a snapshot
+
+        writer.register('memories', self.snapshot, self.write)
+
+    def migrate_legacy(self):
+        """Convert the old memories.json file into a snapshot"""
+        with open(self.legacy_file, 'r') as f:
+            data = json.load(f)
+
+        for channel_id, messages in data.items():
+            self.channels[int(channel_id)] = deque(
+                [MessageMemory.from_dict(msg) for msg in messages],
+                maxlen=self.max_messages
+            )
+
+        # Write the snapshot right away so it is on disk before the legacy file moves
+        self.compaction_due = True
+        self.write(self.snapshot())
+        os.replace(self.legacy_file, self.legacy_file + '.migrated')
+
+        # The channels are indexed from the new snapshot like any other
+        self.channels.clear()
+        self.reindexes.clear()
+        print(f"Migrated {len(data)} channels from {self.legacy_file} to {self.snapshot_file}")
+
+    def replay_journal(self, snapshot_seq):
+        """Apply journal records written after the snapshot was taken"""
+        replayed = 0
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-append can leave a partial last line
+                    continue
+
+                if record['seq'] <= snapshot_seq:
+                    continue
+                self.journal_seq = max(self.journal_seq, record['seq'])
+
+                channel_id = record['channel_id']
+                if record.get('clear'):
+                    self.channels.pop(channel_id, None)
+                    self.cold.pop(channel_id, None)
+                else:
+                    messages = self.load_channel(channel_id)
+                    if messages is None:
+                        messages = self.channels[channel_id] = deque(maxlen=self.max_messages)
+                    messages.append(MessageMemory.from_dict(record['message']))
+                replayed += 1
+        return replayed
+
+    def parse_snapshot_line(self, line):
+        entry = json.loads(line)
+        return entry['channel_id'], deque(
+            [MessageMemory.from_dict(msg) for msg in entry['messages']],
+            maxlen=self.max_messages
+        )
+
+    def index_snapshot(self):
+        """Record where each channel's line is in the snapshot, returning (journal seq, {channel_id: oldest timestamp})"""
+        reader = SnapshotReader(self.snapshot_file)
+        oldest = {}
+        with open(self.snapshot_file, 'rb') as f:
+            header = json.loads(f.readline())
+            offset = f.tell()
+            for line in f:
+                match = SNAPSHOT_LINE_PREFIX.match(line)
+                if match is None:
+                    # Snapshots written before indexing was added; loaded right away
+                    channel_id, messages = self.parse_snapshot_line(line)
+                    self.channels[channel_id] = messages
+                    oldest[channel_id] = messages[0].timestamp
+                else:
+                    channel_id = int(match.group(1))
+                    if channel_id not in self.channels:
+                        self.cold[channel_id] = (reader, offset, len(line), int(match.group(3)))
+                        oldest[channel_id] = float(match.group(2))
+                offset += len(line)
+        return header['journal_seq'], oldest
+
+    def load(self):
+        """Index the snapshot and replay the journal; channels are read on first use"""
+        if self.legacy_file and not os.path.exists(self.snapshot_file) and os.path.exists(self.legacy_file):
+            self.migrate_legacy()
+
+        snapshot_seq = 0
+        oldest = {}
+        if os.path.exists(self.snapshot_file):
+            snapshot_seq, oldest = self.index_snapshot()
+        self.journal_seq = max(self.journal_seq, snapshot_seq)
+
+        replayed = 0
+        if os.path.exists(self.journal_file):
+            replayed = self.replay_journal(snapshot_seq)
+        print(f"Indexed memories for {self.channel_count()} channels ({len(self.cold)} read on first use, {replayed} journal records replayed)")
+
+        # Index channels by their oldest message, then drop anything already expired
+        for channel_id, messages in self.channels.items():
+            if messages:
+                oldest[channel_id] = messages[0].timestamp
+        self.expiry_scheduled = {channel_id: timestamp for channel_id, timestamp in oldest.items()
+                                 if channel_id in self.channels or channel_id in self.cold}
+        self.expiry_heap = [(timestamp, channel_id) for channel_id, timestamp in self.expiry_scheduled.items()]
+        heapq.heapify(self.expiry_heap)
+        self.cleanup_expired()
+
+    def load_channel(self, channel_id):
+        """Return a channel's messages (None if it has none), reading them from the snapshot on first use"""
+        messages = self.channels.get(channel_id)
+        if messages is None and channel_id in self.cold:
+            self.apply_reindexes()
+            reader, offset, length, _ = self.cold.pop(channel_id)
+            _, messages = self.parse_snapshot_line(reader.read(offset, length))
+            self.channels[channel_id] = messages
+            if channel_id not in self.expiry_scheduled:
+                # Expiry skipped this channel while it was unread
+                self.schedule_expiry(channel_id, messages[0].timestamp)
+        return messages
+
+    def load_all(self):
+        """Read every channel still waiting in the snapshot"""
+        for channel_id in list(self.cold):
+            self.load_channel(channel_id)
+
+    def apply_reindexes(self):
+        """Point channels still waiting to be read at the snapshot written by the latest compaction"""
+        while self.reindexes:
+            reader, index, dropped = self.reindexes.popleft()
+            for channel_id, (offset, length, count) in index.items():
+                if channel_id in self.cold:
+                    self.cold[channel_id] = (reader, offset, length, count)
+            for channel_id in dropped:
+                # Every message expired before the channel was read; the old reader closes with its last entry
+                if self.cold.pop(channel_id, None) is not None:
+                    self.expiry_scheduled.pop(channel_id, None)
+
+    def schedule_expiry(self, channel_id, timestamp):
+        """Record when a channel's oldest message was written"""
+        self.expiry_scheduled[channel_id] = timestamp
+        heapq.heappush(self.expiry_heap, (timestamp, channel_id))
+
+    def append_to_journal(self, channel_id, messages):
+        """Queue memory changes for the journal (None clears the channel), compacting when it grows large"""
+        for message in messages:
+            self.journal_seq += 1
+            self.pending_records.append((self.journal_seq, channel_id, message))
+        self.journal_records += len(messages)
+        if self.journal_records >= self.compact_every:
+            self.compaction_due = True
+        self.writer.mark_dirty('memories')
+
+    def add_many(self, channel_id, memories):
+        messages = self.load_channel(channel_id)
+        if messages is None:
+            messages = self.channels[channel_id] = deque(maxlen=self.max_messages)
+            self.schedule_expiry(channel_id, memories[0].timestamp)
+        if self.on_evict is not None:
+            overflow = len(messages) + len(memories) - self.max_messages
+            for evicted in islice(chain(messages, memories), max(0, overflow)):
+                self.on_evict(channel_id, evicted)
+        messages.extend(memories)
+
+        # Record the messages in the journal; snapshots are written on compaction
+        self.append_to_journal(channel_id, memories)
+
+    def recent(self, channel_id, limit):
+        messages = list(self.iter_recent(channel_id, limit))
+        messages.reverse()
+        return messages
+
+    def iter_recent(self, channel_id, limit):
+        messages = self.load_channel(channel_id)
+        if messages is None:
+            return
+        now = time.time()
+        for memory in islice(reversed(messages), limit):
+            if memory.is_expired(self.expiry_hours, now):
+                # Older messages are expired too
+                return
+            yield memory
+
+    def messages(self, channel_id):
+        return list(self.load_channel(channel_id) or ())
+
+    def clear(self, channel_id):
+        if channel_id not in self.channels and channel_id not in self.cold:
+            return False
+        self.channels.pop(channel_id, None)
+        self.cold.pop(channel_id, None)
+        self.expiry_scheduled.pop(channel_id, None)
+        self.append_to_journal(channel_id, (None,))
+        return True
+
+    def channel_ids(self):
+        self.apply_reindexes()
+        return list(self.channels) + list(self.cold)
+
+    def channel_count(self):
+        self.apply_reindexes()
+        return len(self.channels) + len(self.cold)
+
+    def channel_sizes(self):
+        self.apply_reindexes()
+        return [len(messages) for messages in self.channels.values()] + [entry[3] for entry in self.cold.values()]
+
+    def cleanup_expired(self):
+        """Drop expired messages, visiting only channels whose oldest message has expired"""
+        cutoff = time.time() - self.expiry_hours * 3600
+        heap = self.expiry_heap
+        while heap and heap[0][0] < cutoff:
+            timestamp, channel_id = heapq.heappop(heap)
+            if self.expiry_scheduled.get(channel_id) != timestamp:
+                # Stale entry for a cleared or rescheduled channel
+                continue
+            if channel_id in self.cold and self.on_evict is None:
+                # Nothing needs the expired messages: reads skip them and the next compaction drops them
+                del self.expiry_scheduled[channel_id]
+                continue
+
+            # Messages are in time order, so expired ones are all at the left
+            messages = self.load_channel(channel_id)
+            del self.expiry_scheduled[channel_id]
+            while messages and messages[0].timestamp < cutoff:
+                expired = messages.popleft()
+                if self.on_evict is not None:
+                    self.on_evict(channel_id, expired)
+
+            if messages:
+                self.schedule_expiry(channel_id, messages[0].timestamp)
+            else:
+                # Remove empty channels
+                del self.channels[channel_id]
+
+    def save(self):
+        """Schedule memories to be compacted into a snapshot"""
+        self.compaction_due = True
+        self.writer.mark_dirty('memories')
+
+    def snapshot(self):
+        """Capture pending journal records and, if compaction is due, the current memories"""
+        records, self.pending_records = self.pending_records, []
+        snapshot = None
+        if self.compaction_due:
+            self.apply_reindexes()
+            # Messages are never mutated, so copying the deques is enough; channels
+            # not read yet are copied line for line from the current snapshot
+            snapshot = (
+                self.journal_seq,
+                {channel_id: list(messages) for channel_id, messages in self.channels.items()},
+                dict(self.cold)
+            )
+            self.journal_records = 0
+            self.compaction_due = False
+        return records, snapshot
+
+    def write_snapshot(self, f, journal_seq, memories, cold, index, dropped):
+        """Write a snapshot: a header line, then one line per channel, recording where unread
+        channels went in `index` and which were left out because they expired in `dropped`"""
+        header = (json.dumps({'version': 2, 'journal_seq': journal_seq}) + '\n').encode('utf-8')
+        f.write(header)
+        offset = len(header)
+        cutoff = time.time() - self.expiry_hours * 3600
+        chunks = (
+            (cutoff, [(channel_id, [memory.to_tuple() for memory in messages]) for channel_id, messages in chunk])
+            for chunk in chunked(memories.items(), SNAPSHOT_CHUNK_CHANNELS)
+        )
+        for data in self.cpu_pool.imap(encode_snapshot_chunk, chunks):
+            f.write(data)
+            offset += len(data)
+
+        # Reading in file order keeps copying unread channels sequential
+        for channel_id, (reader, line_offset, length, count) in sorted(cold.items(), key=lambda item: (id(item[1][0]), item[1][1])):
+            if channel_id in memories:
+                # Already written from memory
+                continue
+            line = reader.read(line_offset, length)
+            if float(SNAPSHOT_LINE_PREFIX.match(line).group(2)) < cutoff:
+                # Some messages expired without the channel being used; drop them
+                _, messages = self.parse_snapshot_line(line)
+                valid_messages = [memory.to_dict() for memory in messages if memory.timestamp >= cutoff]
+                if not valid_messages:
+                    dropped.append(channel_id)
+                    continue
+                line = encode_snapshot_line(channel_id, valid_messages)
+                count = len(valid_messages)
+            f.write(line)
+            index[channel_id] = (offset, len(line), count)
+            offset += len(line)
+
+    def write(self, payload):
+        """Append journal records and write any snapshot (runs on the writer thread)"""
+        records, snapshot = payload
+
+        if snapshot is not None:
+            # The snapshot already covers every pending record, so the journal starts over
+            journal_seq, memories, cold = snapshot
+            index = {}
+            dropped = []
+            atomic_write(self.snapshot_file, lambda f: self.write_snapshot(f, journal_seq, memories, cold, index, dropped), mode='wb')
+            if index or dropped:
+                # Applied on the event loop the next time unread channels are needed
+                self.reindexes.append((SnapshotReader(self.snapshot_file) if index else None, index, dropped))
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = open(self.journal_file, 'w')
+            return
+
+        if self.journal is None:
+            self.journal = open(self.journal_file, 'a')
+        rows = [(seq, channel_id, None if message is None else message.to_tuple()) for seq, channel_id, message in records]
+        self.journal.write(self.cpu_pool.run(encode_journal_records, rows))
+        self.journal.flush()
+
+
+class SqliteMemoryBackend(MemoryBackend):
+    """Stores messages in SQLite, keeping a small LRU of hot channels in RAM.
+
+    Only the rows a caller asks for are read, so long histories for many
+    channels do not need to be held in memory or parsed at startup. Inserts
+    are batched and committed by the background writer.
+    """
+
+    def __init__(self, writer, max_messages, expiry_hours, db_file, cache_channels=1000):
+        super().__init__(writer, max_messages, expiry_hours)
+        self.db_file = db_file
+        self.cache_channels = cache_channels  # Hot channels kept in RAM
+
+        # {channel_id: [deque of newest messages, whether the deque holds every stored message]}
+        self.cache = OrderedDict()
+
+        # ('add', channel_id, message) / ('clear', channel_id, None) / ('cleanup', None, cutoff)
+        self.pending_ops = []  # Waiting for the writer
+        self.inflight_batches = []  # Taken by the writer but not committed yet
+        self.failed_batches = []  # Batches whose commit failed, retried on the next write
+
+        # Held while a batch commits so reads never miss or double count its rows
+        self.commit_lock = threading.Lock()
+
+        self.read_conn = None
+        self.write_conn = None
+
+        writer.register('memories', self.snapshot, self.write)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def load(self):
+        """Open the database, creating the schema if needed"""
+        self.write_conn = self.connect()
+        self.write_conn.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                author_name TEXT NOT NULL,
+                author_id INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                is_bot INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_channel_time ON messages (channel_id, timestamp);
+        ''')
+        self.write_conn.commit()
+        self.read_conn = self.connect()
+        print(f"Opened memory database {self.db_file} ({self.channel_count()} channels)")
+
+    def import_channels(self, channels):
+        """Bulk insert {channel_id: [MessageMemory]} (used to migrate from the JSON backend)"""
+        self.write_conn.executemany(
+            'INSERT INTO messages (channel_id, author_name, author_id, content, timestamp, is_bot) VALUES (?, ?, ?, ?, ?, ?)',
+            [self.to_row(channel_id, msg) for channel_id, messages in channels.items() for msg in messages]
+        )
+        self.write_conn.commit()
+
+    def is_empty(self):
+        return self.read_conn.execute('SELECT 1 FROM messages LIMIT 1').fetchone() is None
+
+    @staticmethod
+    def to_row(channel_id, memory):
+        return (channel_id, memory.author_name, memory.author_id, memory.content,
+                memory.timestamp, int(memory.is_bot))
+
+    @staticmethod
+    def from_row(row):
+        author_name, author_id, content, timestamp, is_bot = row
+        return MessageMemory(author_name, author_id, content, timestamp, bool(is_bot))
+
+    def cutoff(self):
+        return time.time() - self.expiry_hours * 3600
+
+    def query_newest(self, channel_id, limit):
+        """Read the newest `limit` messages for a channel, including unwritten changes"""
+        with self.commit_lock:
+            # Expired rows may still be waiting for the writer to delete them
+            rows = self.read_conn.execute(
+                'SELECT author_name, author_id, content, timestamp, is_bot FROM messages '
+                'WHERE channel_id = ? AND timestamp >= ? ORDER BY timestamp DESC, id DESC LIMIT ?',
+                (channel_id, self.cutoff(), limit)
+            ).fetchall()
+            messages = [self.from_row(row) for row in reversed(rows)]
+            # Only a short read means the database holds nothing older
+            complete = len(rows) < limit
+
+            # Apply changes the writer has not committed yet
+            unwritten = [op for batch in self.inflight_batches for op in batch] + self.pending_ops
+            for op, op_channel_id, value in unwritten:
+                if op == 'cleanup':
+                    messages = [msg for msg in messages if msg.timestamp >= value]
+                elif op_channel_id != channel_id:
+                    continue
+                elif op == 'clear':
+                    messages = []
+                    complete = True
+                else:
+                    messages.append(value)
+        # Trimming the merged list below drops older messages, so the window is no longer complete
+        return messages[-limit:], complete and len(messages) <= limit
+
+    def cache_put(self, channel_id, messages, complete):
+        self.cache[channel_id] = [deque(messages, maxlen=self.max_messages), complete]
+        self.cache.move_to_end(channel_id)
+        while len(self.cache) > self.cache_channels:
+            self.cache.popitem(last=False)
+
+    def add_many(self, channel_id, memories):
+        entry = self.cache.get(channel_id)
+        if entry is None and self.on_evict is not None:
+            # Eviction tracking needs the channel's full window in RAM
+            messages, _ = self.query_newest(channel_id, self.max_messages)
+            self.cache_put(channel_id, messages, True)
+            entry = self.cache[channel_id]
+        if entry is not None:
+            if self.on_evict is not None:
+                overflow = len(entry[0]) + len(memories) - self.max_messages
+                for evicted in islice(chain(entry[0], memories), max(0, overflow)):
+                    self.on_evict(channel_id, evicted)
+            entry[0].extend(memories)
+            self.cache.move_to_end(channel_id)
+        self.pending_ops.extend(('add', channel_id, memory) for memory in memories)
+        self.writer.mark_dirty('memories')
+
+    def recent(self, channel_id, limit):
+        entry = self.cache.get(channel_id)
+        if entry is not None and (entry[1] or len(entry[0]) >= limit):
+            self.cache.move_to_end(channel_id)
+            messages = list(entry[0])[-limit:]
+        else:
+            # Cache miss: fetch only the rows needed (the full window when evictions are tracked)
+            fetch = self.max_messages if self.on_evict is not None else min(limit, self.max_messages)
+            messages, complete = self.query_newest(channel_id, fetch)
+            self.cache_put(channel_id, messages, complete)
+        return [memory for memory in messages if not memory.is_expired(self.expiry_hours)]
+
+    def messages(self, channel_id):
+        messages, _ = self.query_newest(channel_id, self.max_messages)
+        return messages
+
+    def clear(self, channel_id):
+        had_messages = bool(self.recent(channel_id, 1))
+        self.cache.pop(channel_id, None)
+        self.pending_ops.append(('clear', channel_id, None))
+        self.writer.mark_dirty('memories')
+        return had_messages
+
+    def channel_ids(self):
+        with self.commit_lock:
+            return [row[0] for row in self.read_conn.execute('SELECT DISTINCT channel_id FROM messages')]
+
+    def channel_count(self):
+        with self.commit_lock:
+            return self.read_conn.execute('SELECT COUNT(DISTINCT channel_id) FROM messages').fetchone()[0]
+
+    def channel_sizes(self):
+        with self.commit_lock:
+            return [row[0] for row in self.read_conn.execute('SELECT COUNT(*) FROM messages GROUP BY channel_id')]
+
+    def cleanup_expired(self):
+        cutoff = self.cutoff()
+        for channel_id in list(self.cache.keys()):
+            messages = self.cache[channel_id][0]
+            while messages and messages[0].timestamp < cutoff:
+                expired = messages.popleft()
+                if self.on_evict is not None:
+                    self.on_evict(channel_id, expired)
+            if not messages:
+                del self.cache[channel_id]
+        self.pending_ops.append(('cleanup', None, cutoff))
+        self.writer.mark_dirty('memories')
+
+    def save(self):
+        # Every change is committed by the writer; just make sure it runs
+        self.writer.mark_dirty('memories')
+
+    def snapshot(self):
+        """Take pending changes (and any failed batches) as the next batch to commit"""
+        retry, self.failed_batches = self.failed_batches, []
+        batch = [op for failed in retry for op in failed] + self.pending_ops
+        self.pending_ops = []
+        self.inflight_batches = [b for b in self.inflight_batches if not any(b is failed for failed in retry)]
+        self.inflight_batches.append(batch)
+        return batch
+
+    def write(self, batch):
+        """Commit a batch of changes in one transaction (runs on the writer thread)"""
+        with self.commit_lock:
+            try:
+                self.apply_batch(batch)
+            except Exception:
+                # Keep the batch visible to reads and retry it on the next write
+                self.write_conn.rollback()
+                self.failed_batches.append(batch)
+                raise
+            self.inflight_batches = [b for b in self.inflight_batches if b is not batch]
+
+        cutoffs = [value for op, _, value in batch if op == 'cleanup']
+        if cutoffs:
+            # Expiry and trimming scan the whole table. Reads only ever ask for the newest
+            # messages and skip expired ones themselves, so neither needs the lock or holds
+            # up reads on the event loop
+            self.delete_old(max(cutoffs))
+
+    def delete_old(self, cutoff):
+        """Delete expired rows, then rows past the per-channel limit one channel per statement"""
+        conn = self.write_conn
+        conn.execute('DELETE FROM messages WHERE timestamp < ?', (cutoff,))
+        channel_ids = [row[0] for row in conn.execute(
+            'SELECT channel_id FROM messages GROUP BY channel_id HAVING COUNT(*) > ?', (self.max_messages,)
+        )]
+        for channel_id in channel_ids:
+            conn.execute(
+                'DELETE FROM messages WHERE channel_id = ? AND id NOT IN ('
+                '  SELECT id FROM messages WHERE channel_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?'
+                ')',
+                (channel_id, channel_id, self.max_messages)
+            )
+        conn.commit()
+
+    def apply_batch(self, batch):
+        conn = self.write_conn
+        for op, channel_id, value in batch:
+            if op == 'add':
+                conn.execute(
+                    'INSERT INTO messages (channel_id, author_name, author_id, content, timestamp, is_bot) VALUES (?, ?, ?, ?, ?, ?)',
+                    self.to_row(channel_id, value)
+                )
+            elif op == 'clear':
+                conn.execute('DELETE FROM messages WHERE channel_id = ?', (channel_id,))
+            # 'cleanup' runs after the commit, outside the lock (see write)
+        conn.commit()
@@ -0,0 +1,199 @@
+"""Lightweight in-process metrics with a Prometheus text endpoint.
+
+Recording a value is a dict lookup plus a few additions, so instrumenting hot
+paths costs next to nothing; all formatting work happens only when the
+endpoint is scraped or /bot_stats is used.
+"""
+import os
+import resource
+import sys
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    """Format a number the way Prometheus expects (NaN, +Inf, -Inf)"""
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class Counter:
+    """A value that only goes up, optionally split by labels"""
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def total(self):
+        return sum(self.values.values())
+
+    def collect(self):
+        for label_values, value in self.values.items():
+            yield f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"
+
+
+class Gauge:
+    """A value that can go up and down; `fn` computes it at scrape time instead.
+
+    `fn` returns a number, or a {label_values tuple: number} dict for labelled gauges.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), fn=None):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        self.fn = fn
+        self.values = {}
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def current(self):
+        if self.fn is None:
+            return dict(self.values)
+        value = self.fn()
+        return value if isinstance(value, dict) else {(): value}
+
+    def collect(self):
+        for label_values, value in self.current().items():
+            yield f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"
+
+
+class Histogram:
+    """Counts observations into fixed buckets, optionally split by labels"""
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        self.buckets = tuple(buckets)
+        self.series = {}  # {label_values: [bucket counts..., +Inf count, sum]}
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe how long the block takes, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def count(self, *label_values):
+        series = self.series.get(label_values)
+        return sum(series[:-1]) if series else 0
+
+    def quantile(self, q, *label_values):
+        """Estimate a quantile as the upper bound of the bucket it falls in"""
+        series = self.series.get(label_values)
+        if not series:
+            return None
+        target = q * sum(series[:-1])
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), series[:-1]):
+            seen += bucket_count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def collect(self):
+        for label_values, series in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket{format_labels(self.label_names, label_values, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.label_names, label_values)} {format_value(series[-1])}"
+            yield f"{self.name}_count{format_labels(self.label_names, label_values)} {cumulative}"
+
+
+class Registry:
+    """Holds every metric and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.add(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=(), fn=None):
+        return self.add(Gauge(name, description, labels, fn))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.collect())
+            except Exception as e:
+                lines.append(f"# error collecting {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+def resident_memory_bytes():
+    """Current resident memory of this process (peak resident memory where that is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # ru_maxrss is KiB on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+# Shared registry used by the bot's modules
+REGISTRY = Registry()
+
+
+async def start_metrics_server(host, port, registry=REGISTRY):
+    """Serve /metrics over HTTP on the running event loop, returning the runner"""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,220 @@
+import asyncio
+import bisect
+import re
+import time
+
+from resilience import TokenBucket
+
+FENCE = re.compile(r'^[ \t]*```([^\s`]*)', re.MULTILINE)  # Code fence lines, capturing the language
+FENCE_CLOSE = '\n```'
+PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n\s*')
+LINE_BREAK = re.compile(r'\n')
+SENTENCE_END = re.compile(r'(?<=[.!?…])[)"\'*_~]*\s+')
+SPACE = re.compile(r'\s+')
+
+
+def find_cut(window, minimum=0):
+    """Return (end of this message, start of the next) for the best place to cut `window`.
+
+    Cuts outside code blocks at a paragraph break, line break or sentence end
+    are preferred, then a line break inside a code block, then any space.
+    Only the second half of the window is searched, so no message is tiny,
+    and the next message must start after `minimum`; with no such boundary
+    the window is cut where it ends.
+    """
+    fences = [match.start() for match in FENCE.finditer(window)]
+    floor = len(window) // 2
+
+    def in_code(position):
+        return bisect.bisect_right(fences, position) % 2 == 1
+
+    for pattern, inside_code in ((PARAGRAPH_BREAK, False), (LINE_BREAK, False), (SENTENCE_END, False),
+                                 (LINE_BREAK, True), (SPACE, None)):
+        best = None
+        for match in pattern.finditer(window, floor):
+            if match.end() > minimum and (inside_code is None or in_code(match.start()) == inside_code):
+                best = match
+        if best is not None:
+            return best.start(), best.end()
+    return len(window), len(window)
+
+
+def split_message(text, limit=2000):
+    """Split text into Discord messages of at most `limit` characters at natural boundaries.
+
+    A code block that has to be cut is closed at the end of one message and
+    reopened, with its language, at the start of the next.
+    """
+    text = text.strip()
+    parts = []
+    reopened = 0  # Length of the fence repeated at the start of `text`, which a cut must get past
+    while len(text) > limit:
+        end, start = find_cut(text[:limit - len(FENCE_CLOSE)], reopened)
+        part = text[:end].rstrip()
+        opening = None
+        for match in FENCE.finditer(text, 0, end):
+            opening = None if opening is not None else match.group(1)
+        if opening is not None:
+            # Cut inside a code block: close it here and reopen it in the next message
+            parts.append(part + FENCE_CLOSE)
+            fence = f'```{opening}\n'
+            if len(fence) * 2 > limit:
+                # Not a language but code run into the backticks; repeating it would crowd out the rest
+                fence = '```\n'
+            text = fence + text[start:].lstrip('\n')
+            reopened = len(fence)
+        else:
+            if part:
+                parts.append(part)
+            text = text[start:].lstrip()
+            reopened = 0
+    if text:
+        parts.append(text)
+    return parts
+
+
+class OutboundReply:
+    """One queued reply: the message it answers and the parts still to send"""
+    __slots__ = ('target', 'parts', 'created', 'queued_at', 'waiters')
+
+    def __init__(self, target, parts, created, waiter):
+        self.target = target  # Message being replied to (anything with an async reply(content))
+        self.parts = parts
+        self.created = created  # When the triggering message was sent, in seconds since the epoch
+        self.queued_at = time.perf_counter()
+        self.waiters = [waiter]  # Futures resolved with whether the reply was delivered
+
+
+class ReplySender:
+    """Delivers replies through one queue per channel.
+
+    Each channel sends one message at a time, paced by a token bucket that
+    matches Discord's per-channel limit, so busy channels queue locally
+    instead of running into 429s. Replies are split at markdown and sentence
+    boundaries. When a channel falls behind, the reply to the freshest
+    message goes first, queued replies to the same message are combined
+    into as few messages as possible, and replies whose triggering message
+    is older than `max_age` seconds (or that no longer fit in the queue) are
+    dropped. `on_delivered(wait_seconds, send_seconds)` and
+    `on_dropped(reason)` are called for each reply.
+    """
+
+    def __init__(self, limit=2000, max_age=300.0, max_queued=20, channel_rate=1.0, channel_burst=5,
+                 on_delivered=None, on_dropped=None):
+        self.limit = limit  # Longest message Discord accepts
+        self.max_age = max_age  # Replies to messages older than this are dropped
+        self.max_queued = max_queued  # Replies waiting per channel before the stalest is dropped
+        self.channel_rate = channel_rate  # Messages per second per channel
+        self.channel_burst = channel_burst  # Messages a quiet channel may send at once
+        self.on_delivered = on_delivered
+        self.on_dropped = on_dropped
+        self.queues = {}  # {channel_id: [OutboundReply]}
+        self.buckets = {}  # {channel_id: TokenBucket}
+        self.workers = {}  # {channel_id: asyncio.Task}
+        self.pending_parts = 0  # Messages queued or being sent
+        self.delivered = 0
+        self.dropped = 0
+        self.combined = 0  # Replies folded into an earlier reply to the same message
+
+    def queue_depth(self):
+        """Return how many messages are waiting to be sent"""
+        return self.pending_parts
+
+    async def send(self, channel_id, target, text, created):
+        """Queue `text` as a reply to `target` and wait until it is sent or dropped.
+
+        `created` is when the triggering message was sent (seconds since the
+        epoch). Returns whether the reply was delivered.
+        """
+        parts = split_message(text, self.limit)
+        if not parts:
+            return False
+        done = asyncio.get_running_loop().create_future()
+        queue = self.queues.setdefault(channel_id, [])
+        queue.append(OutboundReply(target, parts, created, done))
+        self.pending_parts += len(parts)
+        if len(queue) > self.max_queued:
+            self.drop(queue, min(queue, key=lambda reply: reply.created), 'queue_full')
+        if channel_id not in self.workers:
+            self.workers[channel_id] = asyncio.get_running_loop().create_task(self.run_channel(channel_id))
+        return await asyncio.shield(done)
+
+    def drop(self, queue, reply, reason):
+        queue.remove(reply)
+        self.pending_parts -= len(reply.parts)
+        self.finish(reply, False)
+        self.dropped += 1
+        if self.on_dropped is not None:
+            self.on_dropped(reason)
+
+    def finish(self, reply, delivered):
+        for waiter in reply.waiters:
+            if not waiter.done():
+                waiter.set_result(delivered)
+
+    def next_reply(self, queue):
+        """Drop stale replies, then take the freshest one, combined with anything else queued for the same message"""
+        now = time.time()
+        for reply in [reply for reply in queue if now - reply.created > self.max_age]:
+            self.drop(queue, reply, 'stale')
+        if not queue:
+            return None
+
+        reply = max(queue, key=lambda reply: reply.created)
+        queue.remove(reply)
+        for other in [other for other in queue if other.target is reply.target]:
+            queue.remove(other)
+            merged = split_message('\n\n'.join(reply.parts + other.parts), self.limit)
+            self.pending_parts += len(merged) - len(reply.parts) - len(other.parts)
+            reply.parts = merged
+            reply.waiters.extend(other.waiters)
+            reply.queued_at = min(reply.queued_at, other.queued_at)
+            self.combined += 1
+        return reply
+
+    async def run_channel(self, channel_id):
+        queue = self.queues[channel_id]
+        bucket = self.buckets.get(channel_id)
+        if bucket is None:
+            bucket = self.buckets[channel_id] = TokenBucket(self.channel_rate, self.channel_burst)
+        try:
+            while queue:
+                reply = self.next_reply(queue)
+                if reply is None:
+                    break
+                wait_seconds = time.perf_counter() - reply.queued_at
+                send_seconds = 0.0
+                delivered = False
+                try:
+                    while reply.parts:
+                        delay = bucket.reserve()
+                        if delay:
+                            await asyncio.sleep(delay)
+                        started = time.perf_counter()
+                        await reply.target.reply(reply.parts[0])
+                        send_seconds += time.perf_counter() - started
+                        reply.parts.pop(0)
+                        self.pending_parts -= 1
+                    delivered = True
+                except Exception as e:
+                    print(f"Error sending reply in channel {channel_id}: {e}")
+                    delivered = False
+                finally:
+                    self.pending_parts -= len(reply.parts)
+                    self.finish(reply, delivered)
+
+                if delivered:
+                    self.delivered += 1
+                    if self.on_delivered is not None:
+                        self.on_delivered(wait_seconds, send_seconds)
+                else:
+                    self.dropped += 1
+                    if self.on_dropped is not None:
+                        self.on_dropped('error')
+        finally:
+            del self.workers[channel_id]
+            if not queue:
+                del self.queues[channel_id]
+            if bucket.is_full():
+                # A quiet channel starts from a full bucket anyway
+                del self.buckets[channel_id]
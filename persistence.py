@@ -0,0 +1,109 @@
+import asyncio
+import os
+import threading
+
+from metrics import REGISTRY
+
+WRITE_SECONDS = REGISTRY.histogram('bot_persist_write_seconds', 'Time spent writing state to disk', labels=('job',))
+WRITE_ERRORS = REGISTRY.counter('bot_persist_write_errors_total', 'Failed state writes', labels=('job',))
+
+
+def atomic_write(path, write_fn, mode='w'):
+    """Write a file via a temp file and rename so readers never see a partial file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode) as f:
+        write_fn(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class BackgroundWriter:
+    """Coalesces "dirty" notifications into batched writes off the event loop.
+
+    Each job is registered with a snapshot function and a write function. The
+    snapshot runs on the event loop thread and should only copy the state it
+    needs; the write receives that copy and runs in a worker thread. Marking a
+    job dirty several times before the writer wakes results in a single write.
+    """
+
+    def __init__(self, delay=2.0):
+        self.delay = delay  # Seconds to wait for more changes before writing
+        self.jobs = {}  # {name: (snapshot_fn, write_fn)}
+        self.dirty = set()
+        self._wakeup = None
+        self._task = None
+        self._write_lock = threading.Lock()
+
+    def register(self, name, snapshot_fn, write_fn):
+        """Register a persistence job"""
+        self.jobs[name] = (snapshot_fn, write_fn)
+
+    def mark_dirty(self, name):
+        """Schedule a job to be written on the next pass"""
+        self.dirty.add(name)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        """Start the background writer task on the running event loop"""
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        if self.dirty:
+            self._wakeup.set()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _take_snapshots(self):
+        """Capture payloads for every dirty job and clear the dirty set"""
+        names, self.dirty = self.dirty, set()
+        snapshots = []
+        for name in names:
+            if name not in self.jobs:
+                continue
+            try:
+                snapshots.append((name, self.jobs[name][0]()))
+            except Exception as e:
+                # Keep the writer alive and try this job again on the next pass
+                WRITE_ERRORS.inc(name)
+                print(f"Error snapshotting {name}: {e}")
+                self.mark_dirty(name)
+        return snapshots
+
+    def _write(self, snapshots):
+        with self._write_lock:
+            for name, payload in snapshots:
+                try:
+                    with WRITE_SECONDS.time(name):
+                        self.jobs[name][1](payload)
+                except Exception as e:
+                    WRITE_ERRORS.inc(name)
+                    print(f"Error writing {name}: {e}")
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Let bursts of changes accumulate into one write
+            await asyncio.sleep(self.delay)
+            self._wakeup.clear()
+            snapshots = self._take_snapshots()
+            if snapshots:
+                await asyncio.to_thread(self._write, snapshots)
+
+    async def stop(self):
+        """Stop the background task and write anything still pending"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+        snapshots = self._take_snapshots()
+        if snapshots:
+            await asyncio.to_thread(self._write, snapshots)
+
+    def flush(self):
+        """Synchronously write all pending jobs (used at shutdown)"""
+        self._write(self._take_snapshots())
@@ -0,0 +1,49 @@
+import hashlib
+
+from tokenizer import count_message_tokens
+
+
+class CompiledPrompt:
+    """A system prompt prepared once and reused for every completion.
+
+    The system message dict is built once and shared by every request, so the
+    start of each request is byte-for-byte identical and providers that cache
+    prompt prefixes can reuse it. The token count and a short digest (used in
+    response cache keys instead of the full text) are computed up front.
+    """
+    __slots__ = ('text', 'tokens', 'digest', 'message')
+
+    def __init__(self, text, cache_control=False):
+        self.text = text
+        self.tokens = count_message_tokens(text)
+        self.digest = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+        if cache_control:
+            # Explicit cache breakpoint for providers that only cache marked content (e.g. Anthropic)
+            content = [{'type': 'text', 'text': text, 'cache_control': {'type': 'ephemeral'}}]
+        else:
+            content = text
+        self.message = {'role': 'system', 'content': content}
+
+
+class PromptUsage:
+    """Prompt token usage reported by the provider for one guild's completions"""
+    __slots__ = ('requests', 'prompt_tokens', 'cached_tokens', 'completion_tokens')
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0  # Prompt tokens the provider served from its prompt cache
+        self.completion_tokens = 0
+
+    def record(self, usage):
+        """Add a completion's `usage` object (OpenAI format), returning its cached prompt tokens"""
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = getattr(details, 'cached_tokens', None) or 0
+        self.requests += 1
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.cached_tokens += cached
+        self.completion_tokens += usage.completion_tokens or 0
+        return cached
+
+    def cached_rate(self):
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
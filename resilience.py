@@ -0,0 +1,220 @@
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed instead of being sent upstream"""
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason  # 'circuit_open', 'queue_full', 'guild_rate' or 'key_rate'
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `burst`.
+
+    Callers reserve a token and are told how long to wait for it, so waiting
+    requests are served in arrival order instead of racing for refills.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, max_wait=None):
+        """Take a token, returning seconds to wait before using it, or None if that exceeds max_wait"""
+        now = time.monotonic()
+        self.refill(now)
+        wait = max(0.0, (1 - self.tokens) / self.rate, self.paused_until - now)
+        if max_wait is not None and wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+    def pause(self, seconds):
+        """Hold off every request for a while (e.g. after a 429 with Retry-After)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def is_full(self):
+        self.refill(time.monotonic())
+        return self.tokens >= self.burst and self.paused_until <= time.monotonic()
+
+
+class CircuitBreaker:
+    """Stops sending requests after repeated upstream failures.
+
+    After `failure_threshold` consecutive failures the circuit opens and every
+    request is rejected for `reset_timeout` seconds. Then a single trial
+    request is let through: success closes the circuit, failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def allow(self):
+        """Return whether a request may be sent now"""
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def abandon(self):
+        """Forget a request that ended without a result (e.g. cancelled)"""
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_running or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.trial_running:
+                print(f"Circuit opened after {self.failures} upstream failures; pausing requests for {self.reset_timeout:.0f}s")
+            self.opened_at = time.monotonic()
+        self.trial_running = False
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (seconds or an HTTP date) into seconds, or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestGuard:
+    """Admission control and retries for upstream AI requests.
+
+    `admit(guild_id)` checks the circuit breaker, bounds how many requests may
+    be waiting or running, and applies the per-guild token bucket; requests
+    that cannot be admitted raise Overloaded immediately rather than piling
+    up. `call(fn)` then runs a request under the shared API key bucket
+    (shedding it if the wait would be longer than the longest backoff),
+    retrying transient failures with jittered exponential backoff that
+    honours Retry-After. `classify(error)` maps an exception to
+    (retryable, counts_as_outage, retry_after seconds or None).
+    """
+
+    def __init__(self, classify, key_rate=10.0, key_burst=20, guild_rate=0.5, guild_burst=5,
+                 guild_max_wait=5.0, max_pending=256, max_retries=2, retry_base_delay=0.5,
+                 retry_max_delay=8.0, breaker=None, on_retry=None):
+        self.classify = classify
+        self.key_bucket = TokenBucket(key_rate, key_burst) if key_rate > 0 else None
+        self.guild_rate = guild_rate  # Requests per second per guild (0 disables the guild limit)
+        self.guild_burst = guild_burst
+        self.guild_max_wait = guild_max_wait  # Longest a guild's request may wait for its bucket before being shed
+        self.guild_buckets = {}  # {guild_id: TokenBucket}
+        self.max_pending = max_pending  # Requests waiting or running before new ones are shed
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay  # Longest backoff; a longer Retry-After gives up instead
+        self.breaker = breaker or CircuitBreaker()
+        self.on_retry = on_retry  # Optional callable(error) run before each retry
+        self.pending = 0
+
+    def guild_bucket(self, guild_id):
+        bucket = self.guild_buckets.get(guild_id)
+        if bucket is None:
+            if len(self.guild_buckets) >= 10000:
+                # Forget guilds that have been idle long enough to refill
+                self.guild_buckets = {key: value for key, value in self.guild_buckets.items() if not value.is_full()}
+            bucket = self.guild_buckets[guild_id] = TokenBucket(self.guild_rate, self.guild_burst)
+        return bucket
+
+    @asynccontextmanager
+    async def admit(self, guild_id=None):
+        """Admit a request for a guild (None skips the guild limit), or raise Overloaded"""
+        if self.breaker.state == 'open':
+            raise Overloaded('circuit_open')
+        if self.pending >= self.max_pending:
+            raise Overloaded('queue_full')
+        wait = 0.0
+        if guild_id is not None and self.guild_rate > 0:
+            wait = self.guild_bucket(guild_id).reserve(self.guild_max_wait)
+            if wait is None:
+                raise Overloaded('guild_rate')
+
+        self.pending += 1
+        try:
+            if wait:
+                await asyncio.sleep(wait)
+            yield
+        finally:
+            self.pending -= 1
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait before retry number `attempt` (full jitter, at least Retry-After)"""
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after + random.uniform(0, self.retry_base_delay))
+        return delay
+
+    async def call(self, fn):
+        """Await `fn()` with rate limiting, retries and circuit breaking"""
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise Overloaded('circuit_open')
+            try:
+                if self.key_bucket is not None:
+                    wait = self.key_bucket.reserve(self.retry_max_delay)
+                    if wait is None:
+                        raise Overloaded('key_rate')
+                    await asyncio.sleep(wait)
+                result = await fn()
+            except (Overloaded, asyncio.CancelledError):
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                retryable, outage, retry_after = self.classify(e)
+                if outage:
+                    self.breaker.record_failure()
+                else:
+                    # The upstream answered, so it is not down
+                    self.breaker.record_success()
+                if retry_after is not None and self.key_bucket is not None:
+                    # Everyone shares the key's limit, so everyone backs off
+                    self.key_bucket.pause(retry_after)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                if retry_after is not None and retry_after > self.retry_max_delay:
+                    raise
+                if self.on_retry is not None:
+                    self.on_retry(e)
+                await asyncio.sleep(self.backoff(attempt, retry_after))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
@@ -0,0 +1,48 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Size-bounded LRU cache of AI completions with a time-to-live.
+
+    Keys hash the full messages list together with the model parameters, so a
+    hit only happens when the exact same prompt would be sent again.
+    """
+
+    def __init__(self, max_entries=1000, ttl=600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl  # Seconds a cached completion stays valid
+        self.entries = OrderedDict()  # {key: (expires_at, response)}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(messages, **params):
+        """Hash a request's messages and model parameters into a cache key"""
+        payload = json.dumps({'messages': messages, 'params': params}, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for a key, or None"""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, response):
+        """Cache a response, evicting the least recently used entries past the size limit"""
+        self.entries[key] = (time.monotonic() + self.ttl, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
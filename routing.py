@@ -0,0 +1,148 @@
+import time
+
+from tokenizer import CHARS_PER_TOKEN, MESSAGE_TOKEN_OVERHEAD
+
+
+class ChatProvider:
+    """Sends chat completion requests for a model.
+
+    The bot only talks to the AI through a provider, so a fake one can be
+    swapped in to exercise routing without a network. `create` takes the
+    OpenAI chat completion arguments and returns an OpenAI-style completion
+    (or stream when stream=True).
+    """
+
+    def __init__(self, client, extra_headers=None, timeout=None):
+        self.client = client  # openai.AsyncOpenAI
+        self.extra_headers = extra_headers or {}
+        self.timeout = timeout
+
+    async def create(self, **kwargs):
+        return await self.client.chat.completions.create(extra_headers=self.extra_headers, timeout=self.timeout, **kwargs)
+
+
+class ModelStats:
+    """Recent latency and running cost of one model"""
+    __slots__ = ('requests', 'errors', 'latency', 'updated', 'prompt_tokens', 'completion_tokens', 'cost')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = None  # Exponentially weighted moving average, in seconds
+        self.updated = 0.0  # time.monotonic() of the last latency sample
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0  # USD, from the configured prices
+
+
+def parse_model_prices(value):
+    """Parse 'model=input:output,...' (USD per million tokens) into {model: (input, output)}"""
+    prices = {}
+    for entry in value.split(','):
+        if '=' not in entry:
+            continue
+        model, price = entry.strip().split('=', 1)
+        input_price, output_price = price.split(':', 1)
+        prices[model] = (float(input_price), float(output_price))
+    return prices
+
+
+def estimate_prompt_tokens(messages, system_tokens):
+    """Cheaply estimate a request's prompt tokens from message lengths.
+
+    The first message is the precompiled system prompt, whose exact count is
+    passed in; the rest are estimated from their length, which is plenty for
+    choosing a model.
+    """
+    return system_tokens + sum(len(message['content']) // CHARS_PER_TOKEN + MESSAGE_TOKEN_OVERHEAD for message in messages[1:])
+
+
+class ModelRouter:
+    """Picks a model for each request from a small and a large tier.
+
+    In 'auto' mode prompts estimated at up to `large_tokens` go to the small
+    model and bigger ones to the large model. 'small' and 'large' pin a tier.
+    Whatever the mode, when the upstream is busy (`busy_fn()` returns True)
+    or the chosen model's recent latency exceeds `slow_seconds`, the request
+    falls back to whichever model is currently fastest, cheapest first on a
+    tie. Latency and cost are recorded per model from every request. A
+    model's latency is forgotten after `stale_seconds` without requests, so a
+    model avoided for being slow is tried again once things have settled.
+    """
+
+    MODES = ('auto', 'small', 'large')
+
+    def __init__(self, small_model, large_model, large_tokens=1200, slow_seconds=10.0,
+                 busy_fn=None, prices=None, latency_weight=0.2, stale_seconds=60.0):
+        self.small_model = small_model
+        self.large_model = large_model or small_model
+        self.large_tokens = large_tokens  # Estimated prompt tokens above which 'auto' uses the large model
+        self.slow_seconds = slow_seconds  # Recent latency above which a model is avoided
+        self.busy_fn = busy_fn
+        self.prices = prices or {}  # {model: (USD per million input tokens, USD per million output tokens)}
+        self.latency_weight = latency_weight  # Weight of the newest sample in the latency average
+        self.stale_seconds = stale_seconds  # Age after which a model's latency is no longer trusted
+        self.stats = {model: ModelStats() for model in dict.fromkeys((self.small_model, self.large_model))}
+        self.fallbacks = 0
+
+    def latency(self, model, now=None):
+        """Return a model's recent latency, or None if unmeasured or stale"""
+        stats = self.stats.get(model)
+        if stats is None or stats.latency is None:
+            return None
+        if (now or time.monotonic()) - stats.updated > self.stale_seconds:
+            return None
+        return stats.latency
+
+    def fastest_model(self, now=None):
+        """Return the model with the lowest recent latency (unmeasured models count as fast)"""
+        def rank(model):
+            input_price, output_price = self.prices.get(model, (0.0, 0.0))
+            return (self.latency(model, now) or 0.0, input_price + output_price)
+        return min(self.stats, key=rank)
+
+    def choose(self, prompt_tokens, mode='auto'):
+        """Pick the model for a request with about `prompt_tokens` prompt tokens"""
+        if mode == 'large' or (mode == 'auto' and prompt_tokens > self.large_tokens):
+            model = self.large_model
+        else:
+            model = self.small_model
+
+        now = time.monotonic()
+        latency = self.latency(model, now)
+        if (self.busy_fn is not None and self.busy_fn()) or (latency is not None and latency > self.slow_seconds):
+            fastest = self.fastest_model(now)
+            if fastest != model:
+                self.fallbacks += 1
+                model = fastest
+        return model
+
+    def model_stats(self, model):
+        stats = self.stats.get(model)
+        if stats is None:
+            stats = self.stats[model] = ModelStats()
+        return stats
+
+    def record(self, model, seconds, failed=False):
+        """Record how long a request to a model took (failed requests count too: timeouts are slowness)"""
+        stats = self.model_stats(model)
+        stats.requests += 1
+        if failed:
+            stats.errors += 1
+        if self.latency(model) is None:
+            stats.latency = seconds
+        else:
+            stats.latency = self.latency_weight * seconds + (1 - self.latency_weight) * stats.latency
+        stats.updated = time.monotonic()
+
+    def record_usage(self, model, usage):
+        """Add a completion's `usage` object (OpenAI format) to a model's cost"""
+        if usage is None:
+            return
+        stats = self.model_stats(model)
+        prompt_tokens = usage.prompt_tokens or 0
+        completion_tokens = usage.completion_tokens or 0
+        stats.prompt_tokens += prompt_tokens
+        stats.completion_tokens += completion_tokens
+        input_price, output_price = self.prices.get(model, (0.0, 0.0))
+        stats.cost += (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
@@ -0,0 +1,121 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from persistence import atomic_write
+
+try:
+    import fcntl
+except ImportError:  # Windows: only one process may use a FileStateStore
+    fcntl = None
+
+
+class StateStore:
+    """Small keyed state (personalities, guild settings, summaries) shared by every bot process.
+
+    State is grouped into namespaces, each a {key: JSON value} mapping. Writes
+    only carry the keys that changed, so processes serving different shards
+    never overwrite each other's entries. A value of None deletes the key.
+    """
+
+    def load(self, namespace):
+        """Return every {key: value} in a namespace"""
+        raise NotImplementedError
+
+    def update(self, namespace, changes):
+        """Apply {key: value or None} to a namespace (runs on the writer thread)"""
+        raise NotImplementedError
+
+
+class FileStateStore(StateStore):
+    """Keeps each namespace in `<namespace>.json`, merged under a file lock"""
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+
+    def path(self, namespace):
+        return os.path.join(self.directory, f'{namespace}.json')
+
+    @contextmanager
+    def locked(self, namespace):
+        """Hold an exclusive lock on a namespace across processes"""
+        if fcntl is None:
+            yield
+            return
+        with open(f'{self.path(namespace)}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self, namespace):
+        path = self.path(namespace)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def load(self, namespace):
+        with self.locked(namespace):
+            return self.read(namespace)
+
+    def update(self, namespace, changes):
+        with self.locked(namespace):
+            # Re-read so entries written by other processes are kept
+            state = self.read(namespace)
+            for key, value in changes.items():
+                if value is None:
+                    state.pop(key, None)
+                else:
+                    state[key] = value
+            atomic_write(self.path(namespace), lambda f: json.dump(state, f, indent=2))
+
+
+class SqliteStateStore(StateStore):
+    """Keeps every namespace in one SQLite table, safe for many processes on one host"""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+        self.conn.commit()
+
+    def load(self, namespace):
+        with self.lock:
+            rows = self.conn.execute('SELECT key, value FROM state WHERE namespace = ?', (namespace,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def update(self, namespace, changes):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM state WHERE namespace = ? AND key = ?',
+                [(namespace, key) for key, value in changes.items() if value is None]
+            )
+            self.conn.executemany(
+                'INSERT INTO state (namespace, key, value) VALUES (?, ?, ?) '
+                'ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value',
+                [(namespace, key, json.dumps(value)) for key, value in changes.items() if value is not None]
+            )
+
+    def import_files(self, file_store, namespaces):
+        """Copy namespaces saved by a FileStateStore into an empty database"""
+        for namespace in namespaces:
+            if self.load(namespace):
+                continue
+            state = file_store.load(namespace)
+            if state:
+                self.update(namespace, state)
+                print(f"Imported {len(state)} {namespace} entries into {self.db_file}")
@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+
+class RollingSummarizer:
+    """Folds messages evicted from channel memory into a compact per-channel summary.
+
+    Evicted messages are queued per channel and summarized in batches by a
+    background task, so the AI is called once per batch rather than once per
+    message. A channel is summarized once `batch_size` messages are queued or
+    its oldest queued message has waited `delay` seconds; each channel keeps
+    its own clock, so a busy channel never holds back the others. `summarize_fn(previous_summary, messages)` is an async callable
+    returning the updated summary text. Summaries are kept in the 'summaries'
+    namespace of a state_store.StateStore.
+    """
+
+    def __init__(self, writer, summarize_fn, store, batch_size=20, delay=60.0):
+        self.writer = writer  # persistence.BackgroundWriter used to save summaries
+        self.summarize_fn = summarize_fn
+        self.store = store
+        self.batch_size = batch_size  # Evicted messages that trigger a summary right away
+        self.delay = delay  # Seconds a channel waits for more evictions before summarizing a smaller batch
+        self.max_pending = batch_size * 5  # Oldest queued messages are dropped past this
+
+        self.summaries = {}  # {channel_id: summary text}
+        self.changed = set()  # Channels whose summary changed since the last write
+        self.pending = {}  # {channel_id: [MessageMemory]}
+        self.pending_since = {}  # {channel_id: time.monotonic() when its oldest queued message arrived}
+        self._wakeup = None
+        self._task = None
+
+        writer.register('summaries', self.snapshot, self.write)
+
+    def load(self):
+        """Load saved summaries from the state store"""
+        try:
+            self.summaries = {int(channel_id): summary for channel_id, summary in self.store.load('summaries').items()}
+            print(f"Loaded conversation summaries for {len(self.summaries)} channels")
+        except Exception as e:
+            print(f"Error loading summaries: {e}")
+
+    def snapshot(self):
+        changes = {str(channel_id): self.summaries.get(channel_id) for channel_id in self.changed}
+        self.changed = set()
+        return changes
+
+    def write(self, changes):
+        """Save changed summaries (runs on the writer thread)"""
+        self.store.update('summaries', changes)
+
+    def start(self):
+        """Start the background summarization task on the running event loop"""
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        if self.pending:
+            self._wakeup.set()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def add_evicted(self, channel_id, memory):
+        """Queue a message that dropped out of channel memory"""
+        queue = self.pending.setdefault(channel_id, [])
+        if not queue:
+            self.pending_since[channel_id] = time.monotonic()
+        queue.append(memory)
+        if len(queue) > self.max_pending:
+            del queue[:len(queue) - self.max_pending]
+        if self._wakeup is not None and (len(queue) == 1 or len(queue) >= self.batch_size):
+            # A new deadline or a full batch; other evictions change nothing the task waits on
+            self._wakeup.set()
+
+    def get(self, channel_id):
+        """Return the summary for a channel, or None"""
+        return self.summaries.get(channel_id)
+
+    def clear(self, channel_id):
+        """Forget a channel's summary and queued messages"""
+        self.pending.pop(channel_id, None)
+        self.pending_since.pop(channel_id, None)
+        if self.summaries.pop(channel_id, None) is not None:
+            self.changed.add(channel_id)
+            self.writer.mark_dirty('summaries')
+
+    async def summarize_channel(self, channel_id):
+        messages = self.pending.pop(channel_id, None)
+        self.pending_since.pop(channel_id, None)
+        if not messages:
+            return
+        try:
+            summary = await self.summarize_fn(self.summaries.get(channel_id), messages)
+        except Exception as e:
+            print(f"Error summarizing channel {channel_id}: {e}")
+            # Put the batch back so it is retried with the next one
+            queue = messages + self.pending.get(channel_id, [])
+            self.pending[channel_id] = queue[-self.max_pending:]
+            self.pending_since[channel_id] = time.monotonic()
+            return
+        if summary:
+            self.summaries[channel_id] = summary
+            self.changed.add(channel_id)
+            self.writer.mark_dirty('summaries')
+
+    def due_channels(self, now):
+        """Return channels with a full batch or whose oldest queued message has waited `delay`"""
+        return [channel_id for channel_id, queue in self.pending.items()
+                if len(queue) >= self.batch_size or now - self.pending_since[channel_id] >= self.delay]
+
+    async def _run(self):
+        while True:
+            # Summarize one channel at a time to keep AI usage bounded
+            for channel_id in self.due_channels(time.monotonic()):
+                await self.summarize_channel(channel_id)
+
+            # Sleep until the next channel is due or an eviction starts a deadline or fills a batch
+            timeout = None
+            if self.pending_since:
+                timeout = max(0.0, min(self.pending_since.values()) + self.delay - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+class Clock:
+    """Stands in for time.monotonic, advanced by hand"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    """Route the bot's completions to a FakeProvider with fresh guard and router state"""
+    import bot
+    from fake_provider import FakeProvider
+    from resilience import CircuitBreaker, RequestGuard
+    from routing import ModelRouter
+    provider = FakeProvider()
+    monkeypatch.setattr(bot, 'ai_provider', provider)
+    monkeypatch.setattr(bot, 'response_cache', None)
+    monkeypatch.setattr(bot, 'ai_guard', RequestGuard(
+        bot.classify_ai_error, key_rate=0, guild_rate=0, max_retries=2, retry_base_delay=0,
+        breaker=CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    ))
+    monkeypatch.setattr(bot, 'model_router', ModelRouter('small', 'large', large_tokens=2000, slow_seconds=5))
+    return provider
+
+
+@pytest.fixture
+def bot_state(tmp_path, monkeypatch):
+    """Return a function that points the bot's memory, ingestion and recording at empty state in a new directory"""
+    import bot
+    from dump_format import MessageRecorder
+    from ingest import MessageIngestor
+    from memory_store import JsonMemoryBackend
+    from persistence import BackgroundWriter
+
+    def use(name='state'):
+        directory = tmp_path / name
+        directory.mkdir()
+        monkeypatch.chdir(directory)
+        writer = BackgroundWriter(delay=0)
+        backend = JsonMemoryBackend(writer, bot.MAX_MEMORY_MESSAGES, bot.MEMORY_EXPIRY_HOURS,
+                                    'memories.snapshot.jsonl', 'memories.journal.jsonl')
+        recorder = MessageRecorder(writer, str(directory / 'recorded.dump'))
+        monkeypatch.setattr(bot, 'persistence_writer', writer)
+        monkeypatch.setattr(bot, 'memory_backend', backend)
+        monkeypatch.setattr(bot, 'message_recorder', recorder)
+        monkeypatch.setattr(bot, 'message_ingestor', MessageIngestor(backend, on_commit=bot.observed_messages_committed))
+        return recorder
+    return use
@@ -0,0 +1,42 @@
+import asyncio
+from types import SimpleNamespace
+
+from routing import ChatProvider
+
+
+def completion(text, prompt_tokens=10, completion_tokens=5):
+    """An OpenAI-style chat completion carrying `text`"""
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+        usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, prompt_tokens_details=None),
+    )
+
+
+class FakeProvider(ChatProvider):
+    """Answers completion requests from a script instead of the network.
+
+    `outcomes` is a list consumed one per request: an exception instance is
+    raised, anything else is returned as the completion's text. Once the
+    script runs out every request gets `default`. `latency` maps a model to
+    seconds to wait before answering.
+    """
+
+    def __init__(self, outcomes=(), default='ok', latency=None):
+        super().__init__(client=None)
+        self.outcomes = list(outcomes)
+        self.default = default
+        self.latency = latency or {}
+        self.requests = []  # kwargs of every request, in order
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        delay = self.latency.get(kwargs.get('model'), 0)
+        if delay:
+            await asyncio.sleep(delay)
+        outcome = self.outcomes.pop(0) if self.outcomes else self.default
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return completion(outcome)
+
+    def models(self):
+        return [request['model'] for request in self.requests]
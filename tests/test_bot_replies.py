@@ -0,0 +1,62 @@
+import asyncio
+
+import httpx
+import openai
+
+import bot
+
+
+def status_error(status, retry_after=None):
+    request = httpx.Request('POST', 'https://openrouter.invalid/chat/completions')
+    headers = {'retry-after': str(retry_after)} if retry_after is not None else {}
+    response = httpx.Response(status, request=request, headers=headers)
+    error_class = openai.RateLimitError if status == 429 else openai.InternalServerError
+    return error_class(f'status {status}', response=response, body=None)
+
+
+def reply(content, guild_id=1):
+    return asyncio.run(bot.generate_ai_response(content, 'tester', guild_id))
+
+
+def test_reply_comes_from_the_provider(provider):
+    provider.outcomes = ['  hi there  ']
+    assert reply('hello') == 'hi there'
+    assert provider.models() == ['small']
+    assert provider.requests[0]['messages'][-1] == {'role': 'user', 'content': 'tester: hello'}
+
+
+def test_long_prompts_use_the_large_model(provider):
+    reply('word ' * 3000)
+    assert provider.models() == ['large']
+
+
+def test_transient_errors_are_retried(provider):
+    provider.outcomes = [status_error(500), status_error(429, retry_after=0), 'recovered']
+    assert reply('hello') == 'recovered'
+    assert len(provider.requests) == 3
+
+
+def test_outages_open_the_circuit_and_shed_replies(provider):
+    provider.outcomes = [status_error(503)] * 3
+    assert reply('hello').startswith('❌')
+    assert bot.ai_guard.breaker.state == 'open'
+    requests = len(provider.requests)
+    assert reply('hello again') == bot.OVERLOADED_REPLY
+    assert len(provider.requests) == requests
+
+
+def test_slow_model_fails_over(provider):
+    bot.model_router.record('large', 30)
+    reply('word ' * 3000)
+    assert provider.models() == ['small']
+
+
+def test_missing_provider_explains_the_setup(monkeypatch):
+    monkeypatch.setattr(bot, 'ai_provider', None)
+    assert 'OPENROUTER_API_KEY' in reply('hello')
+
+
+def test_coalesced_mentions_are_answered_by_one_request(provider):
+    asyncio.run(bot.generate_ai_response('and me?', 'carol', 1, None, [('alice', 'hi'), ('bob', 'hello')]))
+    assert len(provider.requests) == 1
+    assert [m['content'] for m in provider.requests[0]['messages'][-3:]] == ['alice: hi', 'bob: hello', 'carol: and me?']
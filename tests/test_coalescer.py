@@ -0,0 +1,79 @@
+import asyncio
+
+from coalescer import MentionCoalescer
+
+
+class Recorder:
+    """Handler that records each batch and how many ran at once"""
+    def __init__(self, delay=0.0, fail=False):
+        self.batches = []  # (channel_id, items)
+        self.delay = delay
+        self.fail = fail
+        self.running = 0
+        self.most_running = 0
+
+    async def __call__(self, channel_id, items):
+        self.batches.append((channel_id, list(items)))
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.fail:
+                raise RuntimeError('handler failed')
+        finally:
+            self.running -= 1
+
+
+def submit_all(coalescer, mentions):
+    """Submit (channel_id, guild_id, item) mentions at once and return what each submit returned"""
+    async def scenario():
+        return await asyncio.gather(*(coalescer.submit(*mention) for mention in mentions))
+    return asyncio.run(scenario())
+
+
+def test_burst_in_one_channel_is_one_request():
+    handler = Recorder()
+    coalescer = MentionCoalescer(handler, window=0.05)
+    accepted = submit_all(coalescer, [(1, 10, 'a'), (1, 10, 'b'), (1, 10, 'c')])
+    assert accepted == [True, True, True]
+    assert handler.batches == [(1, ['a', 'b', 'c'])]
+    assert coalescer.queue_depth() == 0
+
+
+def test_channels_are_batched_separately():
+    handler = Recorder()
+    coalescer = MentionCoalescer(handler, window=0.05)
+    submit_all(coalescer, [(1, 10, 'a'), (2, 10, 'x'), (1, 10, 'b'), (2, 10, 'y')])
+    assert sorted(handler.batches) == [(1, ['a', 'b']), (2, ['x', 'y'])]
+
+
+def test_full_batches_close_early_and_a_channel_runs_one_at_a_time():
+    handler = Recorder(delay=0.01)
+    coalescer = MentionCoalescer(handler, window=10, max_batch=2, max_pending=10)
+    submit_all(coalescer, [(1, 10, item) for item in 'abcd'])
+    assert handler.batches == [(1, ['a', 'b']), (1, ['c', 'd'])]
+    assert handler.most_running == 1
+
+
+def test_busy_channel_sheds_new_mentions():
+    handler = Recorder()
+    coalescer = MentionCoalescer(handler, window=0.05, max_pending=2)
+    accepted = submit_all(coalescer, [(1, 10, 'a'), (1, 10, 'b'), (1, 10, 'c'), (2, 10, 'x')])
+    assert accepted == [True, True, False, True]
+    assert sorted(handler.batches) == [(1, ['a', 'b']), (2, ['x'])]
+
+
+def test_guilds_take_turns():
+    handler = Recorder(delay=0.01)
+    coalescer = MentionCoalescer(handler, window=10, max_batch=1, max_concurrent=1)
+    # Guild 10 queues four channels before guild 20's single mention, which
+    # still goes ahead of most of them
+    submit_all(coalescer, [(1, 10, 'a'), (2, 10, 'b'), (3, 10, 'c'), (4, 10, 'd'), (5, 20, 'x')])
+    assert [channel_id for channel_id, _ in handler.batches] == [1, 2, 5, 3, 4]
+
+
+def test_failed_batch_still_releases_its_waiters():
+    handler = Recorder(fail=True)
+    coalescer = MentionCoalescer(handler, window=0.01)
+    assert submit_all(coalescer, [(1, 10, 'a')]) == [True]
+    assert coalescer.running == 0 and coalescer.queue_depth() == 0
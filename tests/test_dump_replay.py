@@ -0,0 +1,55 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+import manage
+from dump_format import DumpWriter, MessageRecorder, channel_record, read_dump
+from memory_store import MessageMemory
+from persistence import BackgroundWriter
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip', 'xz'])
+def test_recording_appends_across_restarts(tmp_path, compression):
+    path = str(tmp_path / 'stream.dump')
+    with DumpWriter(path, compression, codec='json') as dump:
+        dump.write(channel_record(1, [MessageMemory('alice', 1, 'exported', 100.0)]))
+
+    # A restarted bot appends to the same file, keeping the codec its header names
+    for content in ('first run', 'second run'):
+        writer = BackgroundWriter()
+        recorder = MessageRecorder(writer, path, codec='msgpack')
+        recorder.record(1, 5, [MessageMemory('bob', 2, content, 200.0)])
+        writer.flush()
+        recorder.close()
+    records = list(read_dump(path))
+    assert [record['type'] for record in records] == ['channel', 'message', 'message']
+    assert [record['content'] for record in records[1:]] == ['first run', 'second run']
+
+
+def channel_contents(channel_ids):
+    return {channel_id: [(memory.author_name, memory.content, memory.is_bot) for memory in bot.memory_backend.messages(channel_id)]
+            for channel_id in channel_ids}
+
+
+def test_recorded_stream_replays_into_the_same_memory(bot_state):
+    recorder = bot_state('live')
+    now = time.time()
+    # Live traffic: two channels of observed messages and a reply
+    bot.message_ingestor.submit(10, 1, 'alice', 100, 'hello there', now - 3)
+    bot.message_ingestor.submit(20, 1, 'bob', 101, 'other channel', now - 2)
+    bot.message_ingestor.flush_all()
+    bot.add_message_to_memory(10, 'Dingus', 999, 'hi alice', is_bot=True)
+    bot.persistence_writer.flush()
+    recorder.close()
+    live = channel_contents((10, 20))
+
+    events = manage.load_events(recorder.path)
+    assert [event[5] for event in events] == ['hello there', 'other channel', 'hi alice']
+
+    bot_state('replay')
+    results = asyncio.run(manage.replay(SimpleNamespace(speed=0), events))
+    assert (results['user_messages'], results['replies'], results['skipped']) == (2, 1, 0)
+    assert channel_contents((10, 20)) == live
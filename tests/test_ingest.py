@@ -0,0 +1,125 @@
+import asyncio
+import contextlib
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from ingest import MessageIngestor, clean_content
+from memory_store import JsonMemoryBackend
+from persistence import BackgroundWriter
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return JsonMemoryBackend(BackgroundWriter(), 50, 24, str(tmp_path / 'memories.snapshot'), str(tmp_path / 'memories.journal'))
+
+
+def contents(backend, channel_id):
+    return [memory.content for memory in backend.messages(channel_id)]
+
+
+def test_clean_content_skips_commands_and_empty_messages():
+    assert clean_content('  hello  ') == 'hello'
+    assert clean_content('') is None
+    assert clean_content('   ') is None
+    assert clean_content('!chat hi there') is None
+    assert clean_content('x' * 20, max_chars=5) == 'xxxxx…'
+
+
+def test_without_a_running_task_messages_commit_right_away(backend):
+    ingestor = MessageIngestor(backend)
+    ingestor.submit(1, 10, 'alice', 1, 'hello', time.time())
+    assert contents(backend, 1) == ['hello']
+    assert ingestor.buffered == 0
+
+
+def test_buffers_commit_once_per_channel_after_the_interval(backend):
+    commits = []
+    ingestor = MessageIngestor(backend, flush_interval=0.05, on_commit=lambda *args: commits.append(args))
+
+    async def scenario():
+        ingestor.start()
+        for i in range(3):
+            ingestor.submit(1, 10, 'alice', 1, f'one {i}', time.time())
+        ingestor.submit(2, 20, 'bob', 2, 'two', time.time())
+        assert backend.messages(1) == [] and ingestor.buffered == 4
+        await asyncio.sleep(0.1)
+        ingestor._task.cancel()
+    asyncio.run(scenario())
+
+    assert contents(backend, 1) == ['one 0', 'one 1', 'one 2']
+    assert contents(backend, 2) == ['two']
+    assert ingestor.batches == 2 and ingestor.committed == 4
+    assert sorted((guild_id, channel_id, len(memories)) for guild_id, channel_id, memories in commits) == [(10, 1, 3), (20, 2, 1)]
+
+
+def test_full_buffers_commit_early(backend):
+    ingestor = MessageIngestor(backend, flush_interval=60, max_buffered=3)
+
+    async def scenario():
+        ingestor.start()
+        for i in range(3):
+            ingestor.submit(1, 10, 'alice', 1, f'message {i}', time.time())
+        await asyncio.sleep(0.01)
+        ingestor._task.cancel()
+    asyncio.run(scenario())
+    assert len(backend.messages(1)) == 3
+    assert ingestor.buffered == 0
+
+
+def test_flush_and_discard_touch_one_channel(backend):
+    ingestor = MessageIngestor(backend, flush_interval=60)
+    ingestor._task = object()  # Stands in for a running flush task, so submits only buffer
+    ingestor.submit(1, 10, 'alice', 1, 'keep', time.time())
+    ingestor.submit(2, 10, 'bob', 2, 'drop', time.time())
+    ingestor.flush(1)
+    ingestor.discard(2)
+    assert contents(backend, 1) == ['keep']
+    assert backend.messages(2) == []
+    assert ingestor.buffered == 0 and not ingestor.buffers
+
+
+class Message:
+    """Just enough of a discord.Message for on_message and the !chat command"""
+    def __init__(self, content, author, channel_id=60):
+        self.content = content
+        self.author = author
+        self.guild = SimpleNamespace(id=1)
+        self.channel = SimpleNamespace(id=channel_id)
+        self.mentions = []
+        self.created_at = SimpleNamespace(timestamp=time.time)
+        self.replies = []
+
+    async def reply(self, content):
+        self.replies.append(content)
+
+
+def test_chat_command_is_remembered_once(provider, bot_state, monkeypatch):
+    bot_state()
+    me = SimpleNamespace(display_name='Dingus', id=999, bot=True)
+    monkeypatch.setattr(type(bot.bot), 'user', property(lambda self: me))
+    commands_run = []
+
+    async def process_commands(message):
+        commands_run.append(message.content)
+    monkeypatch.setattr(bot.bot, 'process_commands', process_commands)
+    provider.outcomes = ['hello alice']
+
+    alice = SimpleNamespace(display_name='alice', id=1, bot=False)
+    message = Message('!chat hi there', alice)
+    ctx = SimpleNamespace(author=alice, guild=message.guild, channel=message.channel, message=message,
+                          typing=contextlib.nullcontext)
+
+    async def scenario():
+        # on_message leaves the command to store its own messages
+        await bot.on_message(message)
+        assert bot.message_ingestor.buffered == 0
+        await bot.chat_command.callback(ctx, message='hi there')
+    asyncio.run(scenario())
+
+    assert commands_run == ['!chat hi there']
+    assert message.replies == ['hello alice']
+    remembered = [(memory.author_name, memory.content) for memory in bot.memory_backend.messages(60)]
+    assert remembered == [('alice', 'hi there'), ('Dingus', 'hello alice')]
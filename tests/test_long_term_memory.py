@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from long_term_memory import HashingEmbedder, LongTermMemory
+from persistence import BackgroundWriter
+
+
+def make_memory(directory, **kwargs):
+    return LongTermMemory(BackgroundWriter(), HashingEmbedder(64), str(directory), **kwargs)
+
+
+@pytest.fixture
+def saved(tmp_path):
+    """A directory holding guild 1's saved index"""
+    memory = make_memory(tmp_path)
+    memory.add(1, 10, 'alice', 'the deployment pipeline broke on friday', time.time())
+    asyncio.run(memory.index_pending())
+    memory.save()
+    memory.writer.flush()
+    return tmp_path
+
+
+@pytest.fixture
+def load_threads(monkeypatch):
+    """Record which thread each saved index is read on"""
+    threads = []
+    load_index = LongTermMemory.load_index
+
+    def recording_load(self, guild_id):
+        threads.append(threading.current_thread())
+        return load_index(self, guild_id)
+    monkeypatch.setattr(LongTermMemory, 'load_index', recording_load)
+    return threads
+
+
+def test_saved_index_is_read_off_the_event_loop(saved, load_threads):
+    memory = make_memory(saved)
+    results = asyncio.run(memory.search(1, 20, 'what broke the deployment pipeline'))
+    assert [entry[2] for _, entry in results] == ['the deployment pipeline broke on friday']
+    assert load_threads and threading.main_thread() not in load_threads
+
+
+def test_slow_index_read_counts_against_the_budget(saved, monkeypatch):
+    memory = make_memory(saved, budget=0.01)
+    load_index = memory.load_index
+
+    def slow_load(guild_id):
+        time.sleep(0.05)
+        return load_index(guild_id)
+    monkeypatch.setattr(memory, 'load_index', slow_load)
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await memory.search(1, 20, 'deployment pipeline')
+        # The read finishes in the background and the next search uses it
+        await asyncio.sleep(0.1)
+        return await memory.search(1, 20, 'deployment pipeline')
+    assert len(asyncio.run(scenario())) == 1
+
+
+def test_new_messages_extend_the_saved_index_off_the_event_loop(saved, load_threads):
+    memory = make_memory(saved)
+    memory.add(1, 10, 'bob', 'the pipeline is fixed now', time.time())
+    memory.add(2, 30, 'carol', 'a brand new server', time.time())
+    asyncio.run(memory.index_pending())
+    assert len(memory.indexes[1]) == 2
+    assert len(memory.indexes[2]) == 1
+    assert load_threads and threading.main_thread() not in load_threads
+
+
+def test_forget_reads_the_saved_index_off_the_event_loop(saved, load_threads):
+    memory = make_memory(saved)
+    asyncio.run(memory.forget(1, 10))
+    assert load_threads and threading.main_thread() not in load_threads
+    assert asyncio.run(memory.search(1, 20, 'deployment pipeline')) == []
+    assert 1 in memory.changed
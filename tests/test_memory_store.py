@@ -0,0 +1,125 @@
+import json
+import os
+import time
+
+import pytest
+
+from memory_store import JsonMemoryBackend, MessageMemory, SqliteMemoryBackend
+from persistence import BackgroundWriter
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return {
+        'snapshot_file': str(tmp_path / 'memories.snapshot'),
+        'journal_file': str(tmp_path / 'memories.journal'),
+        'legacy_file': str(tmp_path / 'memories.json'),
+    }
+
+
+def make_backend(paths, expiry_hours=24):
+    return JsonMemoryBackend(BackgroundWriter(), 50, expiry_hours, **paths)
+
+
+def message(content, age_hours=0):
+    return MessageMemory('alice', 1, content, time.time() - age_hours * 3600)
+
+
+def compact(backend):
+    backend.save()
+    backend.writer.flush()
+
+
+def test_legacy_migration_indexes_each_channel_once(paths):
+    with open(paths['legacy_file'], 'w') as f:
+        json.dump({'1': [message('a').to_dict()], '2': [message('b').to_dict()]}, f)
+
+    backend = make_backend(paths)
+    backend.load()
+    assert sorted(backend.channel_ids()) == [1, 2]
+    assert backend.channel_count() == 2
+    assert os.path.exists(paths['legacy_file'] + '.migrated')
+
+    # New messages survive a compaction and a reload
+    backend.add(1, message('c'))
+    compact(backend)
+    with open(paths['snapshot_file']) as f:
+        assert len(f.readlines()) == 3
+
+    reloaded = make_backend(paths)
+    reloaded.load()
+    assert [memory.content for memory in reloaded.messages(1)] == ['a', 'c']
+
+
+def test_compaction_forgets_expired_unread_channels(paths):
+    backend = make_backend(paths, expiry_hours=72)
+    backend.add_many(1, [message('old', age_hours=48)])
+    backend.add_many(2, [message('new')])
+    compact(backend)
+
+    # Reopened with a shorter expiry, channel 1 is expired but still unread
+    backend = make_backend(paths)
+    backend.load()
+    assert sorted(backend.channel_ids()) == [1, 2]
+    old_reader = backend.cold[1][0]
+
+    compact(backend)
+    assert backend.channel_ids() == [2]
+    assert backend.channel_count() == 1
+    assert backend.channel_sizes() == [1]
+    # Channels still unread point at the new snapshot rather than the replaced file
+    assert backend.cold[2][0] is not old_reader
+    assert [memory.content for memory in backend.messages(2)] == ['new']
+
+
+@pytest.fixture
+def sqlite_backend(tmp_path):
+    backend = SqliteMemoryBackend(BackgroundWriter(), 50, 24, str(tmp_path / 'memories.db'))
+    backend.load()
+    return backend
+
+
+def commit(backend):
+    backend.write(backend.snapshot())
+
+
+def contents(messages):
+    return [memory.content for memory in messages]
+
+
+def test_sqlite_reads_merge_inflight_and_pending_batches(sqlite_backend):
+    backend = sqlite_backend
+    backend.add_many(1, [message('a'), message('b')])
+    commit(backend)
+    backend.add_many(1, [message('c'), message('d')])
+    inflight = backend.snapshot()  # Taken by the writer, not committed yet
+    backend.add_many(1, [message('e')])
+
+    messages, complete = backend.query_newest(1, 10)
+    assert contents(messages) == ['a', 'b', 'c', 'd', 'e'] and complete
+    # The database alone was a short read, but the merged window overflows the limit
+    messages, complete = backend.query_newest(1, 4)
+    assert contents(messages) == ['b', 'c', 'd', 'e'] and not complete
+
+    # A pending clear hides committed and inflight rows alike
+    backend.clear(1)
+    backend.add_many(1, [message('f')])
+    messages, complete = backend.query_newest(1, 4)
+    assert contents(messages) == ['f'] and complete
+
+    backend.write(inflight)
+    commit(backend)
+    assert contents(backend.query_newest(1, 10)[0]) == ['f']
+
+
+def test_sqlite_cleanup_expires_and_trims_after_the_commit(sqlite_backend):
+    backend = sqlite_backend
+    backend.add_many(1, [message('old', age_hours=48)] + [message(str(i)) for i in range(60)])
+    backend.add_many(2, [message('old', age_hours=48), message('new')])
+    commit(backend)
+    assert contents(backend.query_newest(2, 10)[0]) == ['new']
+
+    backend.cleanup_expired()
+    commit(backend)
+    assert sorted(backend.channel_sizes()) == [1, 50]
+    assert contents(backend.query_newest(1, 50)[0]) == [str(i) for i in range(10, 60)]
@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+import pytest
+
+from outbound import ReplySender, split_message
+
+
+def assert_fits(parts, limit=2000):
+    assert parts
+    assert all(0 < len(part) <= limit for part in parts)
+
+
+def test_short_text_is_one_message():
+    assert split_message('  hello  ') == ['hello']
+
+
+def test_prefers_paragraph_breaks():
+    text = 'a' * 1200 + '\n\n' + 'b' * 1200
+    assert split_message(text) == ['a' * 1200, 'b' * 1200]
+
+
+def test_unbroken_run_is_hard_cut():
+    parts = split_message('x' * 5000)
+    assert_fits(parts)
+    assert ''.join(parts) == 'x' * 5000
+
+
+def test_code_block_is_closed_and_reopened_with_its_language():
+    text = '```py\n' + '\n'.join(f'print({i})' for i in range(400)) + '\n```'
+    parts = split_message(text)
+    assert_fits(parts)
+    assert len(parts) > 1
+    for part in parts:
+        assert part.startswith('```py\n')
+        assert part.endswith('```')
+
+
+def test_long_fence_line_makes_progress():
+    text = 'Here you go:\n```' + 'A' * 1200 + '\nmore code\n' + 'B' * 1500 + '\n```'
+    parts = split_message(text)
+    assert_fits(parts)
+    assert sum(part.count('A') for part in parts) == 1200
+    assert sum(part.count('B') for part in parts) == 1500
+
+
+@pytest.mark.parametrize('fence_length', range(0, 2000, 37))
+def test_any_fence_line_length_makes_progress(fence_length):
+    text = 'Intro.\n```' + 'A' * fence_length + '\ncode\n' + 'B' * 3000 + '\n```\nOutro.'
+    parts = split_message(text)
+    assert_fits(parts)
+    assert sum(part.count('B') for part in parts) == 3000
+
+
+def test_unterminated_fence():
+    text = 'Look:\n```js\n' + 'let x = 1;\n' * 500
+    parts = split_message(text)
+    assert_fits(parts)
+    assert all(part.startswith('```js\n') for part in parts[1:])
+    assert sum(part.count('let x = 1;') for part in parts) == 500
+
+
+def test_nested_fences():
+    inner = '```py\nprint(1)\n```\n'
+    text = '````md\n' + inner * 200 + '````'
+    parts = split_message(text, limit=500)
+    assert_fits(parts, limit=500)
+    assert sum(part.count('print(1)') for part in parts) == 200
+
+
+class Target:
+    """Stands in for the Discord message being replied to"""
+    def __init__(self, sent):
+        self.sent = sent
+
+    async def reply(self, content):
+        self.sent.append((self, content))
+
+
+def send_together(sender, replies):
+    """Queue replies on one channel at once and return whether each was delivered"""
+    async def scenario():
+        return await asyncio.gather(*(sender.send(1, target, text, created) for target, text, created in replies))
+    return asyncio.run(scenario())
+
+
+def test_replies_to_the_same_message_are_combined():
+    sent = []
+    target = Target(sent)
+    now = time.time()
+    sender = ReplySender()
+    delivered = send_together(sender, [(target, 'one', now - 1), (target, 'two', now - 1)])
+    assert delivered == [True, True]
+    assert sent == [(target, 'one\n\ntwo')]
+    assert sender.combined == 1
+    assert sender.queue_depth() == 0
+
+
+def test_replies_to_different_messages_are_sent_separately():
+    sent = []
+    first, second = Target(sent), Target(sent)
+    now = time.time()
+    sender = ReplySender()
+    send_together(sender, [(first, 'one', now - 2), (second, 'two', now - 1)])
+    # The freshest message is answered first, each as a reply to its own message
+    assert sent == [(second, 'two'), (first, 'one')]
+    assert sender.combined == 0
@@ -0,0 +1,30 @@
+import asyncio
+
+from persistence import BackgroundWriter
+
+
+def test_failing_snapshot_does_not_stop_the_writer():
+    writer = BackgroundWriter(delay=0.01)
+    written = []
+    failures = [RuntimeError('dictionary changed size during iteration')]
+
+    def flaky_snapshot():
+        if failures:
+            raise failures.pop()
+        return 'flaky'
+
+    writer.register('flaky', flaky_snapshot, written.append)
+    writer.register('steady', lambda: 'steady', written.append)
+
+    async def scenario():
+        writer.start()
+        writer.mark_dirty('flaky')
+        writer.mark_dirty('steady')
+        await asyncio.sleep(0.1)
+        assert not writer._task.done()
+        # The failed job was retried on the next pass
+        assert sorted(written) == ['flaky', 'steady']
+        writer.mark_dirty('steady')
+        await writer.stop()
+    asyncio.run(scenario())
+    assert written.count('steady') == 2
@@ -0,0 +1,199 @@
+import asyncio
+
+import pytest
+
+from resilience import CircuitBreaker, Overloaded, RequestGuard, TokenBucket
+from fake_provider import FakeProvider
+
+
+class Outage(Exception):
+    """Stands in for a 5xx or connection error"""
+
+
+class RateLimited(Exception):
+    """Stands in for a 429"""
+    def __init__(self, retry_after=None):
+        super().__init__('rate limited')
+        self.retry_after = retry_after
+
+
+class BadRequest(Exception):
+    """Stands in for a 4xx that retrying cannot fix"""
+
+
+def classify(error):
+    if isinstance(error, Outage):
+        return True, True, None
+    if isinstance(error, RateLimited):
+        return True, False, error.retry_after
+    return False, False, None
+
+
+def make_guard(**kwargs):
+    kwargs.setdefault('key_rate', 0)
+    kwargs.setdefault('guild_rate', 0)
+    kwargs.setdefault('retry_base_delay', 0)
+    return RequestGuard(classify, **kwargs)
+
+
+def send(guard, provider, guild_id=None):
+    async def request():
+        async with guard.admit(guild_id):
+            return await guard.call(lambda: provider.create(model='m'))
+    return asyncio.run(request())
+
+
+def test_token_bucket_allows_a_burst_then_paces(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve(max_wait=0.5) is None
+
+
+def test_token_bucket_refills_over_time(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    for _ in range(3):
+        bucket.reserve()
+    assert not bucket.is_full()
+    clock.now += 1.5
+    assert bucket.is_full()
+    assert bucket.reserve() == 0.0
+
+
+def test_token_bucket_pause_delays_everyone(clock):
+    bucket = TokenBucket(rate=10, burst=10)
+    bucket.pause(4)
+    assert bucket.reserve() == pytest.approx(4)
+    clock.now += 4
+    assert bucket.reserve() == 0.0
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_success()
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_breaker_failed_trial_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    clock.now += 29
+    assert not breaker.allow()
+
+
+def test_breaker_abandoned_trial_allows_another(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.abandon()
+    assert breaker.allow()
+
+
+def test_guard_retries_transient_failures():
+    provider = FakeProvider([Outage(), RateLimited(), 'hello'])
+    retries = []
+    guard = make_guard(max_retries=2, on_retry=retries.append)
+    result = send(guard, provider)
+    assert result.choices[0].message.content == 'hello'
+    assert len(provider.requests) == 3
+    assert len(retries) == 2
+    assert guard.breaker.state == 'closed'
+
+
+def test_guard_gives_up_after_max_retries():
+    provider = FakeProvider([Outage(), Outage(), Outage()])
+    guard = make_guard(max_retries=1)
+    with pytest.raises(Outage):
+        send(guard, provider)
+    assert len(provider.requests) == 2
+
+
+def test_guard_does_not_retry_bad_requests():
+    provider = FakeProvider([BadRequest()])
+    guard = make_guard(max_retries=2)
+    with pytest.raises(BadRequest):
+        send(guard, provider)
+    assert len(provider.requests) == 1
+
+
+def test_guard_gives_up_when_retry_after_is_too_long():
+    provider = FakeProvider([RateLimited(retry_after=60)])
+    guard = make_guard(max_retries=2, retry_max_delay=8)
+    with pytest.raises(RateLimited):
+        send(guard, provider)
+    assert len(provider.requests) == 1
+
+
+def test_guard_sheds_requests_while_circuit_is_open(clock):
+    provider = FakeProvider([Outage()] * 3)
+    guard = make_guard(max_retries=0, breaker=CircuitBreaker(failure_threshold=3, reset_timeout=30))
+    for _ in range(3):
+        with pytest.raises(Outage):
+            send(guard, provider)
+    with pytest.raises(Overloaded) as shed:
+        send(guard, provider)
+    assert shed.value.reason == 'circuit_open'
+    assert len(provider.requests) == 3
+
+    # After the reset timeout a trial request goes through and closes the circuit
+    clock.now += 30
+    assert send(guard, provider).choices[0].message.content == 'ok'
+    assert guard.breaker.state == 'closed'
+
+
+def test_rate_limits_do_not_open_the_circuit():
+    provider = FakeProvider([RateLimited()] * 5)
+    guard = make_guard(max_retries=0, breaker=CircuitBreaker(failure_threshold=2))
+    for _ in range(5):
+        with pytest.raises(RateLimited):
+            send(guard, provider)
+    assert guard.breaker.state == 'closed'
+
+
+def test_guard_sheds_when_too_many_requests_are_pending():
+    guard = make_guard(max_pending=1)
+
+    async def scenario():
+        async with guard.admit():
+            with pytest.raises(Overloaded) as shed:
+                async with guard.admit():
+                    pass
+            return shed.value.reason
+    assert asyncio.run(scenario()) == 'queue_full'
+    assert guard.pending == 0
+
+
+def test_guard_sheds_guilds_over_their_rate(clock):
+    provider = FakeProvider()
+    guard = make_guard(guild_rate=0.1, guild_burst=2, guild_max_wait=5)
+    send(guard, provider, guild_id=1)
+    send(guard, provider, guild_id=1)
+    with pytest.raises(Overloaded) as shed:
+        send(guard, provider, guild_id=1)
+    assert shed.value.reason == 'guild_rate'
+    # Other guilds have their own bucket
+    send(guard, provider, guild_id=2)
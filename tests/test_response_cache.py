@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import bot
+from response_cache import ResponseCache
+
+MESSAGES = [{'role': 'user', 'content': 'alice: hi'}]
+
+
+def test_keys_cover_messages_and_parameters():
+    key = ResponseCache.make_key(MESSAGES, model='small', temperature=0.7)
+    assert key == ResponseCache.make_key(list(MESSAGES), temperature=0.7, model='small')
+    assert key != ResponseCache.make_key(MESSAGES, model='large', temperature=0.7)
+    assert key != ResponseCache.make_key(MESSAGES + [{'role': 'user', 'content': 'bob: hey'}], model='small', temperature=0.7)
+
+
+def test_hits_and_misses_are_counted():
+    cache = ResponseCache()
+    assert cache.get('k') is None
+    cache.put('k', 'hello')
+    assert cache.get('k') == 'hello'
+    assert (cache.hits, cache.misses, cache.hit_rate()) == (1, 1, 0.5)
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = ResponseCache(ttl=60)
+    cache.put('k', 'hello')
+    clock.now += 60
+    assert cache.get('k') == 'hello'
+    clock.now += 1
+    assert cache.get('k') is None
+    assert 'k' not in cache.entries
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert list(cache.entries) == ['a', 'c']
+
+
+def ask(content, guild_id=1, channel_id=50):
+    return asyncio.run(bot.generate_ai_response(content, 'alice', guild_id, channel_id))
+
+
+def test_repeated_request_reuses_the_reply(provider, bot_state, monkeypatch):
+    bot_state()
+    monkeypatch.setattr(bot, 'response_cache', ResponseCache())
+    provider.outcomes = ['first answer', 'second answer']
+    assert ask('what time is it?') == 'first answer'
+    assert ask('what time is it?') == 'first answer'
+    assert len(provider.requests) == 1
+
+
+def test_new_message_in_the_channel_invalidates_the_reply(provider, bot_state, monkeypatch):
+    bot_state()
+    monkeypatch.setattr(bot, 'response_cache', ResponseCache())
+    provider.outcomes = ['first answer', 'second answer']
+    assert ask('what time is it?') == 'first answer'
+    # The channel's context is part of the key, so anything said since is a miss
+    bot.message_ingestor.submit(50, 1, 'bob', 2, 'it is noon', time.time())
+    assert ask('what time is it?') == 'second answer'
+    assert len(provider.requests) == 2
+
+
+def test_guilds_can_opt_out(provider, bot_state, monkeypatch):
+    bot_state()
+    monkeypatch.setattr(bot, 'response_cache', ResponseCache())
+    monkeypatch.setattr(bot, 'guild_settings', {'1': {'response_cache': False}})
+    ask('what time is it?')
+    ask('what time is it?')
+    assert len(provider.requests) == 2
+    assert not bot.response_cache.entries
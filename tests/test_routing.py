@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+import pytest
+
+from routing import ModelRouter, estimate_prompt_tokens, parse_model_prices
+
+
+def test_auto_mode_routes_by_prompt_size():
+    router = ModelRouter('small', 'large', large_tokens=100)
+    assert router.choose(100) == 'small'
+    assert router.choose(101) == 'large'
+
+
+def test_pinned_modes_ignore_prompt_size():
+    router = ModelRouter('small', 'large', large_tokens=100)
+    assert router.choose(5000, 'small') == 'small'
+    assert router.choose(5, 'large') == 'large'
+
+
+def test_slow_model_fails_over_to_the_fastest(clock):
+    router = ModelRouter('small', 'large', large_tokens=100, slow_seconds=5)
+    router.record('large', 12)
+    router.record('small', 1)
+    assert router.choose(500) == 'small'
+    assert router.fallbacks == 1
+
+
+def test_failed_requests_count_as_slowness(clock):
+    router = ModelRouter('small', 'large', slow_seconds=5)
+    router.record('small', 30, failed=True)
+    assert router.choose(10) == 'large'
+    assert router.model_stats('small').errors == 1
+
+
+def test_busy_upstream_prefers_the_fastest_model(clock):
+    busy = [False]
+    router = ModelRouter('small', 'large', large_tokens=100, busy_fn=lambda: busy[0])
+    router.record('small', 0.5)
+    router.record('large', 2)
+    assert router.choose(500) == 'large'
+    busy[0] = True
+    assert router.choose(500) == 'small'
+
+
+def test_slow_model_is_retried_once_its_latency_is_stale(clock):
+    router = ModelRouter('small', 'large', large_tokens=100, slow_seconds=5, stale_seconds=60)
+    router.record('large', 12)
+    assert router.choose(500) == 'small'
+    clock.now += 61
+    assert router.choose(500) == 'large'
+
+
+def test_latency_is_a_moving_average(clock):
+    router = ModelRouter('small', 'large', latency_weight=0.5)
+    router.record('small', 2)
+    router.record('small', 4)
+    assert router.latency('small') == pytest.approx(3)
+
+
+def test_usage_is_priced_per_model():
+    router = ModelRouter('small', 'large', prices=parse_model_prices('small=1:2, large=10:20'))
+    router.record_usage('small', SimpleNamespace(prompt_tokens=1_000_000, completion_tokens=500_000))
+    router.record_usage('large', None)
+    assert router.model_stats('small').cost == pytest.approx(2.0)
+    assert router.model_stats('large').cost == 0
+
+
+def test_same_small_and_large_model_disables_routing():
+    router = ModelRouter('only', None)
+    assert router.choose(10_000) == 'only'
+    assert list(router.stats) == ['only']
+
+
+def test_prompt_estimate_uses_the_exact_system_prompt_count():
+    messages = [{'role': 'system', 'content': 'x' * 1000}, {'role': 'user', 'content': 'y' * 40}]
+    assert estimate_prompt_tokens(messages, 250) == 250 + 10 + 4
@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+from memory_store import MessageMemory
+from persistence import BackgroundWriter
+from summarizer import RollingSummarizer
+
+
+def test_channels_are_batched_on_their_own_clocks():
+    calls = []  # (channel, messages summarized, seconds since start)
+
+    async def summarize(previous, messages):
+        calls.append((messages[0].author_id, len(messages), time.monotonic() - started))
+        return f'{previous or ""}+{len(messages)}'
+
+    async def evict(summarizer, channel_id, count, interval):
+        for i in range(count):
+            summarizer.add_evicted(channel_id, MessageMemory('alice', channel_id, f'message {i}', time.time()))
+            await asyncio.sleep(interval)
+
+    async def scenario():
+        summarizer = RollingSummarizer(BackgroundWriter(), summarize, None, batch_size=5, delay=0.3)
+        summarizer.start()
+        # Channel 1 evicts every 10ms for 0.6s; channel 2 evicts four messages 40ms apart
+        await asyncio.gather(evict(summarizer, 1, 60, 0.01), evict(summarizer, 2, 4, 0.04))
+        await asyncio.sleep(0.1)
+        summarizer._task.cancel()
+        return summarizer
+
+    started = time.monotonic()
+    summarizer = asyncio.run(scenario())
+
+    busy = [(count, at) for channel_id, count, at in calls if channel_id == 1]
+    quiet = [(count, at) for channel_id, count, at in calls if channel_id == 2]
+    assert [count for count, _ in busy] == [5] * 12
+    # The quiet channel is summarized once, when its first eviction has waited the delay,
+    # while the busy channel is still evicting
+    assert len(quiet) == 1
+    count, at = quiet[0]
+    assert count == 4
+    assert 0.3 <= at < 0.5
+    assert summarizer.get(2) == '+4'
+    assert summarizer.pending == {} and summarizer.pending_since == {}
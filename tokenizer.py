@@ -0,0 +1,39 @@
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Approximate tokens added by chat formatting (role and separators) per message
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Roughly how many characters one token covers in English text
+CHARS_PER_TOKEN = 4
+
+_encoding = None
+_encoding_failed = False
+
+
+def get_encoding():
+    """Return the local tiktoken encoding, or None if it is unavailable"""
+    global _encoding, _encoding_failed
+    if _encoding is None and tiktoken is not None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.get_encoding('o200k_base')
+        except Exception as e:
+            # The encoding file may need downloading; fall back instead of failing replies
+            print(f"Tokenizer unavailable, using character estimate: {e}")
+            _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Count tokens in text, estimating from its length when no tokenizer is available"""
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def count_message_tokens(text):
+    """Count tokens for one chat message, including formatting overhead"""
+    return count_tokens(text) + MESSAGE_TOKEN_OVERHEAD